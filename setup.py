@@ -39,8 +39,15 @@ setup(
     install_requires=[
         'zope.component',
         'zope.interface',
-        'sqlalchemy',
+        'sqlalchemy>=1.3,<1.4',
         'redis',
         'pyramid_redis',
-    ]
+    ],
+    entry_points = {
+        'console_scripts': [
+            'alkey-heat = alkey.heatmap:main',
+            'alkey-relay = alkey.relay:main',
+            'alkey-sweep = alkey.sweep:main',
+        ],
+    },
 )
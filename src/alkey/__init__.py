@@ -4,9 +4,27 @@
   ``config.include('alkey')``.
 """
 
+import functools
+import logging
+logger = logging.getLogger(__name__)
+
 from .cache import get_cache_key_generator
 from .cache import get_cache_manager
 from .events import bind as bind_to_events
+from .feed import get_change_feed
+from .handle import bulk_mode
+from .handle import handle_bulk
+from .handle import handle_commit
+from .handle import handle_execute
+from .handle import handle_flush
+from .handle import invalidate_tokens
+from .heatmap import get_heat_map
+from .policy import get_tracking_policy
+from .popularity import handle_new_request
+from .popularity import has_local_cache
+from .prefetch import bind as bind_prefetch
+from .prefetch import handle_before_render
+from .utils import as_bool
 
 # Taken from zope.dottedname
 def _resolve_dotted(name, module=None): #pragma: no cover
@@ -32,7 +50,7 @@ def _resolve_dotted(name, module=None): #pragma: no cover
     return found
 
 
-def includeme(config, bind=None, resolve=None):
+def includeme(config, bind=None, resolve=None, prefetch=None):
     """Pyramid configuration for this package.
 
       Setup::
@@ -42,6 +60,7 @@ def includeme(config, bind=None, resolve=None):
           >>> mock_config.registry.settings = {}
           >>> mock_bind = Mock()
           >>> mock_resolve = Mock()
+          >>> mock_prefetch = Mock()
 
       Binds session events to the pyramid_basemodel.Session by default::
 
@@ -56,6 +75,52 @@ def includeme(config, bind=None, resolve=None):
           >>> includeme(mock_config, bind=mock_bind, resolve=mock_resolve)
           >>> mock_resolve.assert_called_with('mock.Mock')
 
+      If ``alkey.feed`` is set, commits are recorded to the change feed::
+
+          >>> mock_config.registry.settings = {'alkey.feed': 'true'}
+          >>> includeme(mock_config, bind=mock_bind, resolve=mock_resolve)
+          >>> commit = mock_bind.call_args[1]['commit']
+          >>> commit.keywords['invalidate'].keywords['feed'].key
+          'alkey.feed.CHANGES'
+
+      If ``alkey.heat_map`` is set, invalidations are counted::
+
+          >>> mock_config.registry.settings = {'alkey.heat_map': 'true'}
+          >>> includeme(mock_config, bind=mock_bind, resolve=mock_resolve)
+          >>> kwargs = mock_bind.call_args[1]
+          >>> heat = kwargs['commit'].keywords['invalidate'].keywords['heat']
+          >>> kwargs['flush'].keywords['heat'] is heat
+          True
+
+      If ``alkey.policy.untracked`` or ``alkey.policy.no_global`` are set,
+      the handlers skip the tables they list::
+
+          >>> mock_config.registry.settings = {
+          ...         'alkey.policy.untracked': 'audit_logs'}
+          >>> includeme(mock_config, bind=mock_bind, resolve=mock_resolve)
+          >>> kwargs = mock_bind.call_args[1]
+          >>> kwargs['execute'].keywords['policy'].untracked
+          set(['audit_logs'])
+
+      If ``alkey.prefetch`` is set, the tokens of the instances a request
+      loads are prefetched::
+
+          >>> mock_config.registry.settings = {'alkey.prefetch': 'true'}
+          >>> includeme(mock_config, bind=mock_bind, resolve=mock_resolve,
+          ...         prefetch=mock_prefetch)
+          >>> mock_prefetch.assert_called_with(mock_resolve.return_value)
+          >>> mock_config.add_subscriber.assert_called_with(
+          ...         handle_before_render, 'pyramid.events.BeforeRender')
+
+      If ``alkey.popularity`` is set (with a local token cache), each process
+      warms its local token cache, starting on its first request::
+
+          >>> mock_config.registry.settings = {'alkey.popularity': 'true',
+          ...         'alkey.tracking': 'true'}
+          >>> includeme(mock_config, bind=mock_bind, resolve=mock_resolve)
+          >>> mock_config.add_subscriber.assert_called_with(
+          ...         handle_new_request, 'pyramid.events.NewRequest')
+
       Includes ``pyramid_redis``::
 
           >>> mock_config.include.assert_called_with('pyramid_redis')
@@ -75,14 +140,45 @@ def includeme(config, bind=None, resolve=None):
         bind = bind_to_events
     if resolve is None: #pragma: no cover
         resolve = _resolve_dotted
+    if prefetch is None: #pragma: no cover
+        prefetch = bind_prefetch
 
     # Get the session class.
     settings = config.registry.settings
     dotted_path = settings.get('alkey.session_cls', 'pyramid_basemodel.Session')
     session_cls = resolve(dotted_path)
 
-    # Bind to events.
-    bind(session_cls)
+    # Bind to events, recording commits to the change feed, counting
+    # invalidations in the heat map and applying the tracking policy if
+    # they're configured.
+    feed = get_change_feed(settings)
+    heat = get_heat_map(settings)
+    policy = get_tracking_policy(settings)
+    handlers = {}
+    if feed is not None or heat is not None or policy is not None:
+        invalidate = functools.partial(invalidate_tokens, feed=feed, heat=heat,
+                policy=policy)
+        handlers['commit'] = functools.partial(handle_commit,
+                invalidate=invalidate)
+    if heat is not None or policy is not None:
+        kwargs = dict(heat=heat, policy=policy)
+        handlers['flush'] = functools.partial(handle_flush, **kwargs)
+        handlers['bulk'] = functools.partial(handle_bulk, **kwargs)
+        handlers['execute'] = functools.partial(handle_execute, **kwargs)
+    bind(session_cls, **handlers)
+
+    # Prefetch the tokens of the instances that requests load.
+    if as_bool(settings.get('alkey.prefetch', False)):
+        prefetch(session_cls)
+        config.add_subscriber(handle_before_render, 'pyramid.events.BeforeRender')
+
+    # Warm up each process' local token cache.
+    if as_bool(settings.get('alkey.popularity', False)):
+        if has_local_cache(settings):
+            config.add_subscriber(handle_new_request, 'pyramid.events.NewRequest')
+        else:
+            logger.warn(u'alkey.popularity is ignored without a local token '
+                    u'cache (alkey.tracking or alkey.host_table).')
 
     # Extend the request.
     config.include('pyramid_redis')
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``BucketedRedis``, a redis client that stores row tokens in small
+  per table hashes, rather than one string key per row, e.g.::
+
+      client = BucketedRedis(redis_client)
+      client.setex(u'alkey.cache.TOKENS:alkey:users#1234', 60, token)
+      # HSET alkey.cache.BUCKETS:users:12 34 <compact token>
+      # EXPIRE alkey.cache.BUCKETS:users:12 60
+
+  Integer ids are bucketed by ``id // size``, so neighbouring rows share a
+  bucket. Other ids are bucketed by their CRC32 checksum. Datetime stamps are
+  stored as base 36 microseconds (and expanded again when read). Small hashes
+  use Redis' compact encoding, so this saves most of the per key overhead.
+
+  Buckets expire as a whole, ``ttl`` seconds after their last write, unless
+  ``ttl_fields`` is set, in which case each field is expired using ``HEXPIRE``
+  (which requires Redis 7.4+).
+
+  Table and global write tokens are stored as strings, as before.
+"""
+
+__all__ = [
+    'BucketedPipeline',
+    'BucketedRedis',
+    'compact_stamp',
+    'expand_stamp',
+    'get_bucketed_client',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import zlib
+from datetime import datetime
+from datetime import timedelta
+
+import redis
+
+from .constants import BUCKET_NAMESPACE
+from .constants import TOKEN_NAMESPACE
+from .utils import as_bool
+from .utils import valid_object_id
+
+BASE36_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+EPOCH = datetime(1970, 1, 1)
+STAMP_FORMATS = ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S')
+
+# Compacted stamps are marked with a leading ``!``. Other values that start
+# with a marker are escaped with a leading ``~``.
+COMPACT_MARKER = '!'
+ESCAPE_MARKER = '~'
+
+def compact_stamp(value):
+    """Return a compact form of a ``get_stamp`` datetime ``value``, i.e.: the
+      microseconds since the epoch in base 36. Other values are returned as
+      they are, escaped if need be::
+
+          >>> compact_stamp('2014-01-01 00:00:00.000001')
+          '!do6zwav401'
+          >>> compact_stamp(u'foo'), compact_stamp(u'!foo')
+          (u'foo', u'~!foo')
+
+    """
+
+    dt = None
+    for fmt in STAMP_FORMATS:
+        try:
+            dt = datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            continue
+        break
+    if dt is None:
+        if isinstance(value, basestring) and value[:1] in (COMPACT_MARKER,
+                ESCAPE_MARKER):
+            return ESCAPE_MARKER + value
+        return value
+    delta = dt - EPOCH
+    n = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    digits = []
+    while True:
+        n, i = divmod(n, 36)
+        digits.append(BASE36_DIGITS[i])
+        if not n:
+            break
+    return COMPACT_MARKER + ''.join(reversed(digits))
+
+def expand_stamp(value):
+    """Reverse ``compact_stamp``::
+
+          >>> expand_stamp('!do6zwav401')
+          '2014-01-01 00:00:00.000001'
+          >>> expand_stamp(compact_stamp('2014-01-01 00:00:00'))
+          '2014-01-01 00:00:00'
+          >>> expand_stamp('~!foo'), expand_stamp('foo'), expand_stamp(None)
+          ('!foo', 'foo', None)
+
+    """
+
+    if not value or not isinstance(value, basestring):
+        return value
+    if value[0] == ESCAPE_MARKER:
+        return value[1:]
+    if value[0] != COMPACT_MARKER:
+        return value
+    return str(EPOCH + timedelta(microseconds=int(value[1:], 36)))
+
+
+class BucketedRedis(redis.StrictRedis):
+    """Translate the ``GET``, ``MGET``, ``SETEX`` and ``DEL`` commands for row
+      token keys into hash commands on their buckets, passing everything else
+      through to the ``inner`` client.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> inner = Mock()
+          >>> client = BucketedRedis(inner)
+
+      Integer ids are bucketed by ``id // size``::
+
+          >>> client.get_bucket(u'alkey.cache.TOKENS:alkey:users#1234')
+          (u'alkey.cache.BUCKETS:users:12', u'34')
+
+      Other ids by their checksum::
+
+          >>> client.get_bucket(u'alkey.cache.TOKENS:alkey:tags#a%23b')
+          (u'alkey.cache.BUCKETS:tags:h41558', u'a%23b')
+
+      Write tokens and other keys aren't bucketed::
+
+          >>> client.get_bucket(u'alkey.cache.TOKENS:alkey:users#*')
+          >>> client.get_bucket('foo')
+
+      Reads use ``HGET``::
+
+          >>> return_value = client.get(u'alkey.cache.TOKENS:alkey:users#1234')
+          >>> inner.execute_command.assert_called_with('HGET',
+          ...         u'alkey.cache.BUCKETS:users:12', u'34')
+
+      Or ``HMGET`` per bucket, returning the values in order::
+
+          >>> pipeline = inner.pipeline.return_value
+          >>> pipeline.execute.return_value = [['a', 'b'], 'c']
+          >>> client.mget([u'alkey.cache.TOKENS:alkey:users#1',
+          ...         u'alkey.cache.TOKENS:alkey:users#*',
+          ...         u'alkey.cache.TOKENS:alkey:users#2'])
+          ['a', 'c', 'b']
+          >>> pipeline.execute_command.assert_any_call('HMGET',
+          ...         u'alkey.cache.BUCKETS:users:0', u'1', u'2')
+
+    """
+
+    def __init__(self, inner, size=100, count=65536, ttl_fields=False,
+            namespace=None, bucket_namespace=None, compact=None, expand=None):
+        # Compose.
+        if namespace is None:
+            namespace = TOKEN_NAMESPACE
+        if bucket_namespace is None:
+            bucket_namespace = BUCKET_NAMESPACE
+        if compact is None:
+            compact = compact_stamp
+        if expand is None:
+            expand = expand_stamp
+
+        # Assign.
+        self.inner = inner
+        self.size = size
+        self.count = count
+        self.ttl_fields = ttl_fields
+        self.prefix = u'{0}:'.format(namespace)
+        self.bucket_namespace = bucket_namespace
+        self.compact = compact
+        self.expand = expand
+        self.response_callbacks = {}
+        self.connection = None
+
+    def __repr__(self):
+        return '{0}<{1!r}>'.format(type(self).__name__, self.inner)
+
+    def get_bucket(self, key):
+        """Return ``(bucket_key, field)`` for a row token ``key``, or ``None``
+          if it isn't one.
+        """
+
+        if isinstance(key, str):
+            key = key.decode('utf-8')
+        if not isinstance(key, unicode) or not key.startswith(self.prefix):
+            return None
+        oid = key[len(self.prefix):]
+        if not valid_object_id.match(oid):
+            return None
+        tablename, identity = oid[len(u'alkey:'):].split(u'#', 1)
+        if identity.isdigit():
+            bucket, field = divmod(int(identity), self.size)
+            field = unicode(field)
+        else:
+            checksum = zlib.crc32(identity.encode('utf-8')) & 0xffffffff
+            bucket = u'h{0}'.format(checksum % self.count)
+            field = identity
+        bucket_key = u'{0}:{1}:{2}'.format(self.bucket_namespace, tablename, bucket)
+        return bucket_key, field
+
+    def get_expire_command(self, bucket_key, field, ttl):
+        if self.ttl_fields:
+            return ('HEXPIRE', bucket_key, ttl, 'FIELDS', 1, field)
+        return ('EXPIRE', bucket_key, ttl)
+
+    def translate(self, args, options):
+        """Return ``(commands, combine)``, where ``commands`` is a list of
+          ``(args, options)`` to send to the inner client and ``combine``
+          reduces their results to the result of the original command.
+        """
+
+        command = args[0].upper()
+        passthrough = ([(args, options)], lambda results: results[0])
+        if command not in ('GET', 'MGET', 'SETEX', 'DEL') or len(args) < 2:
+            return passthrough
+
+        if command in ('GET', 'SETEX'):
+            bucket = self.get_bucket(args[1])
+            if bucket is None:
+                return passthrough
+            bucket_key, field = bucket
+            if command == 'GET':
+                combine = lambda results: self.expand(results[0])
+                return [(('HGET', bucket_key, field), options)], combine
+            ttl, value = args[2], args[3]
+            commands = [
+                (('HSET', bucket_key, field, self.compact(value)), {}),
+                (self.get_expire_command(bucket_key, field, ttl), {}),
+            ]
+            return commands, lambda results: True
+
+        # Group multi key commands by bucket, leaving the other keys as a
+        # single command.
+        groups = {}
+        order = []
+        other = []
+        for position, key in enumerate(args[1:]):
+            bucket = self.get_bucket(key)
+            if bucket is None:
+                other.append((position, key))
+                continue
+            bucket_key, field = bucket
+            if bucket_key not in groups:
+                groups[bucket_key] = []
+                order.append(bucket_key)
+            groups[bucket_key].append((position, field))
+        name = 'HMGET' if command == 'MGET' else 'HDEL'
+        commands = []
+        positions = []
+        for bucket_key in order:
+            items = groups[bucket_key]
+            commands.append(((name, bucket_key) + tuple(f for _, f in items), {}))
+            positions.append(items)
+        if other:
+            commands.append(((command,) + tuple(k for _, k in other), options))
+            positions.append(other)
+        if command == 'DEL':
+            return commands, sum
+        def combine(results):
+            values = [None] * (len(args) - 1)
+            for items, part_values in zip(positions, results):
+                for (position, _), value in zip(items, part_values):
+                    values[position] = self.expand(value)
+            return values
+        return commands, combine
+
+    def execute_command(self, *args, **options):
+        commands, combine = self.translate(args, options)
+        if len(commands) == 1:
+            args_, options_ = commands[0]
+            return combine([self.inner.execute_command(*args_, **options_)])
+        pipeline = self.inner.pipeline(transaction=False)
+        for args_, options_ in commands:
+            pipeline.execute_command(*args_, **options_)
+        return combine(pipeline.execute())
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return BucketedPipeline(self, transaction=transaction, shard_hint=shard_hint)
+
+    def scan_iter(self, match=None, count=None):
+        return self.inner.scan_iter(match=match, count=count)
+
+
+class BucketedPipeline(BucketedRedis):
+    """Buffer translated commands and then execute them in one pipeline,
+      only expiring each bucket once::
+
+          >>> from mock import Mock
+          >>> inner = Mock()
+          >>> inner_pipeline = inner.pipeline.return_value
+          >>> inner_pipeline.execute.return_value = [1, 1, True]
+          >>> client = BucketedRedis(inner)
+          >>> pipeline = client.pipeline(transaction=False)
+          >>> key = u'alkey.cache.TOKENS:alkey:users#{0}'
+          >>> pipeline.setex(key.format(1), 60, 'a').setex(key.format(2), 60, 'b')
+          ... # doctest: +ELLIPSIS
+          BucketedPipeline<...>
+          >>> pipeline.execute()
+          [True, True]
+          >>> inner_pipeline.execute_command.call_count
+          3
+
+    """
+
+    def __init__(self, bucketed, transaction=True, shard_hint=None):
+        self.bucketed = bucketed
+        self.transaction = transaction
+        self.shard_hint = shard_hint
+        self.command_stack = []
+        self.response_callbacks = {}
+        self.connection = None
+
+    def __repr__(self):
+        return '{0}<{1!r}>'.format(type(self).__name__, self.bucketed)
+
+    def execute_command(self, *args, **options):
+        self.command_stack.append(self.bucketed.translate(args, options))
+        return self
+
+    def execute(self):
+        """Execute the buffered commands, returning their results in order."""
+
+        translations, self.command_stack = self.command_stack, []
+        pipeline = self.bucketed.inner.pipeline(transaction=self.transaction,
+                shard_hint=self.shard_hint)
+        counts = []
+        expired = set()
+        for commands, combine in translations:
+            count = 0
+            for args, options in commands:
+                # Every write to a bucket extends its expiry, so only the
+                # first is needed.
+                if args[0] == 'EXPIRE':
+                    if args in expired:
+                        continue
+                    expired.add(args)
+                pipeline.execute_command(*args, **options)
+                count += 1
+            counts.append(count)
+        results = iter(pipeline.execute())
+        combined = []
+        for (commands, combine), count in zip(translations, counts):
+            combined.append(combine([next(results) for _ in range(count)]))
+        return combined
+
+    def reset(self):
+        self.command_stack = []
+
+
+def get_bucketed_client(redis_client, settings, bucketed_cls=None):
+    """Return a ``BucketedRedis`` client wrapping ``redis_client``, configured
+      using ``alkey.buckets.size``, ``alkey.buckets.count`` and
+      ``alkey.buckets.ttl_fields``::
+
+          >>> from mock import Mock
+          >>> mock_cls = Mock()
+          >>> settings = {'alkey.buckets.size': '50',
+          ...         'alkey.buckets.ttl_fields': 'on'}
+          >>> client = get_bucketed_client('<client>', settings,
+          ...         bucketed_cls=mock_cls)
+          >>> mock_cls.assert_called_with('<client>', size=50, count=65536,
+          ...         ttl_fields=True)
+
+    """
+
+    # Compose.
+    if bucketed_cls is None:
+        bucketed_cls = BucketedRedis
+
+    size = int(settings.get('alkey.buckets.size', 100))
+    count = int(settings.get('alkey.buckets.count', 65536))
+    ttl_fields = as_bool(settings.get('alkey.buckets.ttl_fields', False))
+    return bucketed_cls(redis_client, size=size, count=count, ttl_fields=ttl_fields)
@@ -18,30 +18,34 @@
 
 __all__ = [
     'CacheKeyGenerator',
+    'LazyCacheKey',
+    'batch_token_getter',
     'get_cache_key_generator',
+    'get_digest',
+    'get_generator_kwargs',
     'get_token_key',
     'get_token',
+    'get_tokens',
+    'read_tokens',
     'set_token'
 ]
 
 import logging
 logger = logging.getLogger(__name__)
 
+import hashlib
 from datetime import datetime
 
-try:
-    from beaker.cache import CacheManager
-    from beaker.util import parse_cache_config_options
-except ImportError:
-    pass
-
 from redis.exceptions import ConnectionError
 
 from .client import get_redis_client
+from .cluster import is_cluster
+from .cluster import mget_by_slot
 from .constants import CACHE_INI_NAMESPACES
 from .constants import GLOBAL_WRITE_TOKEN
 from .constants import MAX_CACHE_DURATION
 from .constants import TOKEN_NAMESPACE
+from .utils import as_bool
 from .utils import get_object_id
 from .utils import get_stamp
 from .utils import resiliently_call
@@ -101,6 +105,137 @@ def get_token(redis_client, instance, get_key=None, get_value=None,
         call(set_value, args=(redis_client, instance, token_value))
     return token_value
 
+def read_tokens(redis_client, instances, get_key=None, cluster=None):
+    """Read the stored tokens of the ``instances`` in one round trip, without
+      storing new tokens for the missing ones, which are returned as ``None``::
+
+          >>> from mock import Mock
+          >>> mock_client = Mock()
+          >>> mock_client.mget.return_value = ['a', None]
+          >>> read_tokens(mock_client, ['i1', 'i2'], get_key=lambda x: x,
+          ...         cluster=False)
+          ['a', None]
+          >>> mock_client.pipeline.called
+          False
+
+    """
+
+    # Compose.
+    if get_key is None:
+        get_key = get_token_key
+    if cluster is None:
+        cluster = is_cluster(redis_client)
+
+    if not instances:
+        return []
+    keys = [get_key(item) for item in instances]
+    if cluster:
+        return mget_by_slot(redis_client, keys)
+    return redis_client.mget(keys)
+
+def get_tokens(redis_client, instances, get_key=None, get_value=None,
+        set_value=None, call=None, cluster=None):
+    """Provide a batched ``get_token``, that reads the tokens for all of the
+      ``instances`` in one round trip and then stores new tokens for any that
+      are missing in one pipeline.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> mock_client = Mock()
+          >>> mock_client.mget.return_value = ['a', None]
+          >>> mock_set_value = Mock()
+          >>> mock_kwargs = dict(get_key=lambda x: x, get_value=lambda: 'new',
+          ...         set_value=mock_set_value, cluster=False)
+
+      Returns the stored tokens, generating and storing the missing ones::
+
+          >>> get_tokens(mock_client, ['i1', 'i2'], **mock_kwargs)
+          ['a', 'new']
+          >>> mock_client.mget.assert_called_with(['i1', 'i2'])
+          >>> pipeline = mock_client.pipeline.return_value
+          >>> mock_set_value.assert_called_with(pipeline, 'i2', 'new')
+
+      In cluster mode, the keys are grouped by slot, so that no ``MGET`` spans
+      more than one slot::
+
+          >>> mock_pipeline = Mock()
+          >>> mock_pipeline.execute.return_value = [['a'], ['b']]
+          >>> mock_client.pipeline.return_value = mock_pipeline
+          >>> mock_kwargs['cluster'] = True
+          >>> get_tokens(mock_client, ['i1', 'i2'], **mock_kwargs)
+          ['a', 'b']
+
+    """
+
+    # Compose.
+    if get_key is None:
+        get_key = get_token_key
+    if get_value is None:
+        get_value = get_stamp
+    if set_value is None:
+        set_value = set_token
+    if call is None:
+        call = resiliently_call
+    if cluster is None:
+        cluster = is_cluster(redis_client)
+
+    if not instances:
+        return []
+
+    # Read all the tokens, with the same ``get and then set if None``
+    # semantics as ``get_token``.
+    try:
+        values = read_tokens(redis_client, instances, get_key=get_key,
+                cluster=cluster)
+    except ConnectionError as err:
+        logger.warn(err, exc_info=True)
+        value = get_value()
+        return [value for item in instances]
+
+    # Generate a value for the missing tokens and store them all at once.
+    missing = [i for i, item in enumerate(values) if item is None]
+    if missing:
+        value = get_value()
+        pipeline = redis_client.pipeline(transaction=False)
+        for i in missing:
+            values[i] = value
+            set_value(pipeline, instances[i], value)
+        call(pipeline.execute)
+    return values
+
+def batch_token_getter(get_token_):
+    """Wrap a ``get_token`` style callable, that returns the token for one
+      instance, into a ``get_tokens`` style one, that returns the tokens for a
+      list of them::
+
+          >>> get_tokens_ = batch_token_getter(lambda client, oid: oid.upper())
+          >>> get_tokens_('<redis client>', [u'a', u'b'])
+          [u'A', u'B']
+
+    """
+
+    def get_tokens_(redis_client, instances):
+        return [get_token_(redis_client, item) for item in instances]
+    return get_tokens_
+
+def get_digest(value):
+    """Return a fixed length (32 character) hex digest of ``value``. The
+      algorithm (truncated sha256) doesn't depend on the interpreter or the
+      installed packages, so every process generates the same keys::
+
+          >>> get_digest(u'token/alkey:users#1') == get_digest(
+          ...         'token/alkey:users#1')
+          True
+          >>> len(get_digest(u'token/alkey:users#1'))
+          32
+
+    """
+
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return hashlib.sha256(value).hexdigest()[:32]
+
 def set_token(redis_client, instance, token_value, duration=None, get_key=None):
     """Use the ``redis_client`` to set the current token for ``instance``"""
 
@@ -114,17 +249,82 @@ def set_token(redis_client, instance, token_value, duration=None, get_key=None):
     return redis_client.setex(key, duration, token_value)
 
 
+class LazyCacheKey(object):
+    """A cache key placeholder, returned by ``CacheKeyGenerator.lazy``, that's
+      resolved (along with all of the other pending placeholders) when it's
+      first turned into a string.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> mock_get_tokens = Mock()
+          >>> mock_get_tokens.return_value = [u'a', u'b']
+          >>> generator = CacheKeyGenerator(None, get_tokens_=mock_get_tokens)
+          >>> first = generator.lazy(u'alkey:users#1', u'foo')
+          >>> second = generator.lazy(u'alkey:users#2')
+
+      Reads all of the pending tokens in one go::
+
+          >>> unicode(first), str(second)
+          (u'a/alkey:users#1/foo', 'b/alkey:users#2')
+          >>> mock_get_tokens.call_count
+          1
+          >>> mock_get_tokens.call_args[0][1]
+          [u'alkey:users#1', u'alkey:users#2']
+
+      And compares and hashes like the key::
+
+          >>> first == u'a/alkey:users#1/foo'
+          True
+          >>> len(set([first, u'a/alkey:users#1/foo']))
+          1
+
+    """
+
+    def __init__(self, generator, oids):
+        self.generator = generator
+        self.oids = oids
+        self.value = None
+
+    def resolve(self):
+        """Return the cache key, resolving the pending placeholders if need be."""
+
+        if self.value is None:
+            self.generator.resolve()
+        return self.value
+
+    def __unicode__(self):
+        return self.resolve()
+
+    def __str__(self):
+        return self.resolve().encode('utf-8')
+
+    def __repr__(self):
+        return '{0}<{1!r}>'.format(type(self).__name__, self.oids)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyCacheKey):
+            other = other.resolve()
+        return self.resolve() == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.resolve())
+
+
 class CacheKeyGenerator(object):
     """Call with an object or object id to get its cache key. Implements
       `key based cache expiration <http://bit.ly/IEl4jh>`_.
     """
 
-    def __call__(self, *args):
-        """Returns the cache key using tokens for all of the args that should be
-          looked up for one, plus all of the original args.
+    def prepare(self, args):
+        """Returns a list of ``(oid, has_token)`` pairs for the ``args``, i.e.:
+          each arg's object id and whether its token should be looked up.
         """
 
-        segments = []
+        oids = []
         for arg in args:
             # Coerce strings to unicode. Presumes any string args are utf-8.
             if isinstance(arg, str):
@@ -134,47 +334,167 @@ class CacheKeyGenerator(object):
             oid = self.get_object_id(arg)
             if not isinstance(oid, unicode):
                 oid = unicode(oid)
-            # If we got a valid object id or a write token, then append the
-            # corresponding token value to the key.
+            # If we got a valid object id or a write token, then we need
+            # the corresponding token value for the key.
             is_oid = self.valid_object_id.match(oid)
             is_token = self.valid_write_token.match(oid)
-            if is_oid or is_token:
-                segments.append(self.get_token(self.redis, oid))
+            oids.append((oid, bool(is_oid or is_token)))
+        return oids
+
+    def build(self, oids, tokens):
+        """Returns the list of key segments for the prepared ``oids``, taking
+          the token values for the ones that have them from ``tokens``.
+        """
+
+        segments = []
+        for oid, has_token in oids:
+            if has_token:
+                segments.append(next(tokens))
             # Either way, always add the object id to the key -- this means
             # a key generated with an instance will be unique to that instance,
             # even if the instance timestamp value is the same as a sibling.
             segments.append(oid)
+        return segments
+
+    def segments(self, *args):
+        """Returns the list of key segments, i.e.: the tokens for all of the
+          args that should be looked up for one, plus all of the original args.
+        """
+
+        oids = self.prepare(args)
+
+        # Read all of the tokens we need in one go.
+        token_oids = [oid for oid, has_token in oids if has_token]
+        tokens = iter(self.get_tokens(self.redis, token_oids))
+        return self.build(oids, tokens)
+
+    def join(self, segments):
+        """Returns the cache key for the ``segments``, i.e.: the segments
+          joined with a ``/`` or, if ``digest`` is set, a fixed length digest
+          of them.
+        """
+
         key = u'/'.join(segments)
-        return key
+        if not self.digest:
+            return key
+        digest_key = u'{0}{1}'.format(self.prefix, self.make_digest(key))
+        if self.debug:
+            logger.debug(u'{0} = {1}'.format(digest_key, segments))
+        return digest_key
+
+    def __call__(self, *args):
+        """Returns the cache key for the ``args``."""
+
+        return self.join(self.segments(*args))
 
-    def __init__(self, redis_client, get_oid=None, get_token_=None, global_token=None,
-            valid_oid=None, valid_token=None):
-        """Instantiate a cache key generator with a redis client."""
+    def lazy(self, *args):
+        """Returns a ``LazyCacheKey`` placeholder for the ``args``. The tokens
+          for all of the pending placeholders are read in one go the first
+          time any of them is turned into a string, e.g.::
+
+              keys = [request.cache_key.lazy(item) for item in items]
+              unicode(keys[0]) # reads the tokens for all of the ``items``
+
+        """
+
+        placeholder = LazyCacheKey(self, self.prepare(args))
+        self.pending.append(placeholder)
+        return placeholder
+
+    def resolve(self):
+        """Resolve all of the pending placeholders with one token read."""
+
+        pending = self.pending
+        if not pending:
+            return
+        token_oids = []
+        for placeholder in pending:
+            token_oids.extend(oid for oid, has_token in placeholder.oids
+                    if has_token)
+        tokens = iter(self.get_tokens(self.redis, token_oids))
+        self.pending = []
+        for placeholder in pending:
+            placeholder.value = self.join(self.build(placeholder.oids, tokens))
+
+    def __init__(self, redis_client, get_oid=None, get_tokens_=None,
+            global_token=None, valid_oid=None, valid_token=None, digest=False,
+            prefix=u'', debug=False, make_digest=None, get_token_=None):
+        """Instantiate a cache key generator with a redis client. If ``digest``
+          is set, keys are a fixed length digest of the segments, after an
+          optional ``prefix``. In ``debug`` mode, the segments of each digest
+          key are logged.
+
+          Tokens are read in batches using ``get_tokens_``. A per instance
+          ``get_token_`` is still accepted and called once per token::
+
+              >>> generator = CacheKeyGenerator(None,
+              ...         get_token_=lambda client, oid: u'token')
+              >>> generator(u'alkey:users#1', u'alkey:users#2')
+              u'token/alkey:users#1/token/alkey:users#2'
+
+        """
 
         # Compose.
         if get_oid is None:
             get_oid = get_object_id
-        if get_token_ is None:
-            get_token_ = get_token
+        if get_tokens_ is None and get_token_ is not None:
+            get_tokens_ = batch_token_getter(get_token_)
+        if get_tokens_ is None:
+            get_tokens_ = get_tokens
         if global_token is None:
             global_token = GLOBAL_WRITE_TOKEN
         if valid_oid is None:
             valid_oid = valid_object_id
         if valid_token is None:
             valid_token = valid_write_token
+        if make_digest is None:
+            make_digest = get_digest
 
         # Assign.
         self.redis = redis_client
         self.get_object_id = get_oid
-        self.get_token = get_token_
+        self.get_tokens = get_tokens_
         self.global_write_token = global_token
         self.valid_object_id = valid_oid
         self.valid_write_token = valid_token
+        self.digest = digest
+        self.prefix = prefix
+        self.debug = debug
+        self.make_digest = make_digest
+        self.pending = []
 
 
-def get_cache_key_generator(request=None, generator_cls=None, get_redis=None):
+def get_cache_key_generator(request=None, generator_cls=None, get_redis=None,
+        get_prefetcher=None):
     """Return an instance of ``CacheKeyGenerator`` configured with a redis
-      client and the right cache duration.
+      client and the right cache duration. Digest keys are configured using
+      the ``alkey.digest``, ``alkey.digest.prefix`` and ``alkey.digest.debug``
+      settings::
+
+          >>> from mock import Mock
+          >>> mock_request = Mock()
+          >>> mock_request.environ = {}
+          >>> mock_request.registry.settings = {'alkey.digest': 'true',
+          ...         'alkey.digest.prefix': 'myapp:'}
+          >>> mock_generator_cls = Mock()
+          >>> generator = get_cache_key_generator(mock_request,
+          ...         generator_cls=mock_generator_cls,
+          ...         get_redis=lambda request: 'redis')
+          >>> mock_generator_cls.assert_called_with('redis', digest=True,
+          ...         prefix=u'myapp:', debug=False)
+
+      If the request has a token prefetcher (see ``alkey.prefetch``), the
+      tokens are read through it::
+
+          >>> mock_prefetcher = Mock()
+          >>> generator = get_cache_key_generator(mock_request,
+          ...         generator_cls=mock_generator_cls,
+          ...         get_redis=lambda request: 'redis',
+          ...         get_prefetcher=lambda request: mock_prefetcher)
+          >>> kwargs = mock_generator_cls.call_args[1]
+          >>> kwargs['get_tokens_'] == mock_prefetcher.get_tokens
+          True
+
     """
 
     # Compose.
@@ -182,27 +502,63 @@ def get_cache_key_generator(request=None, generator_cls=None, get_redis=None):
         generator_cls = CacheKeyGenerator
     if get_redis is None:
         get_redis = get_redis_client
+    if get_prefetcher is None:
+        # Imported here, as the prefetcher uses ``get_tokens``.
+        from .prefetch import get_token_prefetcher as get_prefetcher
+
+    # Unpack.
+    settings = {} if request is None else request.registry.settings
 
     # Instantiate and return the cache key generator.
-    return generator_cls(get_redis(request))
+    kwargs = get_generator_kwargs(settings)
+    prefetcher = get_prefetcher(request)
+    if prefetcher is not None:
+        kwargs['get_tokens_'] = prefetcher.get_tokens
+    return generator_cls(get_redis(request), **kwargs)
+
+def get_generator_kwargs(settings):
+    """Return the ``CacheKeyGenerator`` keyword arguments configured in the
+      ``settings``::
 
+          >>> get_generator_kwargs({})
+          {}
+          >>> sorted(get_generator_kwargs({'alkey.digest': 'true'}).items())
+          [('debug', False), ('digest', True), ('prefix', u'')]
 
-def get_cache_manager(request, namespaces=None, parse=None, manager_cls=None):
-    """Return a configured beaker cache manager."""
+    """
+
+    kwargs = {}
+    if as_bool(settings.get('alkey.digest', False)):
+        kwargs['digest'] = True
+        kwargs['prefix'] = unicode(settings.get('alkey.digest.prefix', u''))
+        kwargs['debug'] = as_bool(settings.get('alkey.digest.debug', False))
+    return kwargs
+
+
+def get_cache_manager(request, namespaces=None, parse=None, manager_cls=None,
+        configure=None):
+    """Return a configured beaker cache manager. If a ``serializer`` or
+      ``compression`` is configured, the cached values are stored using
+      ``alkey.serializers.SerializingNamespaceManager``. Beaker is imported
+      on first use.
+    """
 
     # Compose.
     if namespaces is None:
         namespaces = CACHE_INI_NAMESPACES
     if parse is None:
-        parse = parse_cache_config_options
+        from beaker.util import parse_cache_config_options as parse
     if manager_cls is None:
-        manager_cls = CacheManager
+        from beaker.cache import CacheManager as manager_cls
+    if configure is None:
+        from .serializers import use_serializers as configure
 
     # Unpack.
     settings = request.registry.settings
 
     # For each of the namespaces provided, if they exist then patch their
-    # values into the cache_opts.
+    # values into the cache_opts, under the ``cache.`` prefix that ``parse``
+    # expects.
     cache_opts = {}
     for prefix in namespaces:
         for key in settings.keys():
@@ -213,9 +569,9 @@ def get_cache_manager(request, namespaces=None, parse=None, manager_cls=None):
                     value = value.strip()
                 except AttributeError:
                     pass
-                cache_opts[name] = value
+                cache_opts['cache.{0}'.format(name)] = value
 
     # Instantiate and return the cache manager.
-    cache_manager = manager_cls(**parse(cache_opts))
+    cache_manager = manager_cls(**configure(parse(cache_opts)))
     return cache_manager
 
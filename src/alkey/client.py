@@ -2,6 +2,9 @@
 
 """Provides ``get_redis_client``, a redis client factory that can be used
   directly, or in contect of a Pyramid application as a request method.
+
+  ``pyramid_redis`` is imported when the first client is created, so that
+  importing ``alkey`` doesn't pull in Pyramid.
 """
 
 __all__ = [
@@ -12,22 +15,235 @@ __all__ = [
 import logging
 logger = logging.getLogger(__name__)
 
-from pyramid_redis import DEFAULT_SETTINGS
-from pyramid_redis.hooks import RedisFactory
+from .buckets import get_bucketed_client
+from .cluster import get_cluster_client
+from .expiry import get_expiring_client
+from .hosttable import HostTokenRedis
+from .hosttable import get_host_table
+from .popularity import PopularityRedis
+from .popularity import get_popularity_tracker
+from .popularity import has_local_cache
+from .replicas import ReplicaRouter
+from .replicas import get_replica_set
+from .replicas import is_pinned
+from .sharding import get_sharded_client
+from .tracking import TrackingRedis
+from .tracking import get_token_tracker
+from .utils import as_bool
 
 class GetRedisClient(object):
+    """Return a redis client configured from the request or default settings.
+
+      If ``alkey.cluster`` is set, returns a (shared) Redis Cluster client::
+
+          >>> from mock import Mock
+          >>> mock_get_cluster = Mock()
+          >>> mock_get_cluster.return_value = '<cluster client>'
+          >>> get_client = GetRedisClient(factory=Mock(),
+          ...         settings={'alkey.cluster': 'true'},
+          ...         get_cluster=mock_get_cluster)
+          >>> get_client(), get_client()
+          ('<cluster client>', '<cluster client>')
+          >>> mock_get_cluster.call_count
+          1
+
+      If ``alkey.shards`` is set, returns a (shared) client that shards keys
+      across the standalone nodes listed::
+
+          >>> mock_get_sharded = Mock()
+          >>> mock_get_sharded.return_value = '<sharded client>'
+          >>> get_client = GetRedisClient(factory=Mock(),
+          ...         settings={'alkey.shards': 'redis://a redis://b'},
+          ...         get_sharded=mock_get_sharded)
+          >>> get_client()
+          '<sharded client>'
+
+      If ``alkey.replicas`` is set, wraps the primary client, so that token reads
+      are sent to the replicas (unless the request has been pinned to the
+      primary)::
+
+          >>> mock_factory = Mock()
+          >>> mock_factory.return_value = '<primary>'
+          >>> mock_get_replicas = Mock()
+          >>> get_client = GetRedisClient(factory=mock_factory,
+          ...         settings={'alkey.replicas': 'redis://a'},
+          ...         get_replicas=mock_get_replicas)
+          >>> client = get_client()
+          >>> client.primary, client.replica_set is mock_get_replicas.return_value
+          ('<primary>', True)
+
+      If ``alkey.tracking`` is set, serves hot tokens from a local map that's
+      kept coherent by tracking the primary::
+
+          >>> mock_get_tracker = Mock()
+          >>> get_client = GetRedisClient(factory=mock_factory,
+          ...         settings={'alkey.tracking': 'true'},
+          ...         get_tracker=mock_get_tracker)
+          >>> client = get_client()
+          >>> client.inner, client.tracker is mock_get_tracker.return_value
+          ('<primary>', True)
+          >>> mock_get_tracker.assert_called_with('<primary>', {'alkey.tracking': 'true'})
+
+      If ``alkey.host_table`` is set, serves hot tokens from a table that's
+      shared by the processes on the host instead::
+
+          >>> mock_get_host_table = Mock()
+          >>> settings = {'alkey.host_table': '/dev/shm/alkey.tokens',
+          ...         'alkey.tracking': 'true'}
+          >>> get_client = GetRedisClient(factory=mock_factory,
+          ...         settings=settings, get_host_table=mock_get_host_table)
+          >>> client = get_client()
+          >>> client.inner, client.listener is mock_get_host_table.return_value
+          ('<primary>', True)
+
+      If ``alkey.buckets`` is set, wraps the client so that row tokens are
+      stored in per table hashes. Reads of the hashes aren't routed to
+      replicas or tracked, so tracking (and the host table) is skipped::
+
+          >>> mock_get_bucketed = Mock()
+          >>> mock_get_bucketed.return_value = '<bucketed client>'
+          >>> get_client = GetRedisClient(factory=mock_factory,
+          ...         settings={'alkey.buckets': 'true', 'alkey.tracking': 'true'},
+          ...         get_tracker=mock_get_tracker, get_bucketed=mock_get_bucketed)
+          >>> get_client()
+          '<bucketed client>'
+          >>> mock_get_bucketed.call_args[0][0]
+          '<primary>'
+
+      If ``alkey.sliding_ttl`` is set, wraps the client, so tokens are stored
+      with a short TTL that reads extend. With ``alkey.replicas``, the replica
+      router is wrapped, so the reads still go to the replicas, and the
+      expiries are sent to the primary. Extending a token's expiry invalidates
+      any local copies of it, so this is skipped when tokens are cached
+      locally (or bucketed)::
+
+          >>> mock_get_expiring = Mock()
+          >>> mock_get_expiring.return_value = '<expiring client>'
+          >>> get_client = GetRedisClient(factory=mock_factory,
+          ...         settings={'alkey.sliding_ttl': 'true',
+          ...                   'alkey.replicas': 'redis://a'},
+          ...         get_replicas=mock_get_replicas,
+          ...         get_expiring=mock_get_expiring)
+          >>> get_client()
+          '<expiring client>'
+          >>> args, kwargs = mock_get_expiring.call_args
+          >>> args[0].primary, kwargs['primary']
+          ('<primary>', '<primary>')
+          >>> get_client = GetRedisClient(factory=mock_factory,
+          ...         settings={'alkey.sliding_ttl': 'true',
+          ...                   'alkey.tracking': 'true'},
+          ...         get_tracker=mock_get_tracker,
+          ...         get_expiring=mock_get_expiring)
+          >>> get_client().inner
+          '<primary>'
+
+      If ``alkey.popularity`` is set, samples the token reads so the most
+      popular tokens can be warmed up into the local token cache (so this is
+      skipped if there isn't one)::
+
+          >>> mock_get_popularity = Mock()
+          >>> get_client = GetRedisClient(factory=mock_factory,
+          ...         settings={'alkey.popularity': 'true',
+          ...                   'alkey.tracking': 'true'},
+          ...         get_tracker=mock_get_tracker,
+          ...         get_popularity=mock_get_popularity)
+          >>> client = get_client()
+          >>> client.popularity is mock_get_popularity.return_value
+          True
+          >>> get_client = GetRedisClient(factory=mock_factory,
+          ...         settings={'alkey.popularity': 'true'},
+          ...         get_popularity=mock_get_popularity)
+          >>> get_client()
+          '<primary>'
+
+    """
+
     def __init__(self, **kwargs):
-        self.factory = kwargs.get('factory', RedisFactory())
-        self.settings = kwargs.get('settings', DEFAULT_SETTINGS)
+        self.factory = kwargs.get('factory', None)
+        self.settings = kwargs.get('settings', None)
+        self.get_cluster = kwargs.get('get_cluster', get_cluster_client)
+        self.get_sharded = kwargs.get('get_sharded', get_sharded_client)
+        self.get_replicas = kwargs.get('get_replicas', get_replica_set)
+        self.router_cls = kwargs.get('router_cls', ReplicaRouter)
+        self.get_tracker = kwargs.get('get_tracker', get_token_tracker)
+        self.tracking_cls = kwargs.get('tracking_cls', TrackingRedis)
+        self.get_host_table = kwargs.get('get_host_table', get_host_table)
+        self.host_table_cls = kwargs.get('host_table_cls', HostTokenRedis)
+        self.get_bucketed = kwargs.get('get_bucketed', get_bucketed_client)
+        self.get_expiring = kwargs.get('get_expiring', get_expiring_client)
+        self.get_popularity = kwargs.get('get_popularity', get_popularity_tracker)
+        self.popularity_cls = kwargs.get('popularity_cls', PopularityRedis)
+        self.shared_clients = {}
+
+    def get_shared(self, name, factory, settings):
+        """Cluster and sharded clients manage their own per node connection
+          pools, so instantiate them once and share them.
+        """
+
+        if name not in self.shared_clients:
+            self.shared_clients[name] = factory(settings)
+        return self.shared_clients[name]
+
+    def load_defaults(self):
+        """Import the default ``pyramid_redis`` factory and settings."""
+
+        if self.factory is None:
+            from pyramid_redis.hooks import RedisFactory
+            self.factory = RedisFactory()
+        if self.settings is None:
+            from pyramid_redis import DEFAULT_SETTINGS
+            self.settings = DEFAULT_SETTINGS
 
     def __call__(self, request=None):
+        self.load_defaults()
         if request is None:
             registry = None
             settings = self.settings
         else:
             registry = request.registry
             settings = registry.settings
-        return self.factory(settings, registry=registry)
+        buckets = as_bool(settings.get('alkey.buckets', False))
+        cached = (settings.get('alkey.host_table', None) or
+                as_bool(settings.get('alkey.tracking', False)))
+        sliding = (as_bool(settings.get('alkey.sliding_ttl', False)) and
+                not buckets and not cached)
+        primary = None
+        if as_bool(settings.get('alkey.cluster', False)):
+            client = self.get_shared('cluster', self.get_cluster, settings)
+        elif settings.get('alkey.shards', None):
+            client = self.get_shared('shards', self.get_sharded, settings)
+        else:
+            primary = client = self.factory(settings, registry=registry)
+            if settings.get('alkey.replicas', None):
+                replica_set = self.get_shared('replicas', self.get_replicas, settings)
+                pinned = lambda: is_pinned(request)
+                client = self.router_cls(client, replica_set, is_pinned=pinned)
+                # Replicas can't extend the expiry of the tokens they serve.
+                if sliding:
+                    client = self.get_expiring(client, settings, primary=primary)
+            elif sliding:
+                client = self.get_expiring(client, settings)
+            if settings.get('alkey.host_table', None) and not buckets:
+                get_listener = lambda settings: self.get_host_table(primary,
+                        settings)
+                listener = self.get_shared('host_table', get_listener, settings)
+                client = self.host_table_cls(client, listener)
+            elif as_bool(settings.get('alkey.tracking', False)) and not buckets:
+                get_tracker = lambda settings: self.get_tracker(primary, settings)
+                tracker = self.get_shared('tracking', get_tracker, settings)
+                pinned = lambda: is_pinned(request)
+                client = self.tracking_cls(client, tracker, is_pinned=pinned)
+        base = client if primary is None else primary
+        if sliding and primary is None:
+            client = self.get_expiring(client, settings)
+        if buckets:
+            client = self.get_bucketed(client, settings)
+        if (as_bool(settings.get('alkey.popularity', False)) and
+                has_local_cache(settings)):
+            get_popularity = lambda settings: self.get_popularity(base, settings)
+            popularity = self.get_shared('popularity', get_popularity, settings)
+            client = self.popularity_cls(client, popularity)
+        return client
 
 
 get_redis_client = GetRedisClient()
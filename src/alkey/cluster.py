@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+"""Provides the slot arithmetic needed to run against `Redis Cluster
+  <http://redis.io/topics/cluster-spec>`_, i.e.: ``key_slot`` to find the
+  slot a key hashes to (honouring ``{hash tags}``), ``group_by_slot`` and
+  ``mget_by_slot`` to batch multi key reads without crossing slots and
+  ``is_cluster`` to tell whether a client is a cluster client.
+
+  Cluster clients are provided by the optional `redis-py-cluster
+  <https://github.com/Grokzen/redis-py-cluster>`_ package.
+"""
+
+__all__ = [
+    'RedisCluster',
+    'get_cluster_client',
+    'get_hash_key',
+    'group_by_slot',
+    'hash_tag',
+    'is_cluster',
+    'is_distributed',
+    'key_slot',
+    'mget_by_slot',
+    'parse_startup_nodes',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import urlparse
+
+try:
+    from rediscluster import RedisCluster
+except ImportError: #pragma: no cover
+    RedisCluster = None
+
+# The number of hash slots in a Redis Cluster.
+CLUSTER_SLOTS = 16384
+
+def _make_crc16_table(poly=0x1021):
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xffff)
+    return table
+
+CRC16_TABLE = _make_crc16_table()
+
+def crc16(data):
+    """Return the CRC16 (XMODEM) checksum Redis Cluster uses to hash keys::
+
+          >>> crc16('123456789')
+          12739
+
+    """
+
+    crc = 0
+    for char in data:
+        crc = ((crc << 8) & 0xffff) ^ CRC16_TABLE[((crc >> 8) ^ ord(char)) & 0xff]
+    return crc
+
+def hash_tag(value):
+    """Wrap ``value`` in a hash tag, so all keys that contain it are stored
+      in the same slot::
+
+          >>> hash_tag(u'1234')
+          u'{1234}'
+
+    """
+
+    return u'{{{0}}}'.format(value)
+
+def get_hash_key(key):
+    """Return the part of ``key`` that's hashed to place it, i.e.: the first
+      non empty ``{hash tag}`` if there is one, or otherwise the whole key::
+
+          >>> get_hash_key(u'{user1000}.following')
+          'user1000'
+          >>> get_hash_key('foo{}{bar}')
+          'foo{}{bar}'
+
+    """
+
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    start = key.find('{')
+    if start > -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+def key_slot(key):
+    """Return the cluster slot for ``key``::
+
+          >>> key_slot('foo')
+          12182
+
+      Only the first non empty ``{hash tag}`` is hashed, if there is one::
+
+          >>> key_slot(u'{user1000}.following') == key_slot('{user1000}.followers')
+          True
+          >>> key_slot('foo{}{bar}') == key_slot('foo{}{bar}x')
+          False
+
+    """
+
+    return crc16(get_hash_key(key)) % CLUSTER_SLOTS
+
+def group_by_slot(keys, get_slot=None):
+    """Group ``keys`` by slot, returning a list of ``[(index, key), ...]``
+      groups that preserve the original position of each key::
+
+          >>> group_by_slot(['{a}1', 'b', '{a}2'])
+          [[(0, '{a}1'), (2, '{a}2')], [(1, 'b')]]
+
+    """
+
+    # Compose.
+    if get_slot is None:
+        get_slot = key_slot
+
+    groups = {}
+    order = []
+    for index, key in enumerate(keys):
+        slot = get_slot(key)
+        if slot not in groups:
+            groups[slot] = []
+            order.append(slot)
+        groups[slot].append((index, key))
+    return [groups[item] for item in order]
+
+def mget_by_slot(redis_client, keys, group=None):
+    """Read ``keys`` with one ``MGET`` per slot, sent in a single pipeline.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> mock_pipeline = Mock()
+          >>> mock_client = Mock()
+          >>> mock_client.pipeline.return_value = mock_pipeline
+          >>> mock_pipeline.execute.return_value = [['1', None], ['2']]
+
+      Returns the values in the same order as the keys::
+
+          >>> mget_by_slot(mock_client, ['{a}1', 'b', '{a}2'])
+          ['1', '2', None]
+          >>> mock_pipeline.execute_command.assert_any_call('MGET', '{a}1', '{a}2')
+          >>> mock_pipeline.execute_command.assert_any_call('MGET', 'b')
+
+    """
+
+    # Compose.
+    if group is None:
+        group = group_by_slot
+
+    groups = group(keys)
+    pipeline = redis_client.pipeline(transaction=False)
+    for items in groups:
+        pipeline.execute_command('MGET', *[key for _, key in items])
+    values = [None] * len(keys)
+    for items, results in zip(groups, pipeline.execute()):
+        for (index, _), value in zip(items, results):
+            values[index] = value
+    return values
+
+def is_cluster(redis_client):
+    """Is ``redis_client`` a cluster client (or cluster pipeline), or a client
+      that wraps one?
+
+          >>> is_cluster(object())
+          False
+
+    """
+
+    while hasattr(redis_client, 'inner'):
+        redis_client = redis_client.inner
+    return RedisCluster is not None and isinstance(redis_client, RedisCluster)
+
+def is_distributed(redis_client):
+    """Does ``redis_client`` (or the client it wraps) send commands to more
+      than one node, i.e.: is it a cluster client or does it declare that it
+      ``fans_out``, like a ``ShardedRedis`` client?
+
+          >>> is_distributed(object())
+          False
+          >>> is_distributed(type('Sharded', (object,), {'fans_out': True})())
+          True
+
+    """
+
+    if is_cluster(redis_client):
+        return True
+    while hasattr(redis_client, 'inner'):
+        redis_client = redis_client.inner
+    return bool(getattr(redis_client, 'fans_out', False))
+
+def parse_startup_nodes(value, parse_url=None):
+    """Parse a whitespace separated list of ``redis://`` urls or ``host:port``
+      pairs into cluster startup nodes::
+
+          >>> nodes = parse_startup_nodes('redis://a:7000 b:7001')
+          >>> nodes == [{'host': 'a', 'port': 7000}, {'host': 'b', 'port': 7001}]
+          True
+
+    """
+
+    # Compose.
+    if parse_url is None:
+        parse_url = urlparse.urlparse
+
+    nodes = []
+    for item in value.split():
+        if '://' not in item:
+            item = 'redis://{0}'.format(item)
+        o = parse_url(item)
+        nodes.append({'host': o.hostname, 'port': o.port or 6379})
+    return nodes
+
+def get_cluster_client(settings, client_cls=None, parse_nodes=None):
+    """Return a cluster client configured from the ``settings``. The startup
+      nodes are read from ``alkey.cluster.nodes``, falling back on the
+      ``redis.url``::
+
+          >>> from mock import Mock
+          >>> mock_cls = Mock()
+          >>> settings = {'redis.url': 'redis://:secret@a:7000'}
+          >>> client = get_cluster_client(settings, client_cls=mock_cls)
+          >>> kwargs = mock_cls.call_args[1]
+          >>> kwargs['startup_nodes'], kwargs['password']
+          ([{'host': 'a', 'port': 7000}], 'secret')
+
+    """
+
+    # Compose.
+    if client_cls is None:
+        client_cls = RedisCluster
+    if parse_nodes is None:
+        parse_nodes = parse_startup_nodes
+    if client_cls is None: #pragma: no cover
+        raise ImportError('Cluster mode requires the redis-py-cluster package.')
+
+    url = settings.get('redis.url')
+    value = settings.get('alkey.cluster.nodes', url)
+    kwargs = {
+        'startup_nodes': parse_nodes(value),
+        'skip_full_coverage_check': True,
+    }
+    if url:
+        password = urlparse.urlparse(url).password
+        if password:
+            kwargs['password'] = password
+    max_connections = settings.get('redis.max_connections', None)
+    if max_connections is not None:
+        kwargs['max_connections'] = int(max_connections)
+    return client_cls(**kwargs)
@@ -20,3 +20,33 @@ MAX_CACHE_DURATION = 60 * 60 * 24 # secs
 
 # The Redis key prefix of the instance tokens.
 TOKEN_NAMESPACE = 'alkey.cache.TOKENS'
+
+# The Redis key prefix of the hashes row tokens are bucketed into, when
+# using the hashed storage layout.
+BUCKET_NAMESPACE = 'alkey.cache.BUCKETS'
+
+# The ``request.environ`` key used to pin a request's token reads to the
+# primary, once it's written.
+PRIMARY_PIN_KEY = 'alkey.replicas.PINNED'
+
+# Flag the sessions that are flushing, so statements executed by the flush
+# aren't recorded twice.
+FLUSHING_KEY = 'alkey.handle.FLUSHING'
+
+# The ``session.info`` key of the session's id, which (unlike the session's
+# ``hash_key``) is unique across processes.
+SESSION_ID_KEY = 'alkey.handle.SESSION_ID'
+
+# Flag the sessions that are in bulk mode.
+BULK_MODE_KEY = 'alkey.handle.BULK_MODE'
+
+# The key of the Redis stream that changes are recorded to, when the change
+# feed is enabled.
+FEED_KEY = 'alkey.feed.CHANGES'
+
+# The ``request.environ`` key of the request's token prefetcher.
+PREFETCHER_KEY = 'alkey.prefetch.PREFETCHER'
+
+# The key prefix of the Redis hashes and sorted sets that the processes' heat
+# maps of invalidations are merged into.
+HEAT_MAP_KEY = 'alkey.heat'
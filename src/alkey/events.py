@@ -12,19 +12,32 @@ import logging
 logger = logging.getLogger(__name__)
 
 from sqlalchemy import event as sqlalchemy_event
+from sqlalchemy.engine import Engine
 
+from .handle import handle_begin
+from .handle import handle_bulk
 from .handle import handle_commit
+from .handle import handle_execute
 from .handle import handle_flush
+from .handle import handle_flushed
 from .handle import handle_rollback
+from .policy import handle_configured
 
-def bind(session_cls, event=None, commit=None, flush=None, rollback=None):
+def bind(session_cls, event=None, commit=None, flush=None, rollback=None,
+        flushed=None, begin=None, bulk=None, execute=None, engine_cls=None,
+        configured=None, mapper_cls=None):
     """Handle the ``before_flush`` and ``after_commit`` events of the
       ``session_cls`` provided::
 
           >>> from mock import Mock
           >>> mock_event = Mock()
+          >>> mock_event.contains.return_value = False
           >>> bind('session', event=mock_event, commit='handle_commit',
-          ...         flush='handle_flush', rollback='handle_rollback')
+          ...         flush='handle_flush', rollback='handle_rollback',
+          ...         flushed='handle_flushed', begin='handle_begin',
+          ...         bulk='handle_bulk', execute='handle_execute',
+          ...         engine_cls='engine', configured='handle_configured',
+          ...         mapper_cls='mapper')
           >>> mock_event.listen.assert_any_call('session', 'after_commit',
           ...         'handle_commit')
           >>> mock_event.listen.assert_any_call('session', 'before_flush',
@@ -32,6 +45,45 @@ def bind(session_cls, event=None, commit=None, flush=None, rollback=None):
           >>> mock_event.listen.assert_any_call('session', 'after_soft_rollback',
           ...         'handle_rollback')
 
+      Plus the bulk ``query.update()`` and ``query.delete()`` events and the
+      engine's ``after_execute`` event, so that changes made by bulk and Core
+      DML statements are invalidated too::
+
+          >>> mock_event.listen.assert_any_call('session', 'after_flush',
+          ...         'handle_flushed')
+          >>> mock_event.listen.assert_any_call('session', 'after_begin',
+          ...         'handle_begin')
+          >>> mock_event.listen.assert_any_call('session', 'after_bulk_update',
+          ...         'handle_bulk')
+          >>> mock_event.listen.assert_any_call('session', 'after_bulk_delete',
+          ...         'handle_bulk')
+          >>> mock_event.listen.assert_any_call('engine', 'after_execute',
+          ...         'handle_execute')
+
+      And records the ``__alkey_track__`` and ``__alkey_global__`` that each
+      mapped class declares, as its mapper is configured::
+
+          >>> mock_event.listen.assert_any_call('mapper', 'mapper_configured',
+          ...         'handle_configured')
+
+      The engine and mapper listeners are usually registered on the global
+      ``Engine`` and ``Mapper`` classes, so they're only registered once, even
+      if more than one session class is bound::
+
+          >>> mock_event.reset_mock()
+          >>> mock_event.contains.return_value = True
+          >>> bind('other session', event=mock_event, engine_cls='engine',
+          ...         execute='handle_execute', mapper_cls='mapper',
+          ...         configured='handle_configured', commit='handle_commit',
+          ...         flush='handle_flush', rollback='handle_rollback',
+          ...         flushed='handle_flushed', begin='handle_begin',
+          ...         bulk='handle_bulk')
+          >>> [args[0] for args, kwargs in mock_event.listen.call_args_list
+          ...         if args[0] != 'other session']
+          []
+
+      Note that the handlers use the SQLAlchemy 1.3 event signatures.
+
     """
 
     # Compose.
@@ -43,7 +95,29 @@ def bind(session_cls, event=None, commit=None, flush=None, rollback=None):
         flush = handle_flush
     if rollback is None: # pragma: no cover
         rollback = handle_rollback
+    if flushed is None: # pragma: no cover
+        flushed = handle_flushed
+    if begin is None: # pragma: no cover
+        begin = handle_begin
+    if bulk is None: # pragma: no cover
+        bulk = handle_bulk
+    if execute is None: # pragma: no cover
+        execute = handle_execute
+    if engine_cls is None: # pragma: no cover
+        engine_cls = Engine
+    if configured is None: # pragma: no cover
+        configured = handle_configured
+    if mapper_cls is None: # pragma: no cover
+        from sqlalchemy.orm import Mapper as mapper_cls
 
     event.listen(session_cls, 'after_commit', commit)
     event.listen(session_cls, 'before_flush', flush)
     event.listen(session_cls, 'after_soft_rollback', rollback)
+    event.listen(session_cls, 'after_flush', flushed)
+    event.listen(session_cls, 'after_begin', begin)
+    event.listen(session_cls, 'after_bulk_update', bulk)
+    event.listen(session_cls, 'after_bulk_delete', bulk)
+    if not event.contains(engine_cls, 'after_execute', execute):
+        event.listen(engine_cls, 'after_execute', execute)
+    if not event.contains(mapper_cls, 'mapper_configured', configured):
+        event.listen(mapper_cls, 'mapper_configured', configured)
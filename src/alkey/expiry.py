@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``SlidingExpiryRedis``, a redis client that stores tokens with a
+  short ``initial_ttl`` and extends the expiry of the tokens that are read
+  again to ``max_ttl``, e.g.::
+
+      client = SlidingExpiryRedis(redis_client, initial_ttl=3600)
+      client.setex(u'alkey.cache.TOKENS:alkey:users#1234', 86400, token)
+      # SETEX alkey.cache.TOKENS:alkey:users#1234 3600 <token>
+      client.mget([u'alkey.cache.TOKENS:alkey:users#1234'])
+      # MGET alkey.cache.TOKENS:alkey:users#1234
+      # EXPIRE alkey.cache.TOKENS:alkey:users#1234 86400
+
+  The ``EXPIRE`` commands are sent in the same pipeline as the read (and are
+  no-ops for the tokens that are missing), so cold tokens age out after the
+  ``initial_ttl`` and hot tokens stay for as long as they're read at least
+  once every ``max_ttl`` seconds, without an extra round trip.
+
+  When the reads are routed to read replicas (which can't extend a key's
+  expiry), pass the ``primary`` client and the ``EXPIRE`` commands are sent
+  to it in a pipeline of their own.
+
+  A token that expires is simply replaced by a new token when it's next read,
+  i.e.: expiring a token costs a cache miss, never a stale read.
+"""
+
+__all__ = [
+    'SlidingExpiryPipeline',
+    'SlidingExpiryRedis',
+    'get_expiring_client',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import redis
+from redis.exceptions import RedisError
+
+from .constants import MAX_CACHE_DURATION
+from .constants import TOKEN_NAMESPACE
+
+class SlidingExpiryRedis(redis.StrictRedis):
+    """Translate the ``SETEX`` of a token into a ``SETEX`` with the initial
+      TTL and the ``GET`` or ``MGET`` of tokens into the read plus an
+      ``EXPIRE`` for each token, passing everything else through to the
+      ``inner`` client.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> inner = Mock()
+          >>> client = SlidingExpiryRedis(inner, initial_ttl=60, max_ttl=600)
+          >>> key = u'alkey.cache.TOKENS:alkey:users#1'
+
+      Stores tokens with the initial TTL::
+
+          >>> return_value = client.setex(key, 86400, 'token')
+          >>> inner.execute_command.assert_called_with('SETEX', key, 60, 'token')
+
+      Extends the tokens that are read::
+
+          >>> pipeline = inner.pipeline.return_value
+          >>> pipeline.execute.return_value = [['a', None], 1, 0]
+          >>> client.mget([key, u'alkey.cache.TOKENS:alkey:users#2'])
+          ['a', None]
+          >>> pipeline.execute_command.assert_any_call('EXPIRE', key, 600)
+
+      Other keys aren't touched::
+
+          >>> return_value = client.setex('foo', 10, 'bar')
+          >>> inner.execute_command.assert_called_with('SETEX', 'foo', 10, 'bar')
+
+      Given a ``primary``, reads go through the ``inner`` client (e.g.: to a
+      replica) and the expiries to the primary::
+
+          >>> inner = Mock()
+          >>> inner.execute_command.return_value = ['a']
+          >>> primary = Mock()
+          >>> client = SlidingExpiryRedis(inner, initial_ttl=60, max_ttl=600,
+          ...         primary=primary)
+          >>> client.mget([key])
+          ['a']
+          >>> primary.pipeline.return_value.execute_command.assert_called_with(
+          ...         'EXPIRE', key, 600)
+          >>> inner.pipeline.called
+          False
+
+    """
+
+    def __init__(self, inner, initial_ttl=3600, max_ttl=None, namespace=None,
+            primary=None):
+        # Compose.
+        if max_ttl is None:
+            max_ttl = MAX_CACHE_DURATION
+        if namespace is None:
+            namespace = TOKEN_NAMESPACE
+
+        # Assign.
+        self.inner = inner
+        self.initial_ttl = initial_ttl
+        self.max_ttl = max_ttl
+        self.prefix = u'{0}:'.format(namespace)
+        self.primary = primary
+        self.response_callbacks = {}
+        self.connection = None
+
+    def __repr__(self):
+        return '{0}<{1!r}>'.format(type(self).__name__, self.inner)
+
+    def is_token_key(self, key):
+        if isinstance(key, str):
+            key = key.decode('utf-8')
+        return isinstance(key, unicode) and key.startswith(self.prefix)
+
+    def translate(self, args, options):
+        """Return ``(commands, combine)``, where ``commands`` is a list of
+          ``(args, options)`` to send to the inner client and ``combine``
+          reduces their results to the result of the original command.
+        """
+
+        command = args[0].upper()
+        passthrough = ([(args, options)], lambda results: results[0])
+        if command not in ('GET', 'MGET', 'SETEX') or len(args) < 2:
+            return passthrough
+
+        if command == 'SETEX':
+            if not self.is_token_key(args[1]):
+                return passthrough
+            ttl = min(args[2], self.initial_ttl)
+            return [(('SETEX', args[1], ttl, args[3]), options)], passthrough[1]
+
+        commands = [(args, options)]
+        for key in args[1:]:
+            if self.is_token_key(key):
+                commands.append((('EXPIRE', key, self.max_ttl), {}))
+        return commands, passthrough[1]
+
+    def execute_command(self, *args, **options):
+        commands, combine = self.translate(args, options)
+        if len(commands) == 1:
+            args_, options_ = commands[0]
+            return combine([self.inner.execute_command(*args_, **options_)])
+        if self.primary is not None:
+            return self.read_then_extend(commands, combine)
+        pipeline = self.inner.pipeline(transaction=False)
+        for args_, options_ in commands:
+            pipeline.execute_command(*args_, **options_)
+        return combine(pipeline.execute())
+
+    def read_then_extend(self, commands, combine):
+        """Read through the ``inner`` client and then send the ``EXPIRE``
+          commands to the primary. Failing to extend the tokens just means
+          they expire sooner, so errors are logged rather than raised.
+        """
+
+        args, options = commands[0]
+        result = self.inner.execute_command(*args, **options)
+        pipeline = self.primary.pipeline(transaction=False)
+        for args_, options_ in commands[1:]:
+            pipeline.execute_command(*args_, **options_)
+        try:
+            pipeline.execute()
+        except RedisError as err:
+            logger.warn(err, exc_info=True)
+        return combine([result])
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return SlidingExpiryPipeline(self, transaction=transaction,
+                shard_hint=shard_hint)
+
+    def scan_iter(self, match=None, count=None):
+        return self.inner.scan_iter(match=match, count=count)
+
+
+class SlidingExpiryPipeline(SlidingExpiryRedis):
+    """Buffer translated commands and then execute them in one pipeline::
+
+          >>> from mock import Mock
+          >>> inner = Mock()
+          >>> inner_pipeline = inner.pipeline.return_value
+          >>> inner_pipeline.execute.return_value = [True, ['a'], 1]
+          >>> client = SlidingExpiryRedis(inner, initial_ttl=60)
+          >>> key = u'alkey.cache.TOKENS:alkey:users#1'
+          >>> pipeline = client.pipeline(transaction=False)
+          >>> pipeline.setex(key, 86400, 'a').mget([key]) # doctest: +ELLIPSIS
+          SlidingExpiryPipeline<...>
+          >>> pipeline.execute()
+          [True, ['a']]
+          >>> inner_pipeline.execute_command.call_count
+          3
+
+    """
+
+    def __init__(self, expiring, transaction=True, shard_hint=None):
+        self.expiring = expiring
+        self.transaction = transaction
+        self.shard_hint = shard_hint
+        self.command_stack = []
+        self.response_callbacks = {}
+        self.connection = None
+
+    def __repr__(self):
+        return '{0}<{1!r}>'.format(type(self).__name__, self.expiring)
+
+    def execute_command(self, *args, **options):
+        self.command_stack.append(self.expiring.translate(args, options))
+        return self
+
+    def execute(self):
+        """Execute the buffered commands, returning their results in order."""
+
+        translations, self.command_stack = self.command_stack, []
+        pipeline = self.expiring.inner.pipeline(transaction=self.transaction,
+                shard_hint=self.shard_hint)
+        for commands, combine in translations:
+            for args, options in commands:
+                pipeline.execute_command(*args, **options)
+        results = iter(pipeline.execute())
+        combined = []
+        for commands, combine in translations:
+            combined.append(combine([next(results) for _ in commands]))
+        return combined
+
+    def reset(self):
+        self.command_stack = []
+
+
+def get_expiring_client(redis_client, settings, primary=None, expiring_cls=None):
+    """Return a ``SlidingExpiryRedis`` client wrapping ``redis_client``,
+      configured using ``alkey.sliding_ttl.initial`` and
+      ``alkey.sliding_ttl.max``. If the ``redis_client`` routes reads to
+      replicas, pass the ``primary`` to send the expiries to::
+
+          >>> from mock import Mock
+          >>> mock_cls = Mock()
+          >>> settings = {'alkey.sliding_ttl.initial': '600'}
+          >>> client = get_expiring_client('<client>', settings,
+          ...         expiring_cls=mock_cls)
+          >>> mock_cls.assert_called_with('<client>', initial_ttl=600,
+          ...         max_ttl=86400, primary=None)
+
+    """
+
+    # Compose.
+    if expiring_cls is None:
+        expiring_cls = SlidingExpiryRedis
+
+    initial_ttl = int(settings.get('alkey.sliding_ttl.initial', 3600))
+    max_ttl = int(settings.get('alkey.sliding_ttl.max', MAX_CACHE_DURATION))
+    return expiring_cls(redis_client, initial_ttl=initial_ttl, max_ttl=max_ttl,
+            primary=primary)
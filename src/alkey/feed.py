@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``ChangeFeed``, which records the oids and tables that each commit
+  invalidates to a capped Redis stream (in the same pipeline as the token
+  updates), and ``FeedReader``, a consumer group reader that lets other
+  services, e.g.: a CDN purger or search indexer, consume the changes
+  incrementally, e.g.::
+
+      reader = FeedReader(redis_client, 'search-indexer', 'worker-1')
+      changes = reader.read()
+      for change in changes:
+          reindex(change.oids)
+      reader.ack([change.id for change in changes])
+
+  Or, acknowledging each batch once it's been handled::
+
+      reader.consume(lambda change: reindex(change.oids))
+
+  The stream is capped, so a consumer that falls too far behind (or is down
+  for too long) can miss changes. Use ``reader.has_gap()`` to find out.
+
+  The feed requires Redis 5+ and is enabled by setting ``alkey.feed = true``.
+"""
+
+__all__ = [
+    'Change',
+    'ChangeFeed',
+    'FeedReader',
+    'get_change_feed',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+from collections import namedtuple
+
+from redis.exceptions import ResponseError
+
+from .constants import FEED_KEY
+from .utils import as_bool
+
+# ``oids`` and ``tables`` are lists of unicode strings and ``bumps_global``
+# is whether the commit bumped the global write token (which it did, unless
+# the tracking policy said otherwise).
+Change = namedtuple('Change', 'id token oids tables bumps_global')
+Change.__new__.__defaults__ = (True,)
+
+def decode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+def parse_entry_id(entry_id):
+    """Parse a stream entry id into a comparable tuple::
+
+          >>> parse_entry_id('1526919030474-55') > parse_entry_id(u'1526919030474-9')
+          True
+
+    """
+
+    return tuple(int(item) for item in decode(entry_id).split(u'-'))
+
+
+class ChangeFeed(object):
+    """Record the changes to a stream, capped at (approximately) ``maxlen``
+      entries::
+
+          >>> from mock import Mock
+          >>> pipeline = Mock()
+          >>> feed = ChangeFeed(maxlen=100)
+          >>> feed.record(pipeline, ['alkey:users#2', 'alkey:users#1'],
+          ...         ['users'], 'token')
+          >>> pipeline.xadd.assert_called_with('alkey.feed.CHANGES',
+          ...         {'token': 'token', 'oids': 'alkey:users#1 alkey:users#2',
+          ...          'tables': 'users', 'global': '1'}, maxlen=100,
+          ...         approximate=True)
+
+      Including whether the commit bumped the global write token::
+
+          >>> feed.record(pipeline, ['alkey:counters#1'], ['counters'],
+          ...         'token', bumps_global=False)
+          >>> pipeline.xadd.call_args[0][1]['global']
+          '0'
+
+    """
+
+    def __init__(self, key=None, maxlen=10000):
+        # Compose.
+        if key is None:
+            key = FEED_KEY
+
+        # Assign.
+        self.key = key
+        self.maxlen = maxlen
+
+    def record(self, pipeline, oids, tablenames, value, bumps_global=True):
+        """Queue the ``XADD`` of a record of a commit on the ``pipeline``. The
+          oids and tablenames are space separated.
+        """
+
+        fields = {
+            'token': value,
+            'oids': u' '.join(sorted(decode(item) for item in oids)),
+            'tables': u' '.join(sorted(decode(item) for item in tablenames)),
+            'global': '1' if bumps_global else '0',
+        }
+        pipeline.xadd(self.key, fields, maxlen=self.maxlen, approximate=True)
+
+
+class FeedReader(object):
+    """Read the changes as the ``consumer`` in a consumer ``group``.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> mock_client = Mock()
+          >>> fields = {'token': '1', 'oids': 'alkey:users#1', 'tables': 'users'}
+          >>> mock_client.xreadgroup.side_effect = [
+          ...     [['alkey.feed.CHANGES', [('1-0', fields)]]],
+          ...     [['alkey.feed.CHANGES', []]],
+          ...     [['alkey.feed.CHANGES', [('2-0', fields)]]],
+          ... ]
+          >>> reader = FeedReader(mock_client, 'indexer', 'worker-1')
+
+      First reads the changes that were delivered but not acknowledged, e.g.:
+      before a restart::
+
+          >>> reader.read() # doctest: +NORMALIZE_WHITESPACE
+          [Change(id=u'1-0', token=u'1', oids=[u'alkey:users#1'],
+                  tables=[u'users'], bumps_global=True)]
+          >>> mock_client.xreadgroup.call_args[0][2]
+          {'alkey.feed.CHANGES': '0'}
+
+      Then new ones::
+
+          >>> [change.id for change in reader.read()]
+          []
+          >>> [change.id for change in reader.read()]
+          [u'2-0']
+          >>> mock_client.xreadgroup.call_args[0][2]
+          {'alkey.feed.CHANGES': '>'}
+
+      Detects when the stream has been trimmed past the changes the group has
+      read, i.e.: when changes have been lost::
+
+          >>> mock_client.xinfo_stream.return_value = {
+          ...         'first-entry': ('5-0', fields)}
+          >>> mock_client.xinfo_groups.return_value = [
+          ...         {'name': 'indexer', 'last-delivered-id': '2-0'}]
+          >>> reader.has_gap(), reader.has_gap()
+          (True, False)
+          >>> mock_client.xinfo_stream.return_value = {
+          ...         'first-entry': ('1-0', fields)}
+          >>> reader.has_gap()
+          False
+
+      Including when the pending changes were trimmed before they were
+      acknowledged, in which case they're returned without any oids (so that
+      they can be acknowledged)::
+
+          >>> reader.cursor = '0'
+          >>> mock_client.xreadgroup.side_effect = [
+          ...     [['alkey.feed.CHANGES', [('3-0', {})]]]]
+          >>> reader.read() # doctest: +NORMALIZE_WHITESPACE
+          [Change(id=u'3-0', token=None, oids=[], tables=[],
+                  bumps_global=False)]
+          >>> reader.has_gap(), reader.has_gap()
+          (True, False)
+
+    """
+
+    def __init__(self, redis_client, group, consumer, key=None, start='$',
+            count=100, block=5000):
+        """``start`` is the id the group starts reading from when it's created
+          (``$`` for new changes or ``0`` for all of the changes in the
+          stream) and ``block`` the number of milliseconds to wait for new
+          changes.
+        """
+
+        # Compose.
+        if key is None:
+            key = FEED_KEY
+
+        # Assign.
+        self.redis = redis_client
+        self.group = group
+        self.consumer = consumer
+        self.key = key
+        self.start = start
+        self.count = count
+        self.block = block
+        self.cursor = '0'
+        self.created = False
+        self.trimmed = False
+        self.gap = None
+
+    def ensure_group(self):
+        """Create the consumer group (and the stream) if need be."""
+
+        if self.created:
+            return
+        try:
+            self.redis.xgroup_create(self.key, self.group, id=self.start,
+                    mkstream=True)
+        except ResponseError as err:
+            if 'BUSYGROUP' not in unicode(err):
+                raise
+        self.created = True
+
+    def read(self):
+        """Return a list of up to ``count`` changes."""
+
+        self.ensure_group()
+        block = None if self.cursor == '0' else self.block
+        response = self.redis.xreadgroup(self.group, self.consumer,
+                {self.key: self.cursor}, count=self.count, block=block)
+        entries = response[0][1] if response else []
+        if self.cursor == '0' and not entries:
+            # Caught up with the pending changes, so read new ones.
+            self.cursor = '>'
+        changes = []
+        for entry_id, fields in entries:
+            if not fields:
+                # A pending change that was trimmed before it was handled.
+                self.trimmed = True
+                changes.append(Change(decode(entry_id), None, [], [], False))
+                continue
+            fields = dict((decode(k), decode(v)) for k, v in fields.items())
+            oids = fields.get(u'oids', u'').split()
+            tables = fields.get(u'tables', u'').split()
+            # Entries recorded before the flag was added bumped the token.
+            bumps_global = fields.get(u'global', u'1') != u'0'
+            changes.append(Change(decode(entry_id), fields.get(u'token'), oids,
+                    tables, bumps_global))
+        return changes
+
+    def has_gap(self):
+        """Have changes been trimmed from the stream before the group read
+          them, i.e.: is the stream's first entry newer than the last one
+          delivered to the group? Note that this errs on the side of caution,
+          as the ids don't say whether there were entries between the two.
+        """
+
+        self.ensure_group()
+        trimmed, self.trimmed = self.trimmed, False
+        if trimmed:
+            return True
+        first_entry = self.redis.xinfo_stream(self.key).get('first-entry')
+        if not first_entry:
+            return False
+        for item in self.redis.xinfo_groups(self.key):
+            if decode(item['name']) == self.group:
+                gap = (parse_entry_id(first_entry[0]),
+                        parse_entry_id(item['last-delivered-id']))
+                if gap[0] <= gap[1] or gap == self.gap:
+                    return False
+                # Only report each gap once.
+                self.gap = gap
+                return True
+        return False
+
+    def ack(self, ids):
+        """Acknowledge the changes with ``ids`` as handled."""
+
+        if ids:
+            self.redis.xack(self.key, self.group, *ids)
+
+    def consume(self, handler, should_stop=None):
+        """Call ``handler`` with each change, acknowledging each batch once
+          it's been handled, until ``should_stop()`` returns ``True``.
+        """
+
+        # Compose.
+        if should_stop is None: #pragma: no cover
+            should_stop = lambda: False
+
+        while not should_stop():
+            changes = self.read()
+            for change in changes:
+                handler(change)
+            self.ack([change.id for change in changes])
+
+
+def get_change_feed(settings, feed_cls=None):
+    """Return a ``ChangeFeed`` if ``alkey.feed`` is set, capped at
+      ``alkey.feed.maxlen`` entries::
+
+          >>> get_change_feed({})
+          >>> feed = get_change_feed({'alkey.feed': 'true',
+          ...         'alkey.feed.maxlen': '500'})
+          >>> feed.key, feed.maxlen
+          ('alkey.feed.CHANGES', 500)
+
+    """
+
+    # Compose.
+    if feed_cls is None:
+        feed_cls = ChangeFeed
+
+    if not as_bool(settings.get('alkey.feed', False)):
+        return None
+    maxlen = int(settings.get('alkey.feed.maxlen', 10000))
+    return feed_cls(key=settings.get('alkey.feed.key', None), maxlen=maxlen)
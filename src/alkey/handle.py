@@ -5,8 +5,16 @@
 """
 
 __all__ = [
+    'bulk_mode',
+    'get_bulk_oids',
+    'get_changed_key',
+    'get_session_id',
+    'handle_begin',
+    'handle_bulk',
     'handle_commit',
+    'handle_execute',
     'handle_flush',
+    'handle_flushed',
     'invalidate_tokens',
     'record_changed',
 ]
@@ -14,39 +22,222 @@ __all__ = [
 import logging
 logger = logging.getLogger(__name__)
 
-try: #pragma: no cover
-    from pyramid.threadlocal import get_current_request
-except ImportError: #pragma: no cover
-    get_current_request = lambda: None
+import uuid
+import weakref
+from contextlib import contextmanager
+
+from sqlalchemy.sql.expression import Insert
+from sqlalchemy.sql.expression import UpdateBase
 
 from .cache import set_token
 from .client import get_redis_client
+from .cluster import hash_tag
+from .cluster import is_cluster
+from .cluster import is_distributed
+from .constants import BULK_MODE_KEY
 from .constants import CHANGED_KEY
 from .constants import CHANGED_SET_EXPIRES
+from .constants import FLUSHING_KEY
 from .constants import GLOBAL_WRITE_TOKEN
+from .constants import SESSION_ID_KEY
+from .policy import default_policy
+from .replicas import pin_to_primary
+from .utils import encode_identity
 from .utils import get_object_id
+from .utils import get_parent_oids
+from .utils import get_relation_tables
 from .utils import get_single_relations
 from .utils import get_stamp
 from .utils import get_table_id
 from .utils import resiliently_call
 from .utils import unpack_object_id
 
-def handle_commit(session, get_redis=None, get_request=None, invalidate=None, call=None):
-    """Gets a redis client and call the invalidate function with it.
+# Caches the Pyramid (or fallback) ``get_current_request`` function.
+request_getters = []
+
+def get_current_request():
+    """Return the current Pyramid request, or ``None`` if Pyramid isn't
+      installed. Pyramid is imported on first use, rather than when ``alkey``
+      is imported::
+
+          >>> get_current_request()
+
+    """
+
+    if not request_getters:
+        try:
+            from pyramid.threadlocal import get_current_request as get_request
+        except ImportError: #pragma: no cover
+            get_request = lambda: None
+        request_getters.append(get_request)
+    return request_getters[0]()
+
+def get_session_id(session, key=None, new_id=None):
+    """Return the id that the ``session``'s changed set is keyed on, creating
+      it on first use. Unlike the session's ``hash_key``, which counts up from
+      one in each process, the id is unique across processes, so sessions in
+      different processes never share a changed set::
 
           >>> from mock import Mock
           >>> mock_session = Mock()
-          >>> mock_session.hash_key = 'session id'
+          >>> mock_session.info = {}
+          >>> session_id = get_session_id(mock_session, new_id=lambda: 'abc')
+          >>> session_id, get_session_id(mock_session)
+          ('abc', 'abc')
+
+    """
+
+    # Compose.
+    if key is None:
+        key = SESSION_ID_KEY
+    if new_id is None:
+        new_id = lambda: uuid.uuid4().hex
+
+    if key not in session.info:
+        session.info[key] = new_id()
+    return session.info[key]
+
+# Maps the (pooled dbapi) connections used by session transactions to (weak
+# references to) their sessions, so that statements executed directly on the
+# connection can be recorded against the right changed set. The pooled
+# connection is used as the key because it's shared by the copies of the
+# ``Connection`` that ``execution_options()`` returns.
+session_connections = weakref.WeakKeyDictionary()
+
+@contextmanager
+def bulk_mode(session, max_rows=0, key=None):
+    """Only record the tables touched by the ``session`` (plus, optionally,
+      up to ``max_rows`` rows), rather than every changed row, e.g.::
+
+          with bulk_mode(session):
+              for row in import_rows():
+                  session.add(Thing(**row))
+              session.commit()
+
+      Commits then invalidate the table and global write tokens, without
+      having to store and stamp a token for every row. Note that this means
+      that cache keys generated from the individual rows that aren't recorded
+      are *not* invalidated.
+
+          >>> from mock import Mock
+          >>> mock_session = Mock()
+          >>> mock_session.info = {}
+          >>> with bulk_mode(mock_session, max_rows=10):
+          ...     mock_session.info[BULK_MODE_KEY]['max_rows']
+          10
+          >>> mock_session.info
+          {}
+
+    """
+
+    # Compose.
+    if key is None:
+        key = BULK_MODE_KEY
+
+    previous = session.info.get(key)
+    session.info[key] = {'max_rows': max_rows, 'rows': 0}
+    try:
+        yield session
+    finally:
+        if previous is None:
+            session.info.pop(key, None)
+        else:
+            session.info[key] = previous
+
+def get_bulk_oids(bulk, instances=None, oids=None, get_oid=None, table_oid=None,
+        unpack_oid=None, relation_tables=None):
+    """Return the object ids to record for the ``instances`` and ``oids``
+      changed in ``bulk`` mode, i.e.: their tables, plus any rows within the
+      ``max_rows`` allowance.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> cls = type('Thing', (object,), {'__tablename__': 'things'})
+          >>> instances = [cls(), cls()]
+          >>> mock_kwargs = dict(get_oid=lambda x: u'alkey:things#1',
+          ...         relation_tables=lambda cls: ['users'])
+
+      Records the tables::
+
+          >>> bulk = {'max_rows': 0, 'rows': 0}
+          >>> get_bulk_oids(bulk, instances, **mock_kwargs)
+          [u'alkey:things#*', u'alkey:users#*']
+          >>> get_bulk_oids(bulk, oids=[u'alkey:things#1'])
+          [u'alkey:things#*']
+
+      And the rows, until the allowance runs out::
+
+          >>> bulk = {'max_rows': 1, 'rows': 0}
+          >>> get_bulk_oids(bulk, instances, **mock_kwargs)
+          [u'alkey:things#*', u'alkey:things#1', u'alkey:users#*']
+          >>> get_bulk_oids(bulk, oids=[u'alkey:things#*', u'alkey:things#2'])
+          [u'alkey:things#*']
+
+    """
+
+    # Compose.
+    if instances is None:
+        instances = []
+    if oids is None:
+        oids = []
+    if get_oid is None:
+        get_oid = get_object_id
+    if table_oid is None:
+        table_oid = get_table_id
+    if unpack_oid is None:
+        unpack_oid = unpack_object_id
+    if relation_tables is None:
+        relation_tables = get_relation_tables
+
+    # Only look at the classes of the instances, unless within the allowance.
+    oids = list(oids)
+    classes = set()
+    for instance in instances:
+        classes.add(type(instance))
+        if bulk['rows'] + len(oids) < bulk['max_rows']:
+            oids.append(get_oid(instance))
+    tablenames = set()
+    for cls in classes:
+        tablenames.add(cls.__tablename__)
+        tablenames.update(relation_tables(cls))
+
+    # Record the rows (i.e.: not the write tokens) within the allowance.
+    rows = set()
+    for oid in oids:
+        tablename, identity = unpack_oid(oid)
+        tablenames.add(tablename)
+        if identity is None or oid in rows:
+            continue
+        if bulk['rows'] < bulk['max_rows']:
+            rows.add(oid)
+            bulk['rows'] += 1
+
+    results = set(table_oid(item) for item in tablenames)
+    results.update(rows)
+    return sorted(results)
+
+def handle_commit(session, get_redis=None, get_request=None, invalidate=None,
+        call=None, pin=None):
+    """Gets a redis client and call the invalidate function with it, pinning
+      the rest of the request's token reads to the primary.
+
+          >>> from mock import Mock
+          >>> mock_session = Mock()
+          >>> mock_session.info = {SESSION_ID_KEY: 'session id'}
           >>> mock_get_request = Mock()
           >>> mock_get_request.return_value = '<request>'
           >>> mock_get_redis = Mock()
           >>> mock_get_redis.return_value = '<redis client>'
           >>> mock_invalidate = Mock()
+          >>> mock_pin = Mock()
           >>> mock_kwargs = dict(get_redis=mock_get_redis,
-          ...         get_request=mock_get_request, invalidate=mock_invalidate)
+          ...         get_request=mock_get_request, invalidate=mock_invalidate,
+          ...         pin=mock_pin)
           >>> handle_commit(mock_session, **mock_kwargs)
           >>> mock_get_redis.assert_called_with('<request>')
           >>> mock_invalidate.assert_called_with('<redis client>', 'session id')
+          >>> mock_pin.assert_called_with('<request>')
 
     """
 
@@ -59,24 +250,31 @@ def handle_commit(session, get_redis=None, get_request=None, invalidate=None, ca
         invalidate = invalidate_tokens
     if call is None: # pragma: no cover
         call = resiliently_call
+    if pin is None: # pragma: no cover
+        pin = pin_to_primary
 
     # Get a redis client configured with the current scope's
     # connection pool.
     request = get_request()
     redis_client = get_redis(request)
 
+    # Make sure the request sees its own writes, even if token reads are
+    # being routed to read replicas.
+    pin(request)
+
     # Call the invalidate function.
-    call(invalidate, args=(redis_client, session.hash_key))
+    call(invalidate, args=(redis_client, get_session_id(session)))
 
-def handle_flush(session, ctx, get_redis=None, get_request=None, record=None, call=None):
+def handle_flush(session, ctx, instances=None, get_redis=None, get_request=None,
+        record=None, call=None, get_parents=None, heat=None, policy=None):
     """Get the current request and record the changed instances set::
 
           >>> from mock import Mock
           >>> mock_session = Mock()
-          >>> mock_session.hash_key = 'session id'
           >>> mock_session.new = set('a')
           >>> mock_session.dirty = set('b')
           >>> mock_session.deleted = set('c')
+          >>> mock_session.info = {SESSION_ID_KEY: 'session id'}
           >>> mock_get_request = Mock()
           >>> mock_get_request.return_value = '<request>'
           >>> mock_get_redis = Mock()
@@ -89,6 +287,29 @@ def handle_flush(session, ctx, get_redis=None, get_request=None, record=None, ca
           >>> mock_record.assert_called_with('<redis client>', 'session id',
           ...         set(['a', 'c', 'b']), [])
 
+      Flagging the session as flushing until ``handle_flushed`` is called::
+
+          >>> mock_session.info[FLUSHING_KEY]
+          True
+          >>> handle_flushed(mock_session, 'ctx')
+          >>> FLUSHING_KEY in mock_session.info
+          False
+
+      Counting the tables flushed, if given a ``heat`` map::
+
+          >>> mock_heat = Mock()
+          >>> handle_flush(mock_session, 'ctx', heat=mock_heat, **mock_kwargs)
+          >>> mock_heat.record_source.assert_called_with('flush', [])
+
+      Ignoring the instances that the tracking ``policy`` excludes::
+
+          >>> mock_policy = Mock()
+          >>> mock_policy.tracks.side_effect = lambda item: item != 'c'
+          >>> mock_policy.filter.side_effect = lambda items: items
+          >>> handle_flush(mock_session, 'ctx', policy=mock_policy, **mock_kwargs)
+          >>> mock_record.assert_called_with('<redis client>', 'session id',
+          ...         set(['a', 'b']), [])
+
     """
 
     # Compose.
@@ -100,14 +321,35 @@ def handle_flush(session, ctx, get_redis=None, get_request=None, record=None, ca
         record = record_changed
     if call is None: # pragma: no cover
         call = resiliently_call
+    if get_parents is None:
+        get_parents = get_parent_oids
+    if policy is None:
+        policy = default_policy
 
     # Get a redis client configured with the current scope's
     # connection pool.
     request = get_request()
     redis_client = get_redis(request)
 
-    # Record the new, changed and deleted instances.
+    # Record the new, changed and deleted instances, apart from the ones
+    # that aren't tracked.
     identity_set = session.new.union(session.dirty.union(session.deleted))
+    untracked = [item for item in identity_set if not policy.tracks(item)]
+    identity_set = identity_set.difference(untracked)
+
+    # Flag the flush, so ``handle_execute`` ignores the statements it emits.
+    session.info[FLUSHING_KEY] = True
+
+    # In bulk mode, just record the tables.
+    bulk = session.info.get(BULK_MODE_KEY)
+    if bulk is not None:
+        oids = policy.filter(get_bulk_oids(bulk, instances=identity_set))
+        if not oids:
+            return
+        if heat is not None:
+            heat.record_source('flush', oids)
+        call(record, args=(redis_client, get_session_id(session), [], oids))
+        return
 
     # *And* record any single relations identified by id -- this allows
     # us to catch edge case scenarios where a child is saved without
@@ -119,15 +361,293 @@ def handle_flush(session, ctx, get_redis=None, get_request=None, record=None, ca
         single_relations = get_single_relations(instance)
         if single_relations:
             relations.extend(single_relations)
+        # Plus the parents that the instance's class declares it invalidates,
+        # transitively, via ``__alkey_parents__``.
+        relations.extend(get_parents(instance))
+
+    # Untracked instances still invalidate the parents they declare.
+    for instance in untracked:
+        relations.extend(get_parents(instance))
+    relations = policy.filter(relations)
+    if not identity_set and not relations:
+        return
+
+    if heat is not None:
+        tablenames = [instance.__tablename__ for instance in identity_set
+                if hasattr(instance, '__tablename__')]
+        heat.record_source('flush', tablenames + relations)
+
+    call(record, args=(redis_client, get_session_id(session), identity_set,
+            relations))
+
+def handle_flushed(session, ctx):
+    """Clear the flag set by ``handle_flush``."""
+
+    session.info.pop(FLUSHING_KEY, None)
+
+def handle_begin(session, transaction, connection, connections=None):
+    """Remember which session a transaction's ``connection`` belongs to::
+
+          >>> from mock import Mock
+          >>> mock_session = Mock()
+          >>> mock_connection = Mock()
+          >>> mock_connection.connection = '<dbapi connection>'
+          >>> mock_connections = {}
+          >>> handle_begin(mock_session, 'tx', mock_connection,
+          ...         connections=mock_connections)
+          >>> mock_connections['<dbapi connection>']() is mock_session
+          True
+
+    """
+
+    # Compose.
+    if connections is None: # pragma: no cover
+        connections = session_connections
+
+    connections[connection.connection] = weakref.ref(session)
+
+def handle_bulk(context, get_redis=None, get_request=None, record=None, call=None,
+        table_oid=None, get_oid=None, get_parents=None, heat=None, policy=None):
+    """Record the table (and any rows that are known to have matched) when a
+      ``query.update()`` or ``query.delete()`` is executed.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> mock_context = Mock()
+          >>> mock_context.session.info = {SESSION_ID_KEY: 'session id'}
+          >>> mock_context.primary_table.name = 'users'
+          >>> mock_context.primary_table.primary_key = ['<id column>']
+          >>> mock_get_redis = Mock()
+          >>> mock_get_redis.return_value = '<redis client>'
+          >>> mock_record = Mock()
+          >>> mock_kwargs = dict(get_redis=mock_get_redis,
+          ...         get_request=lambda: None, record=mock_record)
+
+      Records the rows matched by the ``fetch`` synchronisation strategy::
+
+          >>> mock_context.matched_rows = [(1,), (2,)]
+          >>> mock_context.matched_objects = None
+          >>> handle_bulk(mock_context, **mock_kwargs)
+          >>> mock_record.assert_called_with('<redis client>', 'session id', [],
+          ...         [u'alkey:users#*', u'alkey:users#1', u'alkey:users#2'])
+
+      Or the instances matched by the ``evaluate`` strategy::
+
+          >>> mock_context.matched_rows = None
+          >>> mock_context.matched_objects = ['<instance>']
+          >>> handle_bulk(mock_context, get_oid=lambda x: 'oid', **mock_kwargs)
+          >>> mock_record.assert_called_with('<redis client>', 'session id', [],
+          ...         [u'alkey:users#*', 'oid'])
 
-    call(record, args=(redis_client, session.hash_key, identity_set, relations))
+      Unless the tracking ``policy`` excludes the table::
+
+          >>> from alkey.policy import TrackingPolicy
+          >>> mock_record.reset_mock()
+          >>> mock_context.matched_objects = None
+          >>> handle_bulk(mock_context, policy=TrackingPolicy(['users']),
+          ...         **mock_kwargs)
+          >>> mock_record.called
+          False
+
+    """
+
+    # Compose.
+    if get_redis is None: # pragma: no cover
+        get_redis = get_redis_client
+    if get_request is None: # pragma: no cover
+        get_request = get_current_request
+    if record is None: # pragma: no cover
+        record = record_changed
+    if call is None: # pragma: no cover
+        call = resiliently_call
+    if table_oid is None:
+        table_oid = get_table_id
+    if get_oid is None:
+        get_oid = get_object_id
+    if get_parents is None:
+        get_parents = get_parent_oids
+    if policy is None:
+        policy = default_policy
+
+    # Always record the table. Rows are only known if the session was
+    # synchronised using the ``fetch`` strategy (all the matched rows) or the
+    # ``evaluate`` strategy (the matched instances in the identity map).
+    tablename = context.primary_table.name
+    oids = [table_oid(tablename)]
+    for row in getattr(context, 'matched_rows', None) or []:
+        oids.append(u'alkey:{0}#{1}'.format(tablename, encode_identity(row)))
+    for instance in getattr(context, 'matched_objects', None) or []:
+        oids.append(get_oid(instance))
+        oids.extend(get_parents(instance))
+
+    # In bulk mode, just record the table.
+    bulk = context.session.info.get(BULK_MODE_KEY)
+    if bulk is not None:
+        oids = get_bulk_oids(bulk, oids=oids)
+
+    # Skip the tables that aren't tracked.
+    oids = policy.filter(oids)
+    if not oids:
+        return
+    if heat is not None:
+        heat.record_source('bulk', oids)
+
+    request = get_request()
+    redis_client = get_redis(request)
+    call(record, args=(redis_client, get_session_id(context.session), [], oids))
+
+def get_statement_oids(statement, multiparams, params, table_oid=None):
+    """Return the object ids changed by executing a Core DML ``statement``.
+
+      Setup::
+
+          >>> from sqlalchemy import Column, Integer, MetaData, Table, update
+          >>> users = Table('users', MetaData(), Column('id', Integer,
+          ...         primary_key=True), Column('name', Integer))
+
+      Always returns the table and also returns the rows, if the primary key
+      values are bound as parameters::
+
+          >>> get_statement_oids(users.update(), ([{'id': 1}, {'id': 2}],), {})
+          [u'alkey:users#*', u'alkey:users#1', u'alkey:users#2']
+          >>> get_statement_oids(users.delete(), (), {'name': 1})
+          [u'alkey:users#*']
+
+    """
+
+    # Compose.
+    if table_oid is None:
+        table_oid = get_table_id
+
+    table = statement.table
+    oids = [table_oid(table.name)]
+
+    # Inserts only ever need the table token.
+    if isinstance(statement, Insert):
+        return oids
+
+    # Normalise the parameters into a list of dicts.
+    if multiparams and isinstance(multiparams[0], (list, tuple)):
+        param_dicts = multiparams[0]
+    elif multiparams:
+        param_dicts = multiparams
+    else:
+        param_dicts = [params]
+
+    # Look for the primary key values by column key, or by the column label
+    # that the ORM's ``bulk_update_mappings`` binds them to.
+    columns = list(table.primary_key)
+    for item in param_dicts:
+        if not isinstance(item, dict):
+            continue
+        identity = []
+        for column in columns:
+            for name in (column.key, column._label):
+                if name in item:
+                    identity.append(item[name])
+                    break
+        if identity and len(identity) == len(columns):
+            encoded = encode_identity(identity)
+            oids.append(u'alkey:{0}#{1}'.format(table.name, encoded))
+    return oids
+
+def handle_execute(conn, statement, multiparams, params, result, connections=None,
+        get_redis=None, get_request=None, record=None, call=None, get_oids=None,
+        heat=None, policy=None):
+    """Record the changes made by Core ``insert()``, ``update()`` and
+      ``delete()`` statements (including those emitted by the session's
+      ``bulk_*`` methods) executed within a session's transaction.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> from sqlalchemy import Column, Integer, MetaData, Table, select
+          >>> users = Table('users', MetaData(), Column('id', Integer,
+          ...         primary_key=True))
+          >>> mock_session = Mock()
+          >>> mock_session.info = {SESSION_ID_KEY: 'session id'}
+          >>> mock_conn = Mock()
+          >>> mock_conn.connection = '<dbapi connection>'
+          >>> mock_other = Mock()
+          >>> mock_connections = {'<dbapi connection>': lambda: mock_session}
+          >>> mock_record = Mock()
+          >>> mock_kwargs = dict(connections=mock_connections,
+          ...         get_redis=lambda request: '<redis client>',
+          ...         get_request=lambda: None, record=mock_record)
+
+      Records DML statements::
+
+          >>> handle_execute(mock_conn, users.insert(), (), {}, None, **mock_kwargs)
+          >>> mock_record.assert_called_with('<redis client>', 'session id', [],
+          ...         [u'alkey:users#*'])
+
+      Ignoring selects, statements executed outside of a session transaction
+      and the statements the session emits when flushing, which are already
+      recorded by ``handle_flush``. Note that the session's ``bulk_*`` methods
+      don't trigger a flush, so their statements *are* recorded::
+
+          >>> mock_record.reset_mock()
+          >>> handle_execute(mock_conn, select([users]), (), {}, None, **mock_kwargs)
+          >>> handle_execute(mock_other, users.insert(), (), {}, None, **mock_kwargs)
+          >>> mock_session.info[FLUSHING_KEY] = True
+          >>> handle_execute(mock_conn, users.insert(), (), {}, None, **mock_kwargs)
+          >>> mock_record.called
+          False
+
+      And the tables that the tracking ``policy`` excludes::
+
+          >>> from alkey.policy import TrackingPolicy
+          >>> mock_session.info = {SESSION_ID_KEY: 'session id'}
+          >>> handle_execute(mock_conn, users.insert(), (), {}, None,
+          ...         policy=TrackingPolicy(['users']), **mock_kwargs)
+          >>> mock_record.called
+          False
+
+    """
+
+    # Compose.
+    if connections is None: # pragma: no cover
+        connections = session_connections
+    if get_redis is None: # pragma: no cover
+        get_redis = get_redis_client
+    if get_request is None: # pragma: no cover
+        get_request = get_current_request
+    if record is None: # pragma: no cover
+        record = record_changed
+    if call is None: # pragma: no cover
+        call = resiliently_call
+    if get_oids is None:
+        get_oids = get_statement_oids
+    if policy is None:
+        policy = default_policy
+
+    if not isinstance(statement, UpdateBase):
+        return
+    session_ref = connections.get(conn.connection)
+    session = session_ref() if session_ref is not None else None
+    if session is None or session.info.get(FLUSHING_KEY):
+        return
+
+    oids = policy.filter(get_oids(statement, multiparams, params))
+    if not oids:
+        return
+    bulk = session.info.get(BULK_MODE_KEY)
+    if bulk is not None:
+        oids = get_bulk_oids(bulk, oids=oids)
+    if heat is not None:
+        heat.record_source('execute', oids)
+
+    request = get_request()
+    redis_client = get_redis(request)
+    call(record, args=(redis_client, get_session_id(session), [], oids))
 
 def handle_rollback(session, tx, get_redis=None, get_request=None, clear=None, call=None):
     """Get the current request and clear the changed instances set::
 
           >>> from mock import Mock
           >>> mock_session = Mock()
-          >>> mock_session.hash_key = 'session id'
+          >>> mock_session.info = {SESSION_ID_KEY: 'session id'}
           >>> mock_tx = Mock()
           >>> mock_get_request = Mock()
           >>> mock_get_request.return_value = '<request>'
@@ -167,6 +687,9 @@ def handle_rollback(session, tx, get_redis=None, get_request=None, clear=None, c
     if call is None: # pragma: no cover
         call = resiliently_call
 
+    # A failed flush is rolled back without ``handle_flushed`` being called.
+    session.info.pop(FLUSHING_KEY, None)
+
     # Exit if this is an inner transaction -- i.e.: only wipe a changed set
     # if an outer transaction is rolled back. This uses an internal ``_parent``
     # property of the transaction but that seems the most reliable way of
@@ -181,11 +704,12 @@ def handle_rollback(session, tx, get_redis=None, get_request=None, clear=None, c
     redis_client = get_redis(request)
 
     # Clear the changed set.
-    call(clear, args=(redis_client, session.hash_key))
+    call(clear, args=(redis_client, get_session_id(session)))
 
 def invalidate_tokens(redis_client, session_id, key=None, get_members=None,
         get_value=None, global_token=None, store_value=None, table_oid=None,
-        unpack_oid=None):
+        unpack_oid=None, cluster=None, feed=None, heat=None, policy=None,
+        clear=True):
     """Invalidate tokens with a non-transactional pipeline call that minimises
       TCP overhead without blocking the redis client.
 
@@ -201,6 +725,22 @@ def invalidate_tokens(redis_client, session_id, key=None, get_members=None,
       members aren't added to the set whilst the transaction is completed. This
       means we don't need to block redis / stop flushes from another client adding
       members to the set as we do this block operation.
+
+      In cluster mode, or when sharding, the token writes fan out to different
+      nodes, so the ordering within the pipeline no longer holds. Instead, the
+      members are removed from the changed set in one command, once all of the
+      token writes have succeeded.
+
+      If a ``feed`` is provided, a record of the changes is added to it in the
+      same pipeline. If a ``heat`` map is provided, the changes are counted
+      (and merged into Redis by the heat map's own background thread).
+
+      The global write token isn't bumped if the tracking ``policy`` says
+      that none of the changed tables should bump it.
+
+      Pass ``clear=False`` to leave the members in the changed set (to
+      expire), e.g.: when it's not known whether the session has committed,
+      so that a later commit still invalidates them.
     """
 
     # Compose.
@@ -218,6 +758,10 @@ def invalidate_tokens(redis_client, session_id, key=None, get_members=None,
         table_oid = get_table_id
     if unpack_oid is None:
         unpack_oid = unpack_object_id
+    if cluster is None:
+        cluster = is_distributed(redis_client)
+    if policy is None:
+        policy = default_policy
 
     # Get the current members of the set, exiting if there are none.
     members = get_members(redis_client, session_id, key=key)
@@ -235,24 +779,55 @@ def invalidate_tokens(redis_client, session_id, key=None, get_members=None,
 
     # Update the token for each member of the set, deleting the member from the
     # as the next sequential command.
-    changed_key = u'{0}:{1}'.format(key, session_id)
+    changed_key = get_changed_key(session_id, key=key)
     for item in members:
         store_value(pipeline, item, value)
         try:
             tablenames.add(unpack_oid(item)[0])
         except IndexError:
             pass
-        pipeline.srem(changed_key, item)
+        if clear and not cluster:
+            pipeline.srem(changed_key, item)
 
     # Update the tables.
     for item in tablenames:
         store_value(pipeline, table_oid(item), value)
 
-    # Update the global write token.
-    store_value(pipeline, global_token, value)
+    # Update the global write token, unless all the tables opt out of it.
+    bumps_global = policy.bumps_global(tablenames)
+    if bumps_global:
+        store_value(pipeline, global_token, value)
+
+    # Record the changes to the feed.
+    if feed is not None:
+        feed.record(pipeline, members, tablenames, value,
+                bumps_global=bumps_global)
+
+    # Count the changes.
+    if heat is not None:
+        heat.record_commit(members, tablenames, bumps_global=bumps_global)
+        heat.start(redis_client)
 
     # Execute the queued commands.
     pipeline.execute()
+    if clear and cluster:
+        redis_client.srem(changed_key, *members)
+
+def get_changed_key(session_id, key=None):
+    """Return the key of the changed set for this session. The session id is
+      wrapped in a hash tag, so that all of the keys for a session share a slot
+      when running against Redis Cluster::
+
+          >>> get_changed_key(1234)
+          u'alkey.handle.CHANGED:{1234}'
+
+    """
+
+    # Compose.
+    if key is None:
+        key = CHANGED_KEY
+
+    return u'{0}:{1}'.format(key, hash_tag(session_id))
 
 def get_changed(redis_client, session_id, key=None):
     """Get the changed set for this session."""
@@ -262,7 +837,7 @@ def get_changed(redis_client, session_id, key=None):
         key = CHANGED_KEY
 
     # Get the current members of the set, exiting if there are none.
-    changed_key = u'{0}:{1}'.format(key, session_id)
+    changed_key = get_changed_key(session_id, key=key)
     return redis_client.smembers(changed_key)
 
 def clear_changed(redis_client, session_id, key=None):
@@ -272,8 +847,7 @@ def clear_changed(redis_client, session_id, key=None):
     if key is None:
         key = CHANGED_KEY
 
-    # Get the current members of the set, exiting if there are none.
-    changed_key = u'{0}:{1}'.format(key, session_id)
+    changed_key = get_changed_key(session_id, key=key)
     return redis_client.delete(changed_key)
 
 def record_changed(redis_client, session_id, instances, relation_oids=None,
@@ -290,12 +864,14 @@ def record_changed(redis_client, session_id, instances, relation_oids=None,
     if relation_oids is None:
         relation_oids = []
 
-    changed_key = u'{0}:{1}'.format(key, session_id)
+    changed_key = get_changed_key(session_id, key=key)
     instance_oids = [get_oid(item) for item in instances]
     values = tuple(set(instance_oids + relation_oids))
 
-    # Add and update set expiry within a transaction.
-    pipeline = redis_client.pipeline()
+    # Add and update set expiry within a transaction. Cluster clients don't
+    # support ``MULTI``, in which case the commands are pipelined to the
+    # changed set's node.
+    pipeline = redis_client.pipeline(transaction=not is_cluster(redis_client))
     pipeline.sadd(changed_key, *values).expire(changed_key, expires)
     return pipeline.execute()
 
@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``HeatMap``, which counts how often each table and oid is
+  invalidated, and by which flush source (``flush``, ``bulk`` or ``execute``
+  plus the tablename), in bounded memory, using a Count-Min sketch and a
+  bounded set of top-K candidates per kind. Each process counts locally and
+  a background thread periodically merges its counts into Redis, in a
+  pipeline of its own (i.e.: off the commit path), so the worst offenders
+  across all of the processes can be reported, e.g.: using the ``alkey-heat``
+  console script::
+
+      alkey-heat --url redis://localhost:6379 --count 20
+
+  The heat map is enabled by setting ``alkey.heat_map = true``.
+"""
+
+__all__ = [
+    'CountMinSketch',
+    'HeatMap',
+    'get_heat_map',
+    'get_report',
+    'main',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import argparse
+import hashlib
+import struct
+import sys
+import threading
+import time
+from array import array
+
+import redis
+from redis.exceptions import RedisError
+
+from .constants import HEAT_MAP_KEY
+from .utils import as_bool
+from .utils import unpack_object_id
+
+KINDS = ('tables', 'oids', 'sources')
+
+def get_indexes(key, width, depth):
+    """Return the column of ``key`` in each of ``depth`` rows, using double
+      hashing of its md5 digest::
+
+          >>> get_indexes(u'alkey:users#1', 1024, 4) == get_indexes(
+          ...         'alkey:users#1', 1024, 4)
+          True
+
+    """
+
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    a, b = struct.unpack('<QQ', hashlib.md5(key).digest())
+    return [(a + i * b) % width for i in range(depth)]
+
+
+class CountMinSketch(object):
+    """Estimate the count of each key in ``width * depth`` counters. Estimates
+      are never less than the true count::
+
+          >>> sketch = CountMinSketch(width=64, depth=4)
+          >>> [sketch.add(key) for key in ['a', 'a', 'b']]
+          [1, 2, 1]
+          >>> sketch.estimate('a'), sketch.estimate('c')
+          (2, 0)
+
+      The non zero counters are returned as ``((row, column), count)``::
+
+          >>> len(list(sketch.cells())) <= 8
+          True
+
+    """
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('L', [0] * width) for i in range(depth)]
+
+    def add(self, key, count=1):
+        """Add ``count`` to ``key``, returning its new estimate."""
+
+        estimate = None
+        for row, column in enumerate(get_indexes(key, self.width, self.depth)):
+            self.rows[row][column] += count
+            value = int(self.rows[row][column])
+            if estimate is None or value < estimate:
+                estimate = value
+        return estimate
+
+    def estimate(self, key):
+        columns = get_indexes(key, self.width, self.depth)
+        return int(min(self.rows[row][column] for row, column in
+                enumerate(columns)))
+
+    def cells(self):
+        for row, counters in enumerate(self.rows):
+            for column, count in enumerate(counters):
+                if count:
+                    yield (row, column), int(count)
+
+
+class HeatMap(object):
+    """Count invalidations locally, merging them into Redis every
+      ``flush_interval`` seconds.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> heat = HeatMap(width=64, top_k=2)
+
+      Counts the oids and tables each commit invalidates and whether it bumps
+      the global write token::
+
+          >>> heat.record_commit([u'alkey:users#1', u'alkey:users#2'],
+          ...         [u'users'])
+          >>> heat.record_commit([u'alkey:users#1'], [u'users'])
+          >>> heat.record_commit([u'alkey:posts#1'], [u'posts'])
+          >>> heat.top('oids', 1)
+          [(u'alkey:users#1', 2)]
+          >>> heat.commits, heat.global_commits
+          (3, 3)
+
+      Keeping at most ``top_k`` candidates per kind::
+
+          >>> len(heat.candidates['oids'])
+          2
+
+      And the flush sources, by table::
+
+          >>> heat.record_source('flush', [u'alkey:users#1', u'users'])
+          >>> heat.top('sources', 5)
+          [(u'flush:users', 1)]
+
+      Merges into Redis in a pipeline of its own::
+
+          >>> mock_client = Mock()
+          >>> heat.write(mock_client)
+          >>> pipeline = mock_client.pipeline.return_value
+          >>> pipeline.zincrby.assert_any_call('alkey.heat:oids:TOP', 2,
+          ...         u'alkey:users#1')
+          >>> pipeline.hincrby.assert_any_call('alkey.heat:COMMITS', 'global', 3)
+          >>> pipeline.execute.called
+          True
+          >>> heat.commits, heat.top('oids', 1)
+          (0, [])
+
+      Every ``flush_interval`` seconds, once started with a client::
+
+          >>> heat = HeatMap(flush_interval=5, sleep=lambda seconds: heat.stop())
+          >>> heat.redis = mock_client
+          >>> heat.run()
+          >>> heat.stopped
+          True
+
+    """
+
+    def __init__(self, width=2048, depth=4, top_k=100, flush_interval=10,
+            expires=None, key=None, sleep=None):
+        # Compose.
+        if expires is None:
+            expires = 60 * 60 * 24 * 7
+        if key is None:
+            key = HEAT_MAP_KEY
+        if sleep is None:
+            sleep = time.sleep
+
+        # Assign.
+        self.width = width
+        self.depth = depth
+        self.top_k = top_k
+        self.flush_interval = flush_interval
+        self.expires = expires
+        self.key = key
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.redis = None
+        self.stopped = False
+        self.thread = None
+        self.reset()
+
+    def reset(self):
+        self.sketches = dict((k, CountMinSketch(self.width, self.depth))
+                for k in KINDS)
+        self.candidates = dict((k, {}) for k in KINDS)
+        self.commits = 0
+        self.global_commits = 0
+
+    def add(self, kind, key):
+        """Count ``key``, keeping it as a candidate if it's in the top K."""
+
+        estimate = self.sketches[kind].add(key)
+        candidates = self.candidates[kind]
+        candidates[key] = estimate
+        if len(candidates) > self.top_k:
+            coldest = min(candidates, key=candidates.get)
+            del candidates[coldest]
+
+    def record_commit(self, oids, tablenames, bumps_global=True):
+        """Count the ``oids`` and ``tablenames`` a commit invalidates."""
+
+        with self.lock:
+            for oid in oids:
+                self.add('oids', oid)
+            for tablename in tablenames:
+                self.add('tables', tablename)
+            self.commits += 1
+            if bumps_global:
+                self.global_commits += 1
+
+    def record_source(self, source, items):
+        """Count the tables that the ``source`` recorded changes to, given a
+          list of oids and / or tablenames.
+        """
+
+        tablenames = set()
+        for item in items:
+            if u'#' in item:
+                item = unpack_object_id(item)[0]
+            tablenames.add(item)
+        with self.lock:
+            for tablename in tablenames:
+                self.add('sources', u'{0}:{1}'.format(source, tablename))
+
+    def top(self, kind, count):
+        """Return the ``count`` most frequent ``(key, estimate)`` of ``kind``
+          counted locally since the last flush.
+        """
+
+        with self.lock:
+            items = self.candidates[kind].items()
+        items.sort(key=lambda item: (-item[1], item[0]))
+        return items[:count]
+
+    def flush(self, pipeline):
+        """Queue the merge of the local counts into Redis on the ``pipeline``
+          and reset them.
+        """
+
+        with self.lock:
+            sketches = self.sketches
+            candidates = self.candidates
+            commits = self.commits
+            global_commits = self.global_commits
+            self.reset()
+        for kind in KINDS:
+            sketch_key = u'{0}:{1}:SKETCH'.format(self.key, kind)
+            top_key = u'{0}:{1}:TOP'.format(self.key, kind)
+            for (row, column), count in sketches[kind].cells():
+                pipeline.hincrby(sketch_key, u'{0}:{1}'.format(row, column),
+                        count)
+            for candidate, count in candidates[kind].items():
+                pipeline.zincrby(top_key, count, candidate)
+            # Keep the (approximate) top K candidates of all the processes.
+            pipeline.zremrangebyrank(top_key, 0, -(self.top_k + 1))
+            pipeline.expire(sketch_key, self.expires)
+            pipeline.expire(top_key, self.expires)
+        commits_key = u'{0}:COMMITS'.format(self.key)
+        pipeline.hincrby(commits_key, 'commits', commits)
+        pipeline.hincrby(commits_key, 'global', global_commits)
+        pipeline.expire(commits_key, self.expires)
+
+    def write(self, redis_client):
+        """Merge the local counts into Redis in a pipeline of their own."""
+
+        pipeline = redis_client.pipeline(transaction=False)
+        self.flush(pipeline)
+        pipeline.execute()
+
+    def run(self):
+        """Merge the counts every ``flush_interval`` seconds, until stopped."""
+
+        while True:
+            self.sleep(self.flush_interval)
+            if self.stopped:
+                break
+            try:
+                self.write(self.redis)
+            except RedisError as err:
+                logger.warn(err, exc_info=True)
+
+    def start(self, redis_client):
+        """Start merging the counts into Redis, using ``redis_client``, in a
+          daemon thread. Called with the client of the first commit counted,
+          so the thread is started in the process (e.g.: after a fork) that
+          does the counting.
+        """
+
+        if self.thread is None:
+            with self.lock:
+                if self.thread is not None:
+                    return
+                self.redis = redis_client
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+
+
+def get_heat_map(settings, heat_map_cls=None):
+    """Return a ``HeatMap`` if ``alkey.heat_map`` is set::
+
+          >>> get_heat_map({})
+          >>> heat = get_heat_map({'alkey.heat_map': 'true',
+          ...         'alkey.heat_map.top_k': '10'})
+          >>> heat.width, heat.depth, heat.top_k, heat.flush_interval
+          (2048, 4, 10, 10)
+
+    """
+
+    # Compose.
+    if heat_map_cls is None:
+        heat_map_cls = HeatMap
+
+    if not as_bool(settings.get('alkey.heat_map', False)):
+        return None
+    return heat_map_cls(
+        width=int(settings.get('alkey.heat_map.width', 2048)),
+        depth=int(settings.get('alkey.heat_map.depth', 4)),
+        top_k=int(settings.get('alkey.heat_map.top_k', 100)),
+        flush_interval=int(settings.get('alkey.heat_map.flush_interval', 10)),
+        key=settings.get('alkey.heat_map.key', None),
+    )
+
+def decode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+def get_report(redis_client, count=20, width=2048, depth=4, key=None):
+    """Return the ``count`` worst offenders of each kind, as ``(key,
+      estimate)``, estimated from the merged sketches, plus the number of
+      commits and the fraction of them that bumped the global write token.
+      ``width`` and ``depth`` must match the processes' heat maps.
+    """
+
+    # Compose.
+    if key is None:
+        key = HEAT_MAP_KEY
+
+    candidates = {}
+    for kind in KINDS:
+        top_key = u'{0}:{1}:TOP'.format(key, kind)
+        candidates[kind] = [decode(item) for item in
+                redis_client.zrevrange(top_key, 0, count - 1)]
+    pipeline = redis_client.pipeline(transaction=False)
+    for kind in KINDS:
+        sketch_key = u'{0}:{1}:SKETCH'.format(key, kind)
+        for candidate in candidates[kind]:
+            fields = [u'{0}:{1}'.format(row, column) for row, column in
+                    enumerate(get_indexes(candidate, width, depth))]
+            pipeline.hmget(sketch_key, fields)
+    pipeline.hmget(u'{0}:COMMITS'.format(key), ['commits', 'global'])
+    results = iter(pipeline.execute())
+
+    report = {}
+    for kind in KINDS:
+        items = []
+        for candidate in candidates[kind]:
+            estimate = min(int(value or 0) for value in next(results))
+            items.append((candidate, estimate))
+        items.sort(key=lambda item: (-item[1], item[0]))
+        report[kind] = items
+    commits, global_commits = [int(value or 0) for value in next(results)]
+    report['commits'] = commits
+    report['global_fraction'] = global_commits / float(commits or 1)
+    return report
+
+def main(argv=None, client_cls=None, get_report_=None, output=None):
+    """Command line entry point::
+
+          >>> from mock import Mock
+          >>> mock_get_report = Mock()
+          >>> mock_get_report.return_value = {'tables': [(u'users', 12)],
+          ...         'oids': [], 'sources': [(u'flush:users', 3)],
+          ...         'commits': 12, 'global_fraction': 1.0}
+          >>> lines = []
+          >>> main(['--count', '5'], client_cls=Mock(),
+          ...         get_report_=mock_get_report, output=lines.append)
+          0
+          >>> lines # doctest: +NORMALIZE_WHITESPACE
+          [u'commits=12 global=100.0%', u'tables:', u'  12 users', u'oids:',
+           u'sources:', u'  3 flush:users']
+
+    """
+
+    # Compose.
+    if client_cls is None: #pragma: no cover
+        client_cls = redis.StrictRedis
+    if get_report_ is None: #pragma: no cover
+        get_report_ = get_report
+    if output is None: #pragma: no cover
+        output = lambda line: sys.stdout.write(u'{0}\n'.format(line))
+
+    parser = argparse.ArgumentParser(description=u'Report invalidation churn.')
+    parser.add_argument('--url', default='redis://localhost:6379')
+    parser.add_argument('--db', type=int, default=None)
+    parser.add_argument('--count', type=int, default=20)
+    parser.add_argument('--width', type=int, default=2048)
+    parser.add_argument('--depth', type=int, default=4)
+    args = parser.parse_args(argv)
+
+    kwargs = {}
+    if args.db is not None:
+        kwargs['db'] = args.db
+    redis_client = client_cls.from_url(args.url, **kwargs)
+    report = get_report_(redis_client, count=args.count, width=args.width,
+            depth=args.depth)
+    output(u'commits={0} global={1:.1%}'.format(report['commits'],
+            report['global_fraction']))
+    for kind in KINDS:
+        output(u'{0}:'.format(kind))
+        for item, estimate in report[kind]:
+            output(u'  {0} {1}'.format(estimate, item))
+    return 0
@@ -0,0 +1,496 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``HostTokenTable``, a fixed size table of token values in a memory
+  mapped file that's shared by all of the worker processes on a host, and
+  ``HostTokenRedis``, a redis client that reads tokens from it, e.g.::
+
+      listener = get_host_table(redis_client, {'alkey.host_table': path})
+      client = HostTokenRedis(redis_client, listener)
+      client.get(u'alkey.cache.TOKENS:alkey:users#1') # served from the table
+
+  The table is kept coherent by a single listener per host: each process runs
+  a ``HostTokenListener`` thread but only the one that holds an exclusive lock
+  on ``<path>.listener`` tracks the token keys (see ``alkey.tracking``) and
+  writes the invalidations to the table. If that process dies, the lock is
+  released and another process takes over.
+
+  The listener writes a heartbeat to the table after each poll. Reads fall
+  through to Redis if the heartbeat is more than ``max_staleness`` seconds old.
+  Reads are lock free: each slot has a sequence number that's odd whilst the
+  slot is being written, so readers can detect (and skip) torn reads. Writes
+  take an exclusive lock on the table file and values read from Redis are
+  only stored if the table's generation, which is incremented by every
+  invalidation, hasn't changed since the read began.
+"""
+
+__all__ = [
+    'HostTokenListener',
+    'HostTokenRedis',
+    'HostTokenTable',
+    'get_host_table',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+import redis
+
+from .tracking import TokenTracker
+from .utils import is_token_read
+
+# The header is ``(magic, slots, generation, heartbeat)``.
+MAGIC = 'ALK1'
+HEADER = struct.Struct('<4sIQd')
+HEADER_SIZE = 64
+GENERATION = struct.Struct('<Q')
+GENERATION_OFFSET = 8
+HEARTBEAT = struct.Struct('<d')
+HEARTBEAT_OFFSET = 16
+
+# Each slot is ``(sequence, hash, key length, value length)`` followed by the
+# key and value bytes. A hash of zero marks an empty slot.
+SLOT = struct.Struct('<IQHH')
+SEQUENCE = struct.Struct('<I')
+KEY_SIZE = 112
+VALUE_SIZE = 64
+SLOT_SIZE = SLOT.size + KEY_SIZE + VALUE_SIZE
+
+def encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class HostTokenTable(object):
+    """A table of token values, in slots of a memory mapped file, found by
+      open addressing with at most ``max_probe`` probes.
+
+      Setup::
+
+          >>> import os, tempfile
+          >>> path = tempfile.mktemp()
+          >>> table = HostTokenTable(path, slots=8)
+          >>> table.beat()
+
+      Stores values unless the table's been invalidated since the read began::
+
+          >>> generation = table.get_generation()
+          >>> table.fill(['a', 'b'], ['1', '2'], generation)
+          True
+          >>> table.invalidate(['b'])
+          >>> table.fill(['c'], ['3'], generation)
+          False
+
+      The table is shared by every process that opens the file::
+
+          >>> other = HostTokenTable(path, slots=8)
+          >>> other.lookup(['a', 'b', 'c'])
+          (['1', None, None], [1, 2])
+
+      Reads fall through when the heartbeat stops::
+
+          >>> table.beat(0)
+          >>> other.lookup(['a'])
+          ([None], [0])
+
+      Teardown::
+
+          >>> table.close()
+          >>> other.close()
+          >>> os.unlink(path)
+
+    """
+
+    def __init__(self, path, slots=16384, max_probe=8, max_staleness=5,
+            now=None):
+        # Compose.
+        if now is None:
+            now = time.time
+
+        # Assign.
+        self.path = path
+        self.slots = slots
+        self.max_probe = min(max_probe, slots)
+        self.max_staleness = max_staleness
+        self.now = now
+        self.size = HEADER_SIZE + slots * SLOT_SIZE
+        self.lock = threading.Lock()
+
+        # Open, and if need be initialise, the table.
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                self.memory = self.initialise()
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    def initialise(self):
+        """Return the memory map of the table file, sizing it and writing the
+          header if it's new.
+        """
+
+        error = u'{0} is not a table of {1} slots.'.format(self.path, self.slots)
+        size = os.fstat(self.fd).st_size
+        if not size:
+            os.ftruncate(self.fd, self.size)
+        elif size != self.size:
+            raise ValueError(error)
+        memory = mmap.mmap(self.fd, self.size)
+        if not size:
+            HEADER.pack_into(memory, 0, MAGIC, self.slots, 0, 0.0)
+        elif HEADER.unpack_from(memory, 0)[:2] != (MAGIC, self.slots):
+            memory.close()
+            raise ValueError(error)
+        return memory
+
+    @contextmanager
+    def locked(self):
+        """Exclusively lock the table for writing, across threads and
+          processes.
+        """
+
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def get_generation(self):
+        return GENERATION.unpack_from(self.memory, GENERATION_OFFSET)[0]
+
+    def beat(self, timestamp=None):
+        """Record that the table is being kept coherent as of ``timestamp``."""
+
+        if timestamp is None:
+            timestamp = self.now()
+        HEARTBEAT.pack_into(self.memory, HEARTBEAT_OFFSET, timestamp)
+
+    def is_fresh(self):
+        """Has the listener written a heartbeat recently enough?"""
+
+        heartbeat = HEARTBEAT.unpack_from(self.memory, HEARTBEAT_OFFSET)[0]
+        return 0 <= self.now() - heartbeat <= self.max_staleness
+
+    def get_hash(self, key):
+        return (zlib.crc32(key) & 0xffffffff) | 0x100000000
+
+    def get_offsets(self, key_hash):
+        """Return the offsets of the slots to probe for ``key_hash``."""
+
+        start = key_hash % self.slots
+        return [HEADER_SIZE + ((start + i) % self.slots) * SLOT_SIZE
+                for i in range(self.max_probe)]
+
+    def read(self, offset):
+        """Return the ``(hash, key, value)`` in the slot at ``offset``, or
+          ``None`` if it's being written to.
+        """
+
+        sequence, key_hash, key_length, value_length = SLOT.unpack_from(
+                self.memory, offset)
+        if sequence & 1:
+            return None
+        start = offset + SLOT.size
+        key = self.memory[start:start + key_length]
+        start += KEY_SIZE
+        value = self.memory[start:start + value_length]
+        if SEQUENCE.unpack_from(self.memory, offset)[0] != sequence:
+            return None
+        return key_hash, key, value
+
+    def write(self, offset, key_hash, key, value):
+        """Write to the slot at ``offset``. Must be called whilst locked."""
+
+        sequence = SEQUENCE.unpack_from(self.memory, offset)[0]
+        SEQUENCE.pack_into(self.memory, offset, (sequence + 1) & 0xffffffff)
+        start = offset + SLOT.size
+        self.memory[start:start + len(key)] = key
+        start += KEY_SIZE
+        self.memory[start:start + len(value)] = value
+        SLOT.pack_into(self.memory, offset, (sequence + 1) & 0xffffffff,
+                key_hash, len(key), len(value))
+        SEQUENCE.pack_into(self.memory, offset, (sequence + 2) & 0xffffffff)
+
+    def find(self, key):
+        """Return ``(key_hash, offset, value)`` for ``key``, where ``offset``
+          and ``value`` are ``None`` if the key isn't stored.
+        """
+
+        key_hash = self.get_hash(key)
+        for offset in self.get_offsets(key_hash):
+            slot = self.read(offset)
+            if slot is not None and slot[:2] == (key_hash, key):
+                return key_hash, offset, slot[2]
+        return key_hash, None, None
+
+    def lookup(self, keys):
+        """Return ``(values, missing)`` where ``missing`` is the list of the
+          indexes of the ``keys`` that aren't stored in the table.
+        """
+
+        if not self.is_fresh():
+            return [None] * len(keys), range(len(keys))
+        values = []
+        missing = []
+        for i, key in enumerate(keys):
+            value = None
+            key = encode(key)
+            if len(key) <= KEY_SIZE:
+                value = self.find(key)[2]
+            if value is None:
+                missing.append(i)
+            values.append(value)
+        return values, missing
+
+    def fill(self, keys, values, generation):
+        """Store the ``values`` read for ``keys``, unless the table has been
+          invalidated since the read began at ``generation``.
+        """
+
+        with self.locked():
+            if self.get_generation() != generation:
+                return False
+            for key, value in zip(keys, values):
+                key, value = encode(key), encode(value)
+                if value is None or len(key) > KEY_SIZE:
+                    continue
+                if len(value) > VALUE_SIZE:
+                    continue
+                key_hash, offset, _ = self.find(key)
+                if offset is None:
+                    offsets = self.get_offsets(key_hash)
+                    empty = [item for item in offsets if not self.read(item)[0]]
+                    # Evict the first candidate if there are no empty slots.
+                    offset = empty[0] if empty else offsets[0]
+                self.write(offset, key_hash, key, value)
+            return True
+
+    def invalidate(self, keys):
+        """Drop ``keys`` (or everything, if ``keys`` is ``None``)."""
+
+        with self.locked():
+            GENERATION.pack_into(self.memory, GENERATION_OFFSET,
+                    self.get_generation() + 1)
+            if keys is None:
+                offsets = [HEADER_SIZE + i * SLOT_SIZE for i in range(self.slots)]
+                for offset in offsets:
+                    if self.read(offset)[0]:
+                        self.write(offset, 0, '', '')
+                return
+            for key in keys:
+                key_hash, offset, _ = self.find(encode(key))
+                if offset is not None:
+                    self.write(offset, 0, '', '')
+
+    def close(self):
+        self.memory.close()
+        os.close(self.fd)
+
+
+class HostTokenListener(TokenTracker):
+    """Track the token keys and write the invalidations to the ``table``, if
+      this process wins the election to be the host's listener::
+
+          >>> from mock import Mock
+          >>> table = Mock()
+          >>> table.path = '/tmp/alkey.tokens'
+          >>> listener = HostTokenListener(None, table)
+          >>> listener.invalidate(['a'])
+          >>> table.invalidate.called
+          False
+          >>> listener.elected = True
+          >>> listener.invalidate(['a'])
+          >>> table.invalidate.assert_called_with(['a'])
+
+    """
+
+    def __init__(self, redis_client, table, lock_path=None, **kwargs):
+        # Compose.
+        if lock_path is None:
+            lock_path = u'{0}.listener'.format(table.path)
+
+        # Assign.
+        super(HostTokenListener, self).__init__(redis_client, **kwargs)
+        self.table = table
+        self.lock_path = lock_path
+        self.lock_fd = None
+        self.elected = False
+
+    def invalidate(self, keys):
+        if self.elected:
+            self.table.invalidate(keys)
+
+    def connect(self):
+        """Connect and then clear the table, dropping anything that was stored
+          whilst it wasn't being kept coherent.
+        """
+
+        super(HostTokenListener, self).connect()
+        self.invalidate(None)
+
+    def disconnect(self):
+        super(HostTokenListener, self).disconnect()
+        if self.elected:
+            self.table.beat(0)
+
+    def beat(self):
+        self.table.beat()
+
+    def elect(self):
+        """Try to take the host's listener lock, without blocking."""
+
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(fd)
+            return False
+        self.lock_fd = fd
+        return True
+
+    def run(self):
+        """Wait to be elected and then listen. The lock is held until the
+          listener is stopped (or the process exits) -- including if tracking
+          isn't supported, so the other processes don't keep trying.
+        """
+
+        while not self.stopped:
+            if self.elect():
+                self.elected = True
+                self.listen()
+                return
+            self.sleep(self.retry_interval)
+
+    def start(self):
+        """Start running in a daemon thread."""
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        super(HostTokenListener, self).stop()
+        self.elected = False
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+
+class HostTokenRedis(redis.StrictRedis):
+    """Serve token reads from the ``listener``'s ``HostTokenTable``, falling
+      through to Redis for the tokens that aren't in it.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> inner = Mock()
+          >>> listener = Mock()
+          >>> listener.table.lookup.return_value = ([None], [0])
+          >>> listener.table.get_generation.return_value = 3
+          >>> listener.redis.mget.return_value = ['1']
+          >>> client = HostTokenRedis(inner, listener)
+          >>> key = u'alkey.cache.TOKENS:alkey:users#1'
+
+      Falls through to the inner client unless the table is fresh::
+
+          >>> listener.table.is_fresh.return_value = False
+          >>> return_value = client.get(key)
+          >>> inner.execute_command.assert_called_with('GET', key)
+
+      Otherwise fills the table from the listener's client::
+
+          >>> listener.table.is_fresh.return_value = True
+          >>> client.get(key)
+          '1'
+          >>> listener.table.fill.assert_called_with((key,), ['1'], 3)
+
+    """
+
+    def __init__(self, inner, listener, is_token_read_=None):
+        # Compose.
+        if is_token_read_ is None:
+            is_token_read_ = is_token_read
+
+        # Assign.
+        self.inner = inner
+        self.listener = listener
+        self.table = listener.table
+        self.is_token_read = is_token_read_
+        self.response_callbacks = {}
+        self.connection = None
+
+    def __repr__(self):
+        return '{0}<{1!r}>'.format(type(self).__name__, self.inner)
+
+    def execute_command(self, *args, **options):
+        if not self.is_token_read(args) or not self.table.is_fresh():
+            return self.inner.execute_command(*args, **options)
+
+        keys = args[1:]
+        values, missing = self.table.lookup(keys)
+        if missing:
+            # Fill from the tracked client -- not e.g.: a lagging replica.
+            missing_keys = tuple(keys[i] for i in missing)
+            generation = self.table.get_generation()
+            fetched = self.listener.redis.mget(missing_keys)
+            self.table.fill(missing_keys, fetched, generation)
+            for i, value in zip(missing, fetched):
+                values[i] = value
+        if args[0].upper() == 'GET':
+            return values[0]
+        return values
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return self.inner.pipeline(transaction=transaction, shard_hint=shard_hint)
+
+    def scan_iter(self, match=None, count=None):
+        return self.inner.scan_iter(match=match, count=count)
+
+
+def get_host_table(redis_client, settings, table_cls=None, listener_cls=None):
+    """Return a started ``HostTokenListener`` for a ``HostTokenTable`` at the
+      ``alkey.host_table`` path, with ``alkey.host_table.slots`` slots and
+      a ``alkey.host_table.max_staleness`` heartbeat tolerance (in seconds)::
+
+          >>> from mock import Mock
+          >>> mock_table_cls = Mock()
+          >>> mock_listener_cls = Mock()
+          >>> settings = {'alkey.host_table': '/dev/shm/alkey.tokens',
+          ...         'alkey.host_table.slots': '1024'}
+          >>> listener = get_host_table('<client>', settings,
+          ...         table_cls=mock_table_cls, listener_cls=mock_listener_cls)
+          >>> mock_table_cls.assert_called_with('/dev/shm/alkey.tokens',
+          ...         slots=1024, max_staleness=5)
+          >>> listener.start.called
+          True
+
+    """
+
+    # Compose.
+    if table_cls is None:
+        table_cls = HostTokenTable
+    if listener_cls is None:
+        listener_cls = HostTokenListener
+
+    slots = int(settings.get('alkey.host_table.slots', 16384))
+    max_staleness = int(settings.get('alkey.host_table.max_staleness', 5))
+    table = table_cls(settings['alkey.host_table'], slots=slots,
+            max_staleness=max_staleness)
+    listener = listener_cls(redis_client, table)
+    listener.start()
+    return listener
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``conditional_view``, a Pyramid view decorator that derives an
+  ``ETag`` from a cache key and returns a ``304 Not Modified`` response,
+  without calling the view, when the client already has the current version,
+  e.g.::
+
+      @view_config(route_name='order', renderer='json',
+              decorator=conditional_view(lambda request: (request.context,)))
+      def order_view(request):
+          ...
+
+  The key args are passed to ``request.cache_key``, so the tokens are read
+  in one batched round trip.
+
+  The same instances can be rendered by more than one view, or differently
+  after a deploy, so the etag is salted with the ``alkey.etag_salt`` setting
+  and the view's ``salt``, e.g.: ``conditional_view(get_args, salt='v2')``.
+  The ``vary`` and ``cache_control`` headers are set on both the full and the
+  ``304`` responses, so caches treat them alike.
+"""
+
+__all__ = [
+    'conditional_view',
+    'get_etag',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import hashlib
+
+from pyramid.httpexceptions import HTTPNotModified
+
+# The request methods that can be answered with a ``304``.
+CONDITIONAL_METHODS = ('GET', 'HEAD')
+
+def get_etag(cache_key, salt=None):
+    """Return an (unquoted) entity tag for a ``cache_key``, optionally
+      salted::
+
+          >>> get_etag(u'2014-01-01 00:00:00/alkey:users#1')
+          'e301d62546192b35d1fc049fc3b0ec49'
+          >>> get_etag(u'2014-01-01 00:00:00/alkey:users#1', salt=u'v2')
+          'fa2d26fba40355a1b0e51b61ebb546dc'
+
+    """
+
+    if salt:
+        cache_key = u'{0}/{1}'.format(salt, cache_key)
+    if isinstance(cache_key, unicode):
+        cache_key = cache_key.encode('utf-8')
+    return hashlib.md5(cache_key).hexdigest()
+
+def get_salt(settings, salt=None):
+    """Combine the ``alkey.etag_salt`` setting with a view's ``salt``::
+
+          >>> get_salt({}), get_salt({}, salt='json')
+          (None, 'json')
+          >>> get_salt({'alkey.etag_salt': 'v2'}, salt='json')
+          u'v2/json'
+
+    """
+
+    salts = [settings.get('alkey.etag_salt', None), salt]
+    salts = [item for item in salts if item]
+    if not salts:
+        return None
+    if len(salts) == 1:
+        return salts[0]
+    return u'/'.join(salts)
+
+def conditional_view(get_args, salt=None, vary=None, cache_control=None,
+        get_generator=None, get_settings=None, make_etag=None, methods=None,
+        not_modified_cls=None):
+    """Return a view decorator that sets an ``ETag`` derived from the cache
+      key of ``get_args(request)`` on the response, or returns ``304 Not
+      Modified`` if it matches the request's ``If-None-Match`` header.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> mock_view = Mock()
+          >>> mock_request = Mock()
+          >>> mock_request.method = 'GET'
+          >>> mock_request.registry.settings = {}
+          >>> mock_request.cache_key.return_value = u'token/alkey:users#1'
+          >>> etag = get_etag(u'token/alkey:users#1')
+          >>> decorator = conditional_view(lambda request: ('<instance>',))
+          >>> view = decorator(mock_view)
+
+      Calls the view and sets the etag::
+
+          >>> mock_request.if_none_match = []
+          >>> response = view('<context>', mock_request)
+          >>> mock_view.assert_called_with('<context>', mock_request)
+          >>> mock_request.cache_key.assert_called_with('<instance>')
+          >>> response.etag == etag
+          True
+
+      Unless the etag matches::
+
+          >>> mock_view.reset_mock()
+          >>> mock_request.if_none_match = [etag]
+          >>> response = view('<context>', mock_request)
+          >>> response.status_int, response.etag == etag
+          (304, True)
+          >>> mock_view.called
+          False
+
+      The etag is salted and the ``Vary`` and ``Cache-Control`` headers are
+      set on the ``304``, as they would be on the full response::
+
+          >>> mock_request.registry.settings = {'alkey.etag_salt': 'v2'}
+          >>> mock_view.return_value.headers = {}
+          >>> decorator = conditional_view(lambda request: ('<instance>',),
+          ...         salt='json', vary=('Accept',), cache_control='max-age=60')
+          >>> view = decorator(mock_view)
+          >>> response = view('<context>', mock_request)
+          >>> response.etag == etag, response.vary
+          (False, ('Accept',))
+          >>> mock_request.if_none_match = [get_etag(u'token/alkey:users#1',
+          ...         salt=u'v2/json')]
+          >>> response = view('<context>', mock_request)
+          >>> response.status_int, response.vary
+          (304, ('Accept',))
+          >>> response.headers['Cache-Control']
+          'max-age=60'
+
+    """
+
+    # Compose.
+    if get_generator is None:
+        get_generator = lambda request: request.cache_key
+    if get_settings is None:
+        get_settings = lambda request: request.registry.settings or {}
+    if make_etag is None:
+        make_etag = get_etag
+    if methods is None:
+        methods = CONDITIONAL_METHODS
+    if not_modified_cls is None:
+        not_modified_cls = HTTPNotModified
+
+    def decorator(view):
+        def wrapper(context, request):
+            if request.method not in methods:
+                return view(context, request)
+            generator = get_generator(request)
+            cache_key = generator(*get_args(request))
+            etag = make_etag(cache_key, salt=get_salt(get_settings(request),
+                    salt=salt))
+            if etag in request.if_none_match:
+                response = not_modified_cls()
+            else:
+                response = view(context, request)
+            response.etag = etag
+            if vary is not None:
+                response.vary = vary
+            if cache_control is not None:
+                response.headers['Cache-Control'] = cache_control
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``TrackingPolicy``, which decides which changes are recorded and
+  which commits bump the global write token, so that high churn tables that
+  are never cached (audit logs, sessions, job queues, counters, etc.) don't
+  cost any token writes or changed set traffic.
+
+  Exclude a mapped class by declaring ``__alkey_track__ = False`` and stop its
+  changes from bumping the global write token with ``__alkey_global__ =
+  False``, e.g.::
+
+      class AuditLog(Base):
+          __tablename__ = 'audit_logs'
+          __alkey_track__ = False
+
+      class Counter(Base):
+          __tablename__ = 'counters'
+          __alkey_global__ = False
+
+  Or list tablenames in the ``alkey.policy.untracked`` and
+  ``alkey.policy.no_global`` settings (which an explicit ``True`` class
+  attribute overrides). The changes to untracked tables are ignored, apart
+  from the parents that their instances declare in ``__alkey_parents__``.
+  Commits only skip the global write token if *all* of the tables they
+  invalidate opt out of it.
+"""
+
+__all__ = [
+    'TrackingPolicy',
+    'declare',
+    'default_policy',
+    'get_tracking_policy',
+    'handle_configured',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+from .utils import unpack_object_id
+
+# Maps tablenames to the ``{'track': ..., 'global': ...}`` declared by their
+# mapped classes and records the classes that have been looked at.
+declarations = {}
+declared_classes = set()
+
+def declare(cls, registry=None, seen=None):
+    """Record the ``__alkey_track__`` and ``__alkey_global__`` declared on a
+      mapped ``cls``::
+
+          >>> AuditLog = type('AuditLog', (object,), {
+          ...         '__tablename__': 'audit_logs', '__alkey_track__': False})
+          >>> registry = {}
+          >>> declare(AuditLog, registry=registry, seen=set())
+          >>> registry
+          {'audit_logs': {'track': False}}
+
+    """
+
+    # Compose.
+    if registry is None:
+        registry = declarations
+    if seen is None:
+        seen = declared_classes
+
+    if cls in seen:
+        return
+    seen.add(cls)
+    tablename = getattr(cls, '__tablename__', None)
+    if tablename is None:
+        return
+    declared = {}
+    for attr, name in (('__alkey_track__', 'track'),
+            ('__alkey_global__', 'global')):
+        value = getattr(cls, attr, None)
+        if value is not None:
+            declared[name] = bool(value)
+    if declared:
+        registry.setdefault(tablename, {}).update(declared)
+
+def handle_configured(mapper, cls):
+    """Record the class' declarations as soon as its mapper is configured,
+      i.e.: before any of its changes are seen.
+    """
+
+    declare(cls)
+
+
+class TrackingPolicy(object):
+    """Filter changes by table.
+
+      Setup::
+
+          >>> registry = {'sessions': {'track': True}}
+          >>> policy = TrackingPolicy(untracked=['audit_logs', 'sessions'],
+          ...         no_global=['counters'], registry=registry)
+
+      Filters instances, classes, object ids and tablenames, with the class
+      declarations overriding the settings::
+
+          >>> policy.filter([u'alkey:users#1', u'alkey:audit_logs#*',
+          ...         u'alkey:sessions#1', u'counters'])
+          [u'alkey:users#1', u'alkey:sessions#1', u'counters']
+
+      Commits bump the global write token unless all of their tables opt out::
+
+          >>> policy.bumps_global([u'counters'])
+          False
+          >>> policy.bumps_global([u'counters', u'users'])
+          True
+
+    """
+
+    def __init__(self, untracked=(), no_global=(), registry=None,
+            declare_=None):
+        # Compose.
+        if registry is None:
+            registry = declarations
+        if declare_ is None:
+            declare_ = declare
+
+        # Assign.
+        self.untracked = set(untracked)
+        self.no_global = set(no_global)
+        self.registry = registry
+        self.declare = declare_
+
+    def get_tablename(self, item):
+        """Return the tablename of an instance, class, oid or tablename."""
+
+        if isinstance(item, basestring):
+            return unpack_object_id(item)[0] if u'#' in item else item
+        self.declare(item if isinstance(item, type) else type(item))
+        return getattr(item, '__tablename__', None)
+
+    def is_declared(self, tablename, name, default):
+        declared = self.registry.get(tablename)
+        if declared is not None and name in declared:
+            return declared[name]
+        return default
+
+    def tracks(self, item):
+        tablename = self.get_tablename(item)
+        return self.is_declared(tablename, 'track',
+                tablename not in self.untracked)
+
+    def filter(self, items):
+        return [item for item in items if self.tracks(item)]
+
+    def bumps_global(self, tablenames):
+        """Return whether a commit that invalidates ``tablenames`` should
+          bump the global write token.
+        """
+
+        if not tablenames:
+            return True
+        return any(self.is_declared(item, 'global', item not in self.no_global)
+                for item in tablenames)
+
+
+# Used by the handlers when they're not given a policy, i.e.: just applies
+# the class declarations.
+default_policy = TrackingPolicy()
+
+def get_tracking_policy(settings, policy_cls=None):
+    """Return a ``TrackingPolicy`` configured with the whitespace separated
+      ``alkey.policy.untracked`` and ``alkey.policy.no_global`` tablenames,
+      or ``None`` if neither are set::
+
+          >>> get_tracking_policy({})
+          >>> policy = get_tracking_policy({
+          ...         'alkey.policy.untracked': 'audit_logs sessions'})
+          >>> sorted(policy.untracked), policy.no_global
+          (['audit_logs', 'sessions'], set([]))
+
+    """
+
+    # Compose.
+    if policy_cls is None:
+        policy_cls = TrackingPolicy
+
+    untracked = settings.get('alkey.policy.untracked', u'').split()
+    no_global = settings.get('alkey.policy.no_global', u'').split()
+    if not untracked and not no_global:
+        return None
+    return policy_cls(untracked=untracked, no_global=no_global)
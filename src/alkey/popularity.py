@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``PopularityTracker``, which samples token reads into a decaying
+  Redis sorted set, ``PopularityRedis``, a redis client that samples the token
+  reads made through it, and ``Warmer``, which periodically reads the most
+  popular tokens in one batch, e.g.: to warm a new worker's local token cache
+  (see ``alkey.tracking`` and ``alkey.host_table``) after a deploy.
+
+  In a Pyramid app, ``config.include('alkey')`` starts each process' warmer
+  on its first request (i.e.: after any fork). Otherwise, e.g.: in a post
+  fork hook::
+
+      start_warmer(get_redis_client(), settings)
+
+  The warm up reads go through the client (bypassing the sampling), so they
+  fill whichever local token cache it's configured with. Without one, warming
+  would just read the tokens from Redis, so reads are only sampled when a
+  local token cache is configured. Scores are halved every ``half_life``
+  seconds (by whichever process gets there first) and the set is trimmed to
+  the ``max_size`` most popular tokens.
+"""
+
+__all__ = [
+    'PopularityPipeline',
+    'PopularityRedis',
+    'PopularityTracker',
+    'Warmer',
+    'get_popularity_tracker',
+    'handle_new_request',
+    'has_local_cache',
+    'start_warmer',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import random
+import threading
+import time
+
+import redis
+from redis.exceptions import RedisError
+
+from .cluster import is_cluster
+from .cluster import mget_by_slot
+from .utils import as_bool
+from .utils import is_token_read
+
+# The key of the sorted set of token keys, scored by popularity.
+POPULARITY_KEY = 'alkey.popularity.TOKENS'
+
+# The warmers started by ``handle_new_request``, by process id.
+warmers = {}
+warmers_lock = threading.Lock()
+
+def has_local_cache(settings):
+    """Do the ``settings`` configure a local token cache for the warm up
+      reads to fill?
+
+          >>> has_local_cache({'alkey.tracking': 'true'})
+          True
+          >>> has_local_cache({'alkey.tracking': 'true', 'alkey.buckets': 'true'})
+          False
+          >>> has_local_cache({})
+          False
+
+    """
+
+    if as_bool(settings.get('alkey.buckets', False)):
+        return False
+    return bool(settings.get('alkey.host_table', None) or
+            as_bool(settings.get('alkey.tracking', False)))
+
+class PopularityTracker(object):
+    """Sample token reads into a sorted set.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> mock_client = Mock()
+          >>> pipeline = mock_client.pipeline.return_value
+          >>> tracker = PopularityTracker(mock_client, sample_rate=0.5,
+          ...         get_random=lambda: 0.25)
+
+      Counts the sampled keys, scaled by the sample rate::
+
+          >>> tracker.record(['a', 'b'])
+          >>> pipeline.zincrby.assert_called_with(POPULARITY_KEY, 2.0, 'b')
+
+      Decays the scores once per half life::
+
+          >>> mock_client.set.return_value = True
+          >>> tracker.decay()
+          True
+          >>> mock_client.zunionstore.assert_called_with(POPULARITY_KEY,
+          ...         {POPULARITY_KEY: 0.5})
+
+    """
+
+    def __init__(self, redis_client, sample_rate=0.01, half_life=3600,
+            max_size=10000, key=None, get_random=None):
+        # Compose.
+        if key is None:
+            key = POPULARITY_KEY
+        if get_random is None:
+            get_random = random.random
+
+        # Assign.
+        self.redis = redis_client
+        self.sample_rate = sample_rate
+        self.half_life = half_life
+        self.max_size = max_size
+        self.key = key
+        self.get_random = get_random
+
+    def record(self, keys):
+        """Sample the read of ``keys``."""
+
+        if not keys or self.get_random() >= self.sample_rate:
+            return
+        pipeline = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipeline.zincrby(self.key, 1.0 / self.sample_rate, key)
+        try:
+            pipeline.execute()
+        except RedisError as err:
+            logger.warn(err, exc_info=True)
+
+    def decay(self):
+        """Halve the scores and trim the set, unless another process has done
+          so within the last ``half_life`` seconds.
+        """
+
+        decay_key = u'{0}:DECAYED'.format(self.key)
+        if not self.redis.set(decay_key, 1, nx=True, ex=self.half_life):
+            return False
+        self.redis.zunionstore(self.key, {self.key: 0.5})
+        self.redis.zremrangebyrank(self.key, 0, -(self.max_size + 1))
+        return True
+
+    def top(self, count):
+        """Return the ``count`` most popular token keys."""
+
+        return self.redis.zrevrange(self.key, 0, count - 1)
+
+
+class PopularityRedis(redis.StrictRedis):
+    """Sample the token reads made through the ``inner`` client::
+
+          >>> from mock import Mock
+          >>> inner = Mock()
+          >>> popularity = Mock()
+          >>> client = PopularityRedis(inner, popularity)
+          >>> key = u'alkey.cache.TOKENS:alkey:users#1'
+          >>> return_value = client.get(key)
+          >>> inner.execute_command.assert_called_with('GET', key)
+          >>> popularity.record.assert_called_with((key,))
+          >>> return_value = client.smembers('alkey.handle.CHANGED:{1}')
+          >>> popularity.record.call_count
+          1
+
+      Including the reads made in pipelines, e.g.: by ``mget_by_slot``::
+
+          >>> pipeline = client.pipeline(transaction=False)
+          >>> pipeline.mget([key]).mget(['{a}b']) # doctest: +ELLIPSIS
+          PopularityPipeline<...>
+          >>> return_value = pipeline.execute()
+          >>> popularity.record.assert_called_with([key])
+
+    """
+
+    def __init__(self, inner, popularity, is_token_read_=None):
+        # Compose.
+        if is_token_read_ is None:
+            is_token_read_ = is_token_read
+
+        # Assign.
+        self.inner = inner
+        self.popularity = popularity
+        self.is_token_read = is_token_read_
+        self.response_callbacks = {}
+        self.connection = None
+
+    def __repr__(self):
+        return '{0}<{1!r}>'.format(type(self).__name__, self.inner)
+
+    def execute_command(self, *args, **options):
+        if self.is_token_read(args):
+            self.popularity.record(args[1:])
+        return self.inner.execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        inner = self.inner.pipeline(transaction=transaction, shard_hint=shard_hint)
+        return PopularityPipeline(inner, self.popularity,
+                is_token_read_=self.is_token_read)
+
+    def scan_iter(self, match=None, count=None):
+        return self.inner.scan_iter(match=match, count=count)
+
+
+class PopularityPipeline(PopularityRedis):
+    """Buffer the token reads queued on the ``inner`` pipeline and sample
+      them (as one read) when it's executed.
+    """
+
+    def __init__(self, inner, popularity, is_token_read_=None):
+        super(PopularityPipeline, self).__init__(inner, popularity,
+                is_token_read_=is_token_read_)
+        self.keys = []
+
+    def execute_command(self, *args, **options):
+        if self.is_token_read(args):
+            self.keys.extend(args[1:])
+        self.inner.execute_command(*args, **options)
+        return self
+
+    def execute(self, raise_on_error=True):
+        keys, self.keys = self.keys, []
+        results = self.inner.execute(raise_on_error=raise_on_error)
+        if keys:
+            self.popularity.record(keys)
+        return results
+
+    def reset(self):
+        self.keys = []
+        self.inner.reset()
+
+
+class Warmer(object):
+    """Read the ``count`` most popular tokens through ``redis_client`` every
+      ``interval`` seconds, ``batch_size`` at a time::
+
+          >>> from mock import Mock
+          >>> mock_client = Mock(spec=['mget'])
+          >>> popularity = Mock()
+          >>> popularity.top.return_value = ['a', 'b', 'c']
+          >>> warmer = Warmer(mock_client, popularity, count=3, batch_size=2)
+          >>> warmer.warm()
+          3
+          >>> mock_client.mget.assert_called_with(['c'])
+
+    """
+
+    def __init__(self, redis_client, popularity, count=1000, interval=300,
+            delay=1, batch_size=1000, sleep=None):
+        # Compose.
+        if sleep is None:
+            sleep = time.sleep
+
+        # Assign.
+        self.redis = redis_client
+        self.popularity = popularity
+        self.count = count
+        self.interval = interval
+        self.delay = delay
+        self.batch_size = batch_size
+        self.sleep = sleep
+        self.stopped = False
+        self.thread = None
+
+    def warm(self):
+        """Read the most popular tokens, returning how many were read."""
+
+        keys = self.popularity.top(self.count)
+        cluster = is_cluster(self.redis)
+        for i in range(0, len(keys), self.batch_size):
+            batch = keys[i:i + self.batch_size]
+            if cluster:
+                mget_by_slot(self.redis, batch)
+            else:
+                self.redis.mget(batch)
+        return len(keys)
+
+    def run(self):
+        """Wait for ``delay`` seconds, e.g.: for the local token cache to
+          connect, and then decay the scores and warm every ``interval``.
+        """
+
+        self.sleep(self.delay)
+        while not self.stopped:
+            try:
+                self.popularity.decay()
+                count = self.warm()
+                logger.debug(u'Warmed {0} tokens.'.format(count))
+            except RedisError as err:
+                logger.warn(err, exc_info=True)
+            self.sleep(self.interval)
+
+    def start(self):
+        """Start warming in a daemon thread."""
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+
+
+def get_popularity_tracker(redis_client, settings, tracker_cls=None):
+    """Return a ``PopularityTracker`` for ``redis_client``, configured by the
+      ``alkey.popularity.sample_rate``, ``alkey.popularity.half_life`` and
+      ``alkey.popularity.max_size`` settings::
+
+          >>> from mock import Mock
+          >>> mock_tracker_cls = Mock()
+          >>> settings = {'alkey.popularity.sample_rate': '0.1'}
+          >>> tracker = get_popularity_tracker('<client>', settings,
+          ...         tracker_cls=mock_tracker_cls)
+          >>> mock_tracker_cls.assert_called_with('<client>', sample_rate=0.1,
+          ...         half_life=3600, max_size=10000)
+
+    """
+
+    # Compose.
+    if tracker_cls is None:
+        tracker_cls = PopularityTracker
+
+    sample_rate = float(settings.get('alkey.popularity.sample_rate', 0.01))
+    half_life = int(settings.get('alkey.popularity.half_life', 3600))
+    max_size = int(settings.get('alkey.popularity.max_size', 10000))
+    return tracker_cls(redis_client, sample_rate=sample_rate,
+            half_life=half_life, max_size=max_size)
+
+def handle_new_request(event, get_redis=None, start=None, getpid=None,
+        started=None):
+    """Start the current process' ``Warmer`` on its first request::
+
+          >>> from mock import Mock
+          >>> mock_start = Mock()
+          >>> mock_event = Mock()
+          >>> mock_kwargs = dict(get_redis=lambda request: '<client>',
+          ...         start=mock_start, getpid=lambda: 1, started={})
+          >>> handle_new_request(mock_event, **mock_kwargs)
+          >>> handle_new_request(mock_event, **mock_kwargs)
+          >>> mock_start.call_count
+          1
+
+    """
+
+    # Compose.
+    if get_redis is None: #pragma: no cover
+        # Imported here, as the client factory uses ``PopularityRedis``.
+        from .client import get_redis_client as get_redis
+    if start is None: #pragma: no cover
+        start = start_warmer
+    if getpid is None: #pragma: no cover
+        getpid = os.getpid
+    if started is None: #pragma: no cover
+        started = warmers
+
+    pid = getpid()
+    if pid in started:
+        return
+    with warmers_lock:
+        if pid in started:
+            return
+        request = event.request
+        started[pid] = start(get_redis(request), request.registry.settings)
+
+def start_warmer(redis_client, settings, warmer_cls=None):
+    """Start a ``Warmer`` for a ``redis_client`` that samples its token reads,
+      configured by the ``alkey.popularity.warm_count`` and
+      ``alkey.popularity.warm_interval`` settings. Returns ``None`` if the
+      client doesn't sample its token reads::
+
+          >>> from mock import Mock
+          >>> mock_warmer_cls = Mock()
+          >>> client = PopularityRedis('<inner>', '<popularity>')
+          >>> warmer = start_warmer(client, {}, warmer_cls=mock_warmer_cls)
+          >>> mock_warmer_cls.assert_called_with('<inner>', '<popularity>',
+          ...         count=1000, interval=300)
+          >>> warmer.start.called
+          True
+          >>> start_warmer('<client>', {})
+
+    """
+
+    # Compose.
+    if warmer_cls is None:
+        warmer_cls = Warmer
+
+    if not isinstance(redis_client, PopularityRedis):
+        return None
+    count = int(settings.get('alkey.popularity.warm_count', 1000))
+    interval = int(settings.get('alkey.popularity.warm_interval', 300))
+    warmer = warmer_cls(redis_client.inner, redis_client.popularity,
+            count=count, interval=interval)
+    warmer.start()
+    return warmer
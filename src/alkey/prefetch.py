@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``TokenPrefetcher``, which collects the oids of the instances
+  that a request loads from the db and then reads all of their tokens in one
+  batch -- on the first cache key generation, before rendering or, in
+  ``background`` mode, on a worker thread whilst the request carries on
+  querying -- so the token reads overlap with (rather than add to) the
+  query time.
+
+  Enable with ``alkey.prefetch = true`` (and, optionally,
+  ``alkey.prefetch.background = true``). The ORM's ``load`` and ``refresh``
+  events then register each instance with the current request's prefetcher,
+  which ``request.cache_key`` reads its tokens through. The prefetched tokens
+  are dropped when a session commits, as the commit may have invalidated them.
+
+  Prefetching only reads the tokens that exist, so loading many rows doesn't
+  write a token for each of them. The missing tokens are created when (and
+  if) the oids are actually used in a cache key.
+
+  Outside of a request, e.g.: in a worker, use a prefetcher directly::
+
+      prefetcher = TokenPrefetcher(redis_client)
+      for item in items:
+          prefetcher.register(item)
+      generator = CacheKeyGenerator(redis_client,
+              get_tokens_=prefetcher.get_tokens)
+"""
+
+__all__ = [
+    'TokenPrefetcher',
+    'bind',
+    'get_token_prefetcher',
+    'handle_before_render',
+    'handle_commit',
+    'handle_load',
+    'handle_refresh',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import threading
+from multiprocessing.pool import ThreadPool
+
+from redis.exceptions import RedisError
+
+from .cache import get_tokens
+from .cache import read_tokens
+from .client import get_redis_client
+from .constants import PREFETCHER_KEY
+from .handle import get_current_request
+from .utils import as_bool
+from .utils import get_object_id
+from .utils import valid_object_id
+
+# The thread pools that background prefetches run on, by size.
+shared_pools = {}
+
+class TokenPrefetcher(object):
+    """Read the tokens of the registered instances in one batch.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> mock_read_tokens = Mock()
+          >>> mock_read_tokens.side_effect = lambda client, oids: [
+          ...         u'token:{0}'.format(oid[-1]) for oid in oids]
+          >>> mock_get_tokens = Mock()
+          >>> prefetcher = TokenPrefetcher('<redis>', get_tokens_=mock_get_tokens,
+          ...         read_tokens_=mock_read_tokens)
+          >>> prefetcher.register(u'alkey:users#1')
+          >>> prefetcher.register(u'alkey:users#2')
+          >>> prefetcher.register('not an oid')
+
+      Reads the registered tokens, plus any others requested, in one go::
+
+          >>> prefetcher.get_tokens('<redis>', [u'alkey:users#2', u'alkey:*#*'])
+          [u'token:2', u'token:*']
+          >>> mock_read_tokens.call_args[0][1]
+          [u'alkey:users#1', u'alkey:users#2', u'alkey:*#*']
+
+      Then serves the prefetched tokens without reading them again::
+
+          >>> prefetcher.get_tokens('<redis>', [u'alkey:users#1'])
+          [u'token:1']
+          >>> mock_read_tokens.call_count
+          1
+
+      Until they're cleared, e.g.: by a commit::
+
+          >>> prefetcher.clear()
+          >>> prefetcher.get_tokens('<redis>', [u'alkey:users#1'])
+          [u'token:1']
+          >>> mock_read_tokens.call_count
+          2
+
+      The prefetch doesn't store tokens for the oids that don't have one.
+      They're only created for the oids that are asked for::
+
+          >>> mock_read_tokens.side_effect = lambda client, oids: [None] * len(oids)
+          >>> mock_get_tokens.return_value = [u'new']
+          >>> prefetcher.register(u'alkey:users#3')
+          >>> prefetcher.get_tokens('<redis>', [u'alkey:users#4'])
+          [u'new']
+          >>> mock_get_tokens.call_args[0][1]
+          [u'alkey:users#4']
+
+    """
+
+    def __init__(self, redis_client, pool=None, get_tokens_=None,
+            read_tokens_=None, get_oid=None):
+        """If a thread ``pool`` is provided, ``prefetch`` reads the tokens
+          in the background. The tokens are read with ``read_tokens_`` and
+          the missing ones that are asked for created with ``get_tokens_``.
+        """
+
+        # Compose.
+        if get_tokens_ is None:
+            get_tokens_ = get_tokens
+        if read_tokens_ is None:
+            read_tokens_ = read_tokens
+        if get_oid is None:
+            get_oid = get_object_id
+
+        # Assign.
+        self.redis = redis_client
+        self.pool = pool
+        self.create_tokens = get_tokens_
+        self.read_tokens = read_tokens_
+        self.get_oid = get_oid
+        self.lock = threading.Lock()
+        self.pending = []
+        self.registered = set()
+        self.tokens = {}
+        self.generation = 0
+        self.inflight = None
+
+    def register(self, instance):
+        """Register an instance (or oid) whose token will be needed."""
+
+        oid = self.get_oid(instance)
+        if not isinstance(oid, unicode) or not valid_object_id.match(oid):
+            return
+        with self.lock:
+            if oid in self.registered:
+                return
+            self.registered.add(oid)
+            self.pending.append(oid)
+
+    def fetch(self, extra=None):
+        """Read the tokens of the pending oids (plus the ``extra`` oids) in
+          one batch, returning a dict of the tokens that exist.
+        """
+
+        with self.lock:
+            oids, self.pending = self.pending, []
+            generation = self.generation
+        if extra:
+            seen = set(oids)
+            oids.extend(oid for oid in extra if oid not in seen)
+        if not oids:
+            return {}
+        values = self.read_tokens(self.redis, oids)
+        tokens = dict((k, v) for k, v in zip(oids, values) if v is not None)
+        self.remember(tokens, generation)
+        return tokens
+
+    def remember(self, tokens, generation):
+        with self.lock:
+            # Don't keep tokens that were read before a commit.
+            if generation == self.generation:
+                self.tokens.update(tokens)
+
+    def run(self):
+        """Fetch in the background, until there's nothing pending."""
+
+        try:
+            while self.pending:
+                self.fetch()
+        except RedisError as err:
+            logger.warn(err, exc_info=True)
+        finally:
+            with self.lock:
+                self.inflight = None
+
+    def prefetch(self):
+        """Read the pending tokens: in the background, if there's a thread
+          pool (and a background fetch isn't already running), or now.
+        """
+
+        if self.pool is None:
+            try:
+                self.fetch()
+            except RedisError as err:
+                logger.warn(err, exc_info=True)
+            return
+        with self.lock:
+            if self.inflight is not None or not self.pending:
+                return
+            self.inflight = self.pool.apply_async(self.run)
+
+    def wait(self):
+        inflight = self.inflight
+        if inflight is not None:
+            inflight.wait()
+
+    def get_tokens(self, redis_client, oids):
+        """A drop in replacement for ``alkey.cache.get_tokens``, that serves
+          the prefetched tokens, reading the rest in one batch along with any
+          that are still pending and then creating the ones that are missing.
+        """
+
+        self.wait()
+        with self.lock:
+            tokens = dict(self.tokens)
+            generation = self.generation
+        missing = [oid for oid in oids if oid not in tokens]
+        if missing or self.pending:
+            try:
+                tokens.update(self.fetch(extra=missing))
+            except RedisError as err:
+                logger.warn(err, exc_info=True)
+            missing = [oid for oid in oids if oid not in tokens]
+        if missing:
+            created = dict(zip(missing, self.create_tokens(redis_client, missing)))
+            self.remember(created, generation)
+            tokens.update(created)
+        return [tokens[oid] for oid in oids]
+
+    def clear(self):
+        """Drop the prefetched tokens and forget the registered oids."""
+
+        with self.lock:
+            self.generation += 1
+            self.tokens = {}
+            self.registered = set()
+            self.pending = []
+
+
+def get_token_prefetcher(request, key=None, get_redis=None, prefetcher_cls=None):
+    """Return the ``request``'s ``TokenPrefetcher``, creating it if
+      ``alkey.prefetch`` is set, or ``None``::
+
+          >>> from mock import Mock
+          >>> request = Mock()
+          >>> request.environ = {}
+          >>> request.registry.settings = {}
+          >>> get_token_prefetcher(request)
+          >>> get_token_prefetcher(None)
+          >>> request.registry.settings = {'alkey.prefetch': 'true'}
+          >>> prefetcher = get_token_prefetcher(request,
+          ...         get_redis=lambda request: '<redis>')
+          >>> prefetcher.redis, prefetcher.pool
+          ('<redis>', None)
+          >>> get_token_prefetcher(request) is prefetcher
+          True
+
+      With ``alkey.prefetch.background``, tokens are prefetched on a shared
+      pool of ``alkey.prefetch.threads`` threads (default ``4``).
+    """
+
+    # Compose.
+    if key is None:
+        key = PREFETCHER_KEY
+    if get_redis is None: #pragma: no cover
+        get_redis = get_redis_client
+    if prefetcher_cls is None:
+        prefetcher_cls = TokenPrefetcher
+
+    if request is None:
+        return None
+    prefetcher = request.environ.get(key)
+    if prefetcher is not None:
+        return prefetcher
+    settings = request.registry.settings
+    if not as_bool(settings.get('alkey.prefetch', False)):
+        return None
+    pool = None
+    if as_bool(settings.get('alkey.prefetch.background', False)):
+        threads = int(settings.get('alkey.prefetch.threads', 4))
+        if threads not in shared_pools:
+            shared_pools[threads] = ThreadPool(threads)
+        pool = shared_pools[threads]
+    prefetcher = prefetcher_cls(get_redis(request), pool=pool)
+    request.environ[key] = prefetcher
+    return prefetcher
+
+def handle_load(target, context, get_request=None, get_prefetcher=None):
+    """Register an instance that's been loaded with the current request's
+      prefetcher, prefetching in the background if configured to::
+
+          >>> from mock import Mock
+          >>> mock_prefetcher = Mock()
+          >>> mock_kwargs = dict(get_request=lambda: '<request>',
+          ...         get_prefetcher=lambda request: mock_prefetcher)
+          >>> handle_load('<instance>', '<context>', **mock_kwargs)
+          >>> mock_prefetcher.register.assert_called_with('<instance>')
+          >>> mock_prefetcher.pool = None
+          >>> handle_load('<instance>', '<context>', **mock_kwargs)
+          >>> mock_prefetcher.prefetch.call_count
+          1
+
+    """
+
+    # Compose.
+    if get_request is None: #pragma: no cover
+        get_request = get_current_request
+    if get_prefetcher is None: #pragma: no cover
+        get_prefetcher = get_token_prefetcher
+
+    prefetcher = get_prefetcher(get_request())
+    if prefetcher is None:
+        return
+    prefetcher.register(target)
+    if prefetcher.pool is not None:
+        prefetcher.prefetch()
+
+def handle_refresh(target, context, attrs, **kwargs):
+    """Register an instance that's been refreshed, e.g.: after a commit
+      expired it.
+    """
+
+    handle_load(target, context, **kwargs)
+
+def handle_before_render(event, get_prefetcher=None):
+    """Read the pending tokens before a template is rendered::
+
+          >>> from mock import Mock
+          >>> mock_event = {'request': '<request>'}
+          >>> mock_prefetcher = Mock()
+          >>> handle_before_render(mock_event,
+          ...         get_prefetcher=lambda request: mock_prefetcher)
+          >>> mock_prefetcher.prefetch.called
+          True
+
+    """
+
+    # Compose.
+    if get_prefetcher is None: #pragma: no cover
+        get_prefetcher = get_token_prefetcher
+
+    prefetcher = get_prefetcher(event.get('request'))
+    if prefetcher is not None:
+        prefetcher.prefetch()
+
+def handle_commit(session, get_request=None, key=None):
+    """Clear the current request's prefetched tokens, if any, as the commit
+      may have invalidated them::
+
+          >>> from mock import Mock
+          >>> request = Mock()
+          >>> request.environ = {PREFETCHER_KEY: Mock()}
+          >>> handle_commit('<session>', get_request=lambda: request)
+          >>> request.environ[PREFETCHER_KEY].clear.called
+          True
+
+    """
+
+    # Compose.
+    if get_request is None: #pragma: no cover
+        get_request = get_current_request
+    if key is None:
+        key = PREFETCHER_KEY
+
+    request = get_request()
+    if request is None:
+        return
+    prefetcher = request.environ.get(key)
+    if prefetcher is not None:
+        prefetcher.clear()
+
+def bind(session_cls, event=None, mapper_cls=None, load=None, refresh=None,
+        commit=None):
+    """Register the instances loaded by any mapper and clear the prefetched
+      tokens when a ``session_cls`` session commits::
+
+          >>> from mock import Mock
+          >>> mock_event = Mock()
+          >>> bind('session', event=mock_event, mapper_cls='mapper',
+          ...         load='handle_load', refresh='handle_refresh',
+          ...         commit='handle_commit')
+          >>> mock_event.listen.assert_any_call('mapper', 'load', 'handle_load')
+          >>> mock_event.listen.assert_any_call('mapper', 'refresh',
+          ...         'handle_refresh')
+          >>> mock_event.listen.assert_any_call('session', 'after_commit',
+          ...         'handle_commit')
+
+    """
+
+    # Compose.
+    if event is None: #pragma: no cover
+        from sqlalchemy import event
+    if mapper_cls is None: #pragma: no cover
+        from sqlalchemy.orm import Mapper as mapper_cls
+    if load is None: #pragma: no cover
+        load = handle_load
+    if refresh is None: #pragma: no cover
+        refresh = handle_refresh
+    if commit is None: #pragma: no cover
+        commit = handle_commit
+
+    event.listen(mapper_cls, 'load', load)
+    event.listen(mapper_cls, 'refresh', refresh)
+    event.listen(session_cls, 'after_commit', commit)
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+"""Provides a `dogpile.cache <https://dogpilecache.sqlalchemy.org>`_
+  integration: key generators that run the function arguments through a
+  ``CacheKeyGenerator`` and a Redis backend that shares alkey's redis client,
+  e.g.::
+
+      region = get_cache_region(get_redis_client(), settings)
+
+      @region.cache_on_arguments()
+      def render_user(user):
+          ...
+
+      @region.cache_multi_on_arguments()
+      def render_users(*users):
+          ...
+
+  The keys for ``cache_multi_on_arguments`` are generated with one batched
+  token read and the values are read with one ``MGET``, using dogpile's
+  mutexes (a Redis lock when ``alkey.dogpile.distributed_lock`` is set) to
+  protect against stampedes.
+"""
+
+__all__ = [
+    'AlkeyRedisBackend',
+    'function_key_generator',
+    'function_multi_key_generator',
+    'get_cache_region',
+    'get_key_prefix',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import inspect
+
+from dogpile.cache import make_region
+from dogpile.cache import register_backend
+from dogpile.cache.backends.redis import RedisBackend
+
+from .cache import CacheKeyGenerator
+from .cache import get_generator_kwargs
+from .utils import as_bool
+
+BACKEND_NAME = 'alkey.redis'
+
+def get_key_prefix(namespace, fn):
+    """Return the first key segment for ``fn``, in the same format as dogpile's
+      default key generator::
+
+          >>> get_key_prefix(None, get_key_prefix)
+          u'alkey.region:get_key_prefix'
+          >>> get_key_prefix('users', get_key_prefix)
+          u'alkey.region:get_key_prefix|users'
+
+    """
+
+    prefix = u'{0}:{1}'.format(fn.__module__, fn.__name__)
+    if namespace is not None:
+        prefix = u'{0}|{1}'.format(prefix, namespace)
+    return prefix
+
+def has_self_arg(fn):
+    """Is the first argument of ``fn`` ``self`` or ``cls``?"""
+
+    args = inspect.getargspec(fn)[0]
+    return bool(args) and args[0] in ('self', 'cls')
+
+def function_key_generator(get_generator):
+    """Return a dogpile ``function_key_generator`` that generates keys with the
+      ``CacheKeyGenerator`` returned by ``get_generator()``::
+
+          >>> from mock import Mock
+          >>> mock_generator = Mock()
+          >>> mock_generator.return_value = u'key'
+          >>> factory = function_key_generator(lambda: mock_generator)
+          >>> generate_key = factory(None, get_key_prefix)
+          >>> generate_key('<instance>', 1)
+          u'key'
+          >>> mock_generator.assert_called_with(
+          ...         u'alkey.region:get_key_prefix', '<instance>', 1)
+
+    """
+
+    def factory(namespace, fn, **kw):
+        prefix = get_key_prefix(namespace, fn)
+        has_self = has_self_arg(fn)
+        def generate_key(*args, **kwargs):
+            if kwargs:
+                raise ValueError(u'Keyword arguments are not supported.')
+            if has_self:
+                args = args[1:]
+            return get_generator()(prefix, *args)
+        return generate_key
+    return factory
+
+def function_multi_key_generator(get_generator):
+    """Return a dogpile ``function_multi_key_generator`` that generates a key
+      for each argument, reading all of their tokens in one go::
+
+          >>> from mock import Mock
+          >>> mock_get_tokens = Mock()
+          >>> mock_get_tokens.return_value = [u'a', u'b']
+          >>> generator = CacheKeyGenerator(None, get_tokens_=mock_get_tokens)
+          >>> factory = function_multi_key_generator(lambda: generator)
+          >>> generate_keys = factory(None, get_key_prefix)
+          >>> generate_keys(u'alkey:users#1', u'alkey:users#2')
+          ... # doctest: +NORMALIZE_WHITESPACE
+          [u'alkey.region:get_key_prefix/a/alkey:users#1',
+           u'alkey.region:get_key_prefix/b/alkey:users#2']
+          >>> mock_get_tokens.call_count
+          1
+
+    """
+
+    def factory(namespace, fn, **kw):
+        prefix = get_key_prefix(namespace, fn)
+        has_self = has_self_arg(fn)
+        def generate_keys(*args, **kwargs):
+            if kwargs:
+                raise ValueError(u'Keyword arguments are not supported.')
+            if has_self:
+                args = args[1:]
+            generator = get_generator()
+            keys = [generator.lazy(prefix, arg) for arg in args]
+            return [unicode(key) for key in keys]
+        return generate_keys
+    return factory
+
+
+class AlkeyRedisBackend(RedisBackend):
+    """A dogpile Redis backend that uses the ``redis_client`` argument, e.g.:
+      alkey's redis client, rather than creating a client of its own::
+
+          >>> backend = AlkeyRedisBackend({'redis_client': '<client>'})
+          >>> backend.client
+          '<client>'
+
+    """
+
+    def __init__(self, arguments):
+        self.redis_client = arguments.get('redis_client', None)
+        super(AlkeyRedisBackend, self).__init__(arguments)
+
+    def _create_client(self):
+        if self.redis_client is not None:
+            return self.redis_client
+        return super(AlkeyRedisBackend, self)._create_client()
+
+register_backend(BACKEND_NAME, __name__, 'AlkeyRedisBackend')
+
+
+def get_cache_region(redis_client, settings=None, make_region_=None,
+        generator_cls=None):
+    """Return a dogpile cache region, backed by ``redis_client``, whose keys
+      are generated by a ``CacheKeyGenerator``. Expiry and locking are
+      configured using the ``alkey.dogpile.expiration_time`` (default one
+      hour), ``alkey.dogpile.redis_expiration_time`` (default twice the
+      expiration time) and ``alkey.dogpile.distributed_lock`` settings::
+
+          >>> from mock import Mock
+          >>> mock_make_region = Mock()
+          >>> settings = {'alkey.dogpile.expiration_time': '60'}
+          >>> region = get_cache_region('<client>', settings,
+          ...         make_region_=mock_make_region)
+          >>> args, kwargs = region.configure.call_args
+          >>> args, kwargs['expiration_time']
+          (('alkey.redis',), 60)
+          >>> sorted(kwargs['arguments'].items()) # doctest: +NORMALIZE_WHITESPACE
+          [('distributed_lock', True), ('lock_timeout', None),
+           ('redis_client', '<client>'), ('redis_expiration_time', 120),
+           ('thread_local_lock', False)]
+
+    """
+
+    # Compose.
+    if settings is None:
+        settings = {}
+    if make_region_ is None:
+        make_region_ = make_region
+    if generator_cls is None:
+        generator_cls = CacheKeyGenerator
+
+    generator_kwargs = get_generator_kwargs(settings)
+    get_generator = lambda: generator_cls(redis_client, **generator_kwargs)
+    region = make_region_(
+            function_key_generator=function_key_generator(get_generator),
+            function_multi_key_generator=function_multi_key_generator(
+                    get_generator))
+
+    expiration_time = int(settings.get('alkey.dogpile.expiration_time', 3600))
+    redis_expiration_time = int(settings.get(
+            'alkey.dogpile.redis_expiration_time', expiration_time * 2))
+    distributed_lock = as_bool(settings.get('alkey.dogpile.distributed_lock',
+            True))
+    lock_timeout = settings.get('alkey.dogpile.lock_timeout', None)
+    if lock_timeout is not None:
+        lock_timeout = int(lock_timeout)
+    region.configure(BACKEND_NAME, expiration_time=expiration_time,
+            arguments={
+                'redis_client': redis_client,
+                'redis_expiration_time': redis_expiration_time,
+                'distributed_lock': distributed_lock,
+                'thread_local_lock': not distributed_lock,
+                'lock_timeout': lock_timeout,
+            })
+    return region
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``Relay``, which consumes the change feed (see ``alkey.feed``) and
+  applies the token updates to one or more remote Redis targets, e.g.: the
+  Redis used by the read replicas of an application in another region::
+
+      reader = FeedReader(primary_client, 'alkey-relay', 'relay-1')
+      relay = Relay(reader, [remote_client], window=1, batch_size=1000)
+      relay.run()
+
+  Changes are accumulated for up to ``window`` seconds (or until there are
+  ``batch_size`` tokens to update), de-duplicating the oids, and are then
+  written to each target in one pipeline. The changes are only acknowledged
+  once they've been applied to all of the targets, so the consumer group
+  acts as a checkpoint: after a restart, the relay resumes with the changes
+  it hadn't finished applying.
+
+  The feed is capped, so if the relay is down or falls behind for long enough,
+  changes are trimmed before they're relayed. When that happens, which the
+  relay checks before each read, it logs an error and bumps the global write
+  token and all of the table tokens on every target, as it can't know which
+  tables were affected. Fragments keyed only on row tokens may still be stale.
+
+  Or use the ``alkey-relay`` console script::
+
+      alkey-relay --source redis://localhost:6379 --target redis://remote:6379
+"""
+
+__all__ = [
+    'Relay',
+    'main',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import argparse
+import socket
+import time
+from collections import OrderedDict
+
+import redis
+from redis.exceptions import RedisError
+
+from .cache import set_token
+from .constants import GLOBAL_WRITE_TOKEN
+from .constants import TOKEN_NAMESPACE
+from .feed import FeedReader
+from .utils import get_stamp
+from .utils import get_table_id
+
+class Relay(object):
+    """Apply the changes read by ``reader`` to the ``targets``.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> from alkey.feed import Change
+          >>> clock = [0]
+          >>> reader = Mock()
+          >>> reader.has_gap.return_value = False
+          >>> reader.read.return_value = [
+          ...     Change(u'1-0', u'a', [u'alkey:users#1'], [u'users']),
+          ...     Change(u'2-0', u'b', [u'alkey:users#1'], [u'users']),
+          ... ]
+          >>> target = Mock()
+          >>> pipeline = target.pipeline.return_value
+          >>> relay = Relay(reader, [target], window=1, now=lambda: clock[0])
+
+      Waits for the window to pass::
+
+          >>> relay.step()
+          0
+          >>> reader.read.return_value = []
+          >>> clock[0] = 1
+
+      Then applies the latest token for each oid and acknowledges the changes::
+
+          >>> relay.step()
+          3
+          >>> pipeline.setex.assert_any_call(
+          ...         u'alkey.cache.TOKENS:alkey:users#1', 86400, u'b')
+          >>> pipeline.setex.assert_any_call(
+          ...         u'alkey.cache.TOKENS:alkey:users#*', 86400, u'b')
+          >>> reader.ack.assert_called_with([u'1-0', u'2-0'])
+
+      Only bumping the global write token for the changes that bumped it::
+
+          >>> reader.read.return_value = [Change(u'3-0', u'c',
+          ...         [u'alkey:counters#1'], [u'counters'], False)]
+          >>> clock[0] = 2
+          >>> relay.step()
+          0
+          >>> clock[0] = 3
+          >>> reader.read.return_value = []
+          >>> relay.step()
+          2
+
+      If changes were trimmed from the feed before they were relayed, bumps
+      the global write token and the table tokens on every target::
+
+          >>> reader.has_gap.return_value = True
+          >>> target.scan_iter.return_value = [
+          ...         'alkey.cache.TOKENS:alkey:users#*']
+          >>> relay.get_value = lambda: u'new'
+          >>> relay.step()
+          0
+          >>> pipeline.setex.assert_any_call(
+          ...         u'alkey.cache.TOKENS:alkey:*#*', 86400, u'new')
+          >>> pipeline.setex.assert_any_call(
+          ...         u'alkey.cache.TOKENS:alkey:users#*', 86400, u'new')
+
+    """
+
+    def __init__(self, reader, targets, window=1, batch_size=1000,
+            retry_interval=5, store_value=None, table_oid=None,
+            global_token=None, get_value=None, namespace=None, now=None,
+            sleep=None):
+        # Compose.
+        if store_value is None:
+            store_value = set_token
+        if get_value is None:
+            get_value = get_stamp
+        if namespace is None:
+            namespace = TOKEN_NAMESPACE
+        if table_oid is None:
+            table_oid = get_table_id
+        if global_token is None:
+            global_token = GLOBAL_WRITE_TOKEN
+        if now is None:
+            now = time.time
+        if sleep is None:
+            sleep = time.sleep
+
+        # Assign.
+        self.reader = reader
+        self.targets = list(targets)
+        self.window = window
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.store_value = store_value
+        self.table_oid = table_oid
+        self.global_token = global_token
+        self.get_value = get_value
+        self.prefix = u'{0}:'.format(namespace)
+        self.now = now
+        self.sleep = sleep
+        self.reset()
+
+    def reset(self):
+        self.ids = []
+        self.tokens = OrderedDict()
+        self.started = None
+
+    def add(self, changes):
+        """Accumulate the ``changes``, keeping the latest token for each oid."""
+
+        for change in changes:
+            if self.started is None:
+                self.started = self.now()
+            self.ids.append(change.id)
+            oids = list(change.oids)
+            oids.extend(self.table_oid(item) for item in change.tables)
+            if change.bumps_global:
+                oids.append(self.global_token)
+            for oid in oids:
+                self.tokens.pop(oid, None)
+                self.tokens[oid] = change.token
+
+    def is_due(self):
+        """Should the accumulated changes be applied?"""
+
+        if not self.ids:
+            return False
+        if len(self.tokens) >= self.batch_size:
+            return True
+        return self.now() - self.started >= self.window
+
+    def flush(self):
+        """Apply the accumulated changes to all of the targets and then
+          acknowledge them, returning the number of tokens updated.
+        """
+
+        for target in self.targets:
+            pipeline = target.pipeline(transaction=False)
+            for oid, token in self.tokens.items():
+                self.store_value(pipeline, oid, token)
+            pipeline.execute()
+        self.reader.ack(self.ids)
+        count = len(self.tokens)
+        self.reset()
+        return count
+
+    def bump_all(self):
+        """Bump the global write token and the table tokens on all of the
+          targets.
+        """
+
+        value = self.get_value()
+        match = u'{0}{1}'.format(self.prefix, self.table_oid(u'*'))
+        match = match.replace(u'#*', u'#\\*')
+        for target in self.targets:
+            pipeline = target.pipeline(transaction=False)
+            self.store_value(pipeline, self.global_token, value)
+            for key in target.scan_iter(match=match):
+                key = key.decode('utf-8') if isinstance(key, str) else key
+                self.store_value(pipeline, key[len(self.prefix):], value)
+            pipeline.execute()
+
+    def step(self):
+        """Read the next changes, applying the accumulated changes if they're
+          due. Returns the number of tokens updated.
+        """
+
+        if self.reader.has_gap():
+            logger.error(u'Changes were trimmed from the feed before they '
+                    u'were relayed: bumping the global and table tokens.')
+            self.bump_all()
+        self.add(self.reader.read())
+        if self.is_due():
+            return self.flush()
+        return 0
+
+    def run(self, should_stop=None):
+        """Relay the changes until ``should_stop()`` returns ``True``, retrying
+          (without losing the accumulated changes) if Redis is unavailable.
+        """
+
+        # Compose.
+        if should_stop is None: #pragma: no cover
+            should_stop = lambda: False
+
+        while not should_stop():
+            try:
+                count = self.step()
+            except RedisError as err:
+                logger.warn(err, exc_info=True)
+                self.sleep(self.retry_interval)
+            else:
+                if count:
+                    logger.info(u'Relayed {0} tokens.'.format(count))
+
+
+def main(argv=None, client_cls=None, reader_cls=None, relay_cls=None):
+    """Command line entry point::
+
+          >>> from mock import Mock
+          >>> mock_client_cls = Mock()
+          >>> mock_reader_cls = Mock()
+          >>> mock_relay_cls = Mock()
+          >>> main(['--target', 'redis://a', '--target', 'redis://b',
+          ...         '--consumer', 'relay-1', '--window', '2'],
+          ...         client_cls=mock_client_cls, reader_cls=mock_reader_cls,
+          ...         relay_cls=mock_relay_cls)
+          0
+          >>> mock_reader_cls.call_args[0][1:], mock_reader_cls.call_args[1]
+          (('alkey-relay', 'relay-1'), {'block': 2000})
+          >>> args, kwargs = mock_relay_cls.call_args
+          >>> len(args[1]), kwargs
+          (2, {'window': 2.0, 'batch_size': 1000})
+          >>> mock_relay_cls.return_value.run.called
+          True
+
+    """
+
+    # Compose.
+    if client_cls is None: #pragma: no cover
+        client_cls = redis.StrictRedis
+    if reader_cls is None: #pragma: no cover
+        reader_cls = FeedReader
+    if relay_cls is None: #pragma: no cover
+        relay_cls = Relay
+
+    parser = argparse.ArgumentParser(description=u'Relay invalidations.')
+    parser.add_argument('--source', default='redis://localhost:6379')
+    parser.add_argument('--target', action='append', required=True,
+            help=u'The url of a remote Redis (can be given more than once).')
+    parser.add_argument('--group', default='alkey-relay',
+            help=u'The consumer group, i.e.: the checkpoint.')
+    parser.add_argument('--consumer', default=socket.gethostname())
+    parser.add_argument('--window', type=float, default=1,
+            help=u'Seconds to accumulate changes for.')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    source = client_cls.from_url(args.source)
+    targets = [client_cls.from_url(url) for url in args.target]
+    block = max(1, int(args.window * 1000))
+    reader = reader_cls(source, args.group, args.consumer, block=block)
+    relay = relay_cls(reader, targets, window=args.window,
+            batch_size=args.batch_size)
+    relay.run()
+    return 0
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``ReplicaRouter``, a redis client that sends token reads to read
+  replicas and everything else to the primary, e.g.::
+
+      replica_set = ReplicaSet([replica1, replica2], max_staleness=1)
+      client = ReplicaRouter(primary, replica_set)
+      client.get(u'alkey.cache.TOKENS:alkey:users#1') # reads from a replica
+
+  Replicas that have lost their link to the primary, or haven't heard from it
+  for more than ``max_staleness`` seconds, aren't used. Reads can also be
+  pinned to the primary, e.g.: for the rest of a request that's committed
+  changes, so that it sees its own writes. Reads that fail to connect or time
+  out are retried on the primary and the replica isn't used again until it's
+  next checked.
+"""
+
+__all__ = [
+    'ReplicaRouter',
+    'ReplicaSet',
+    'get_replica_set',
+    'is_pinned',
+    'pin_to_primary',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import random
+import threading
+import time
+
+import redis
+from redis.exceptions import ConnectionError
+from redis.exceptions import RedisError
+from redis.exceptions import TimeoutError
+
+from .constants import PRIMARY_PIN_KEY
+from .utils import is_token_read
+
+def pin_to_primary(request, key=None):
+    """Pin the rest of the ``request``'s token reads to the primary::
+
+          >>> from mock import Mock
+          >>> request = Mock()
+          >>> request.environ = {}
+          >>> pin_to_primary(request)
+          >>> is_pinned(request)
+          True
+          >>> is_pinned(None)
+          False
+
+    """
+
+    # Compose.
+    if key is None:
+        key = PRIMARY_PIN_KEY
+
+    if request is not None:
+        request.environ[key] = True
+
+def is_pinned(request, key=None):
+    """Have the ``request``'s token reads been pinned to the primary?"""
+
+    # Compose.
+    if key is None:
+        key = PRIMARY_PIN_KEY
+
+    if request is None:
+        return False
+    return bool(request.environ.get(key, False))
+
+
+class ReplicaSet(object):
+    """The read replicas of a primary, with a cached view of which of them are
+      fresh enough to read from.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> fresh = Mock()
+          >>> fresh.info.return_value = {'master_link_status': 'up',
+          ...         'master_last_io_seconds_ago': 0}
+          >>> stale = Mock()
+          >>> stale.info.return_value = {'master_link_status': 'up',
+          ...         'master_last_io_seconds_ago': 12}
+          >>> down = Mock()
+          >>> down.info.side_effect = redis.ConnectionError
+
+      Only chooses replicas within the staleness tolerance::
+
+          >>> replica_set = ReplicaSet([fresh, stale, down], max_staleness=1)
+          >>> replica_set.choose() is fresh
+          True
+          >>> replica_set = ReplicaSet([stale, down], max_staleness=1)
+          >>> replica_set.choose()
+
+      Checks each replica using its ``check_clients`` entry, e.g.: a client
+      with a short socket timeout, if given::
+
+          >>> replica_set = ReplicaSet([Mock()], check_clients=[fresh])
+          >>> replica_set.choose() is replica_set.clients[0]
+          True
+
+      Only one thread checks at a time, whilst the others carry on with the
+      previous healthy replicas::
+
+          >>> replica_set.checked = None
+          >>> replica_set.checking = True
+          >>> replica_set.healthy = []
+          >>> replica_set.choose()
+
+      Replicas that fail are dropped until the next check::
+
+          >>> replica_set.healthy = [fresh, stale]
+          >>> replica_set.mark_down(fresh)
+          >>> replica_set.healthy == [stale]
+          True
+
+    """
+
+    def __init__(self, clients, max_staleness=1, check_interval=1,
+            check_clients=None, now=None):
+        # Compose.
+        if check_clients is None:
+            check_clients = clients
+        if now is None:
+            now = time.time
+
+        # Assign.
+        self.clients = list(clients)
+        self.check_clients = list(check_clients)
+        self.max_staleness = max_staleness
+        self.check_interval = check_interval
+        self.now = now
+        self.healthy = []
+        self.checked = None
+        self.checking = False
+        self.lock = threading.Lock()
+
+    def is_fresh(self, client):
+        """Is ``client`` connected to its primary and up to date enough?"""
+
+        try:
+            info = client.info('replication')
+        except RedisError as err:
+            logger.warn(err, exc_info=True)
+            return False
+        if info.get('master_link_status') != 'up':
+            return False
+        if info.get('master_sync_in_progress'):
+            return False
+        last_io = info.get('master_last_io_seconds_ago', -1)
+        return 0 <= int(last_io) <= self.max_staleness
+
+    def is_due(self, now):
+        return self.checked is None or now - self.checked >= self.check_interval
+
+    def check(self):
+        """Refresh the healthy replicas, at most once per ``check_interval``.
+          The lock is only held to claim the check, so the replicas are asked
+          for their ``INFO`` by one thread without blocking the others.
+        """
+
+        now = self.now()
+        if not self.is_due(now):
+            return
+        with self.lock:
+            if self.checking or not self.is_due(now):
+                return
+            self.checking = True
+        try:
+            pairs = zip(self.clients, self.check_clients)
+            self.healthy = [item for item, check_client in pairs
+                    if self.is_fresh(check_client)]
+            self.checked = now
+        finally:
+            self.checking = False
+
+    def mark_down(self, client):
+        """Stop choosing ``client`` until the replicas are next checked."""
+
+        with self.lock:
+            self.healthy = [item for item in self.healthy if item is not client]
+
+    def choose(self):
+        """Return a healthy replica, or ``None`` if there isn't one."""
+
+        self.check()
+        healthy = self.healthy
+        if not healthy:
+            return None
+        return random.choice(healthy)
+
+
+class ReplicaRouter(redis.StrictRedis):
+    """Send token reads to a replica and everything else to the ``primary``.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> primary = Mock()
+          >>> replica = Mock()
+          >>> replica_set = Mock()
+          >>> replica_set.choose.return_value = replica
+          >>> key = u'alkey.cache.TOKENS:alkey:users#1'
+
+      Token reads go to the replica::
+
+          >>> client = ReplicaRouter(primary, replica_set)
+          >>> return_value = client.get(key)
+          >>> replica.execute_command.assert_called_with('GET', key)
+
+      Writes and non token reads go to the primary::
+
+          >>> return_value = client.setex(key, 60, 'token')
+          >>> primary.execute_command.assert_called_with('SETEX', key, 60, 'token')
+          >>> return_value = client.smembers('alkey.handle.CHANGED:{1}')
+          >>> primary.execute_command.assert_called_with('SMEMBERS',
+          ...         'alkey.handle.CHANGED:{1}')
+
+      As do all reads once pinned::
+
+          >>> client = ReplicaRouter(primary, replica_set, is_pinned=lambda: True)
+          >>> return_value = client.get(key)
+          >>> primary.execute_command.assert_called_with('GET', key)
+
+      Reads that fail on the replica are retried on the primary::
+
+          >>> primary.reset_mock()
+          >>> replica.execute_command.side_effect = redis.TimeoutError
+          >>> client = ReplicaRouter(primary, replica_set)
+          >>> return_value = client.get(key)
+          >>> primary.execute_command.assert_called_with('GET', key)
+          >>> replica_set.mark_down.assert_called_with(replica)
+
+    """
+
+    def __init__(self, primary, replica_set, is_pinned=None, is_token_read_=None):
+        # Compose.
+        if is_pinned is None:
+            is_pinned = lambda: False
+        if is_token_read_ is None:
+            is_token_read_ = is_token_read
+
+        # Assign.
+        self.primary = primary
+        self.replica_set = replica_set
+        self.is_pinned = is_pinned
+        self.is_token_read = is_token_read_
+        self.response_callbacks = {}
+        self.connection = None
+
+    def __repr__(self):
+        return '{0}<{1!r}>'.format(type(self).__name__, self.primary)
+
+    def get_client(self, args):
+        """Return the client to send the command in ``args`` to."""
+
+        if self.is_token_read(args) and not self.is_pinned():
+            replica = self.replica_set.choose()
+            if replica is not None:
+                return replica
+        return self.primary
+
+    def execute_command(self, *args, **options):
+        client = self.get_client(args)
+        if client is self.primary:
+            return client.execute_command(*args, **options)
+        try:
+            return client.execute_command(*args, **options)
+        except (ConnectionError, TimeoutError) as err:
+            logger.warn(err, exc_info=True)
+            self.replica_set.mark_down(client)
+        return self.primary.execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return self.primary.pipeline(transaction=transaction, shard_hint=shard_hint)
+
+    def scan_iter(self, match=None, count=None):
+        return self.primary.scan_iter(match=match, count=count)
+
+
+def get_replica_set(settings, client_cls=None, pool_cls=None, replica_set_cls=None):
+    """Return a ``ReplicaSet`` configured from the ``settings``. The replica
+      urls are read from ``alkey.replicas`` and the staleness tolerance (in
+      seconds) from ``alkey.replicas.max_staleness``. Reads time out after
+      ``alkey.replicas.socket_timeout`` seconds (default ``1``), so a hung
+      replica fails over to the primary. The replicas are checked using their
+      own single connection clients, which time out after
+      ``alkey.replicas.check_timeout`` seconds (default ``0.25``)::
+
+          >>> from mock import Mock
+          >>> mock_replica_set_cls = Mock()
+          >>> settings = {
+          ...     'alkey.replicas': 'redis://a:6379 redis://b:6379',
+          ...     'alkey.replicas.max_staleness': '5',
+          ... }
+          >>> mock_pool_cls = Mock()
+          >>> replica_set = get_replica_set(settings, client_cls=Mock(),
+          ...         pool_cls=mock_pool_cls, replica_set_cls=mock_replica_set_cls)
+          >>> args, kwargs = mock_replica_set_cls.call_args
+          >>> len(args[0]), len(kwargs['check_clients']), kwargs['max_staleness']
+          (2, 2, 5)
+          >>> mock_pool_cls.from_url.call_args_list[0][1]['socket_timeout']
+          1.0
+
+    """
+
+    # Compose.
+    if client_cls is None:
+        client_cls = redis.StrictRedis
+    if pool_cls is None:
+        pool_cls = redis.BlockingConnectionPool
+    if replica_set_cls is None:
+        replica_set_cls = ReplicaSet
+
+    kwargs = {}
+    max_connections = settings.get('redis.max_connections', None)
+    if max_connections is not None:
+        kwargs['max_connections'] = int(max_connections)
+    socket_timeout = float(settings.get('alkey.replicas.socket_timeout', 1))
+    kwargs['socket_timeout'] = socket_timeout
+    kwargs['socket_connect_timeout'] = socket_timeout
+    check_timeout = float(settings.get('alkey.replicas.check_timeout', 0.25))
+    clients = []
+    check_clients = []
+    for url in settings['alkey.replicas'].split():
+        pool = pool_cls.from_url(url, **kwargs)
+        clients.append(client_cls(connection_pool=pool))
+        pool = pool_cls.from_url(url, max_connections=1,
+                socket_timeout=check_timeout,
+                socket_connect_timeout=check_timeout)
+        check_clients.append(client_cls(connection_pool=pool))
+    max_staleness = int(settings.get('alkey.replicas.max_staleness', 1))
+    return replica_set_cls(clients, max_staleness=max_staleness,
+            check_clients=check_clients)
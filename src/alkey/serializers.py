@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``SerializingNamespaceManager``, a Beaker namespace manager that
+  wraps another one (e.g.: ``ext:redis``), serialising and optionally
+  compressing the cached values before they're stored, e.g.::
+
+      cache.type = ext:redis
+      cache.serializer = raw
+      cache.compression = lz4
+      cache.compression_threshold = 1024
+
+  The ``serializer`` is one of ``pickle`` (the default), ``msgpack`` (if
+  installed) or ``raw``, which stores strings as they are. Values that a
+  serializer can't handle are pickled, as are values that msgpack can't
+  round trip exactly, e.g.: tuples, which it unpacks as lists. If ``compression`` is ``zlib`` or
+  ``lz4`` (falling back to ``zlib`` if ``lz4`` isn't installed), values of at
+  least ``compression_threshold`` bytes are compressed.
+
+  Each stored value starts with a small header that identifies its format, so
+  values stored with different settings, or by the wrapped namespace manager
+  directly, can be read side by side, e.g.: during a rolling deploy.
+"""
+
+__all__ = [
+    'SERIALIZED_TYPE',
+    'SerializingNamespaceManager',
+    'decode_value',
+    'encode_value',
+    'use_serializers',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import cPickle as pickle
+import struct
+import zlib
+
+try:
+    import msgpack
+except ImportError: #pragma: no cover
+    msgpack = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError: #pragma: no cover
+    lz4_frame = None
+
+from beaker.cache import clsmap
+
+# The Beaker cache type of the serializing namespace manager.
+SERIALIZED_TYPE = 'alkey:serialized'
+
+# The header is ``(magic, format, compression, stored time, expire time)``.
+MAGIC = 'AK'
+HEADER = struct.Struct('<2sccdd')
+
+SERIALIZATION_OPTIONS = ('serializer', 'compression', 'compression_threshold')
+
+def is_same(value, other):
+    """Are ``value`` and ``other`` equal and of the same types, all the way
+      down?::
+
+          >>> is_same({u'a': [1, 'b']}, {u'a': [1, 'b']})
+          True
+          >>> is_same((1, 2), [1, 2]), is_same({'a': 1}, {u'a': 1})
+          (False, False)
+
+    """
+
+    if type(value) is not type(other):
+        return False
+    if isinstance(value, list):
+        if len(value) != len(other):
+            return False
+        return all(is_same(a, b) for a, b in zip(value, other))
+    if isinstance(value, dict):
+        if len(value) != len(other):
+            return False
+        keys = dict((key, key) for key in other)
+        for key, item in value.items():
+            if key not in keys or not is_same(key, keys[key]):
+                return False
+            if not is_same(item, other[key]):
+                return False
+        return True
+    return value == other
+
+def dumps(value, serializer):
+    """Return ``(format, data)`` for ``value``. Values are only stored as
+      msgpack if they unpack to the same value, with the same types::
+
+          >>> dumps((u'a', 1), 'msgpack')[0]
+          'p'
+
+    """
+
+    if serializer == 'raw':
+        if isinstance(value, str):
+            return 'b', value
+        if isinstance(value, unicode):
+            return 'u', value.encode('utf-8')
+    elif serializer == 'msgpack' and msgpack is not None:
+        try:
+            data = msgpack.packb(value, use_bin_type=True)
+        except (OverflowError, TypeError, ValueError):
+            data = None
+        if data is not None and is_same(value, loads('m', data)):
+            return 'm', data
+    return 'p', pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+def loads(format_, data):
+    if format_ == 'b':
+        return data
+    if format_ == 'u':
+        return data.decode('utf-8')
+    if format_ == 'm':
+        if msgpack is None: #pragma: no cover
+            raise KeyError(u'msgpack is not installed.')
+        return msgpack.unpackb(data, raw=False)
+    return pickle.loads(data)
+
+def compress(data, compression):
+    """Return ``(compression, data)``."""
+
+    if compression == 'lz4' and lz4_frame is not None:
+        return 'l', lz4_frame.compress(data)
+    return 'z', zlib.compress(data)
+
+def decompress(compression, data):
+    if compression == 'l':
+        if lz4_frame is None: #pragma: no cover
+            raise KeyError(u'lz4 is not installed.')
+        return lz4_frame.decompress(data)
+    if compression == 'z':
+        return zlib.decompress(data)
+    return data
+
+def encode_value(item, serializer='pickle', compression=None, threshold=1024):
+    """Encode a Beaker ``(stored time, expire time, value)`` ``item``::
+
+          >>> data = encode_value((1.0, None, u'<p>Hi</p>' * 200),
+          ...         serializer='raw', compression='zlib')
+          >>> data[:4], len(data) < 200
+          ('AKuz', True)
+          >>> decode_value(data) == (1.0, None, u'<p>Hi</p>' * 200)
+          True
+
+      Values that aren't Beaker items are left as they are::
+
+          >>> encode_value({'a': 1})
+          {'a': 1}
+
+    """
+
+    if not isinstance(item, tuple) or len(item) != 3:
+        return item
+    stored, expires, value = item
+    format_, data = dumps(value, serializer)
+    compression_ = 'n'
+    if compression and len(data) >= threshold:
+        compressed = compress(data, compression)
+        if len(compressed[1]) < len(data):
+            compression_, data = compressed
+    expires = -1.0 if expires is None else expires
+    header = HEADER.pack(MAGIC, format_, compression_, stored, expires)
+    return header + data
+
+def decode_value(data):
+    """Decode an encoded item, passing through values without a header::
+
+          >>> decode_value((1.0, None, 'stored by the wrapped manager'))
+          (1.0, None, 'stored by the wrapped manager')
+
+      Raises a ``KeyError`` (i.e.: a cache miss) if the value was stored in a
+      format that can't be read here.
+    """
+
+    if not isinstance(data, str) or not data.startswith(MAGIC):
+        return data
+    if len(data) < HEADER.size:
+        raise KeyError(u'Invalid header.')
+    _, format_, compression, stored, expires = HEADER.unpack_from(data)
+    data = decompress(compression, data[HEADER.size:])
+    expires = None if expires < 0 else expires
+    return stored, expires, loads(format_, data)
+
+
+class SerializingNamespaceManager(object):
+    """Wrap the ``inner_type`` namespace manager, encoding the values stored
+      in it::
+
+          >>> manager = SerializingNamespaceManager('ns', inner_type='memory',
+          ...         serializer='raw')
+          >>> manager.set_value('key', (1.0, 60, 'value'))
+          >>> manager.inner['key'][:4], manager.inner['key'][-5:]
+          ('AKbn', 'value')
+          >>> manager['key']
+          (1.0, 60.0, 'value')
+          >>> 'key' in manager
+          True
+
+    """
+
+    def __init__(self, namespace, inner_type='memory', serializer='pickle',
+            compression=None, compression_threshold=1024, **kwargs):
+        self.inner = clsmap[inner_type](namespace, **kwargs)
+        self.serializer = serializer
+        self.compression = compression
+        self.threshold = int(compression_threshold)
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def encode(self, item):
+        return encode_value(item, serializer=self.serializer,
+                compression=self.compression, threshold=self.threshold)
+
+    def __getitem__(self, key):
+        return decode_value(self.inner[key])
+
+    def __setitem__(self, key, value):
+        self.inner[key] = self.encode(value)
+
+    def set_value(self, key, value, expiretime=None):
+        self.inner.set_value(key, self.encode(value), expiretime=expiretime)
+
+    def __contains__(self, key):
+        return key in self.inner
+
+    def __delitem__(self, key):
+        del self.inner[key]
+
+# Register the namespace manager with Beaker.
+clsmap._clsmap[SERIALIZED_TYPE] = SerializingNamespaceManager
+
+
+def use_serializers(options):
+    """Wrap the namespace managers of the parsed cache ``options``, and of
+      their regions, if a ``serializer`` or ``compression`` is configured.
+      Regions inherit the top level serialization options::
+
+          >>> options = {'type': 'ext:redis', 'compression': 'zlib',
+          ...         'cache_regions': {'short': {'type': 'memory'}}}
+          >>> options = use_serializers(options)
+          >>> options['type'], options['inner_type']
+          ('alkey:serialized', 'ext:redis')
+          >>> region = options['cache_regions']['short']
+          >>> region['type'], region['inner_type'], region['compression']
+          ('alkey:serialized', 'memory', 'zlib')
+
+    """
+
+    defaults = dict((k, options[k]) for k in SERIALIZATION_OPTIONS
+            if k in options)
+    configs = [options] + options.get('cache_regions', {}).values()
+    for config in configs:
+        for key, value in defaults.items():
+            config.setdefault(key, value)
+        if config.get('serializer') or config.get('compression'):
+            if config.get('type') != SERIALIZED_TYPE:
+                config['inner_type'] = config.get('type') or 'memory'
+                config['type'] = SERIALIZED_TYPE
+    return options
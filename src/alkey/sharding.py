@@ -0,0 +1,512 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``ShardedRedis``, a redis client that spreads keys across a list
+  of standalone Redis instances using a consistent hash ring, e.g.::
+
+      client = ShardedRedis([redis1, redis2, redis3])
+      client.setex(u'alkey.cache.TOKENS:alkey:users#1', 60, u'token')
+
+  Single key commands are sent to the node that owns the key. ``MGET`` and
+  ``DEL`` are split per node and the nodes are called in parallel. Other multi
+  key commands and scripts (e.g.: the ``EVALSHA`` of a ``redis.lock()``) are
+  routed by their keys, which must all live on the same node. A handful of
+  keyless commands are sent to every node and anything else is refused with a
+  ``DataError``. Pipelines are split into one pipeline per node, again
+  executed in parallel.
+
+  Optionally, the global and table write tokens can be replicated to every
+  node, in which case they're read from the ``local`` node.
+"""
+
+__all__ = [
+    'HashRing',
+    'ShardedPipeline',
+    'ShardedRedis',
+    'get_sharded_client',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import bisect
+import hashlib
+
+from multiprocessing.pool import ThreadPool
+
+import redis
+from redis.exceptions import DataError
+
+from .cluster import get_hash_key
+from .constants import TOKEN_NAMESPACE
+from .utils import as_bool
+from .utils import valid_write_token
+
+# Commands that only read -- used to route reads of replicated keys
+# to the local node.
+READ_COMMANDS = frozenset([
+    'EXISTS',
+    'GET',
+    'MGET',
+    'PTTL',
+    'SCARD',
+    'SISMEMBER',
+    'SMEMBERS',
+    'TTL',
+])
+
+# Multi key commands that are split per node, mapped to the function that
+# combines the nodes' results (``None`` meaning the values are put back in
+# the order of the keys).
+SPLIT_COMMANDS = {
+    'DEL': sum,
+    'EXISTS': sum,
+    'MGET': None,
+    'TOUCH': sum,
+    'UNLINK': sum,
+}
+
+# Commands whose keys aren't just ``args[1]``, mapped to a function that
+# returns their keys. All of their keys must live on the same node.
+get_keys = lambda args: args[1:]
+get_keys_but_last = lambda args: args[1:-1]
+get_two_keys = lambda args: args[1:3]
+get_script_keys = lambda args: args[3:3 + int(args[2])]
+get_store_keys = lambda args: (args[1],) + args[3:3 + int(args[2])]
+KEY_COMMANDS = {
+    'BITOP': lambda args: args[2:],
+    'BLPOP': get_keys_but_last,
+    'BRPOP': get_keys_but_last,
+    'BRPOPLPUSH': get_two_keys,
+    'EVAL': get_script_keys,
+    'EVALSHA': get_script_keys,
+    'MSET': lambda args: args[1::2],
+    'MSETNX': lambda args: args[1::2],
+    'PFCOUNT': get_keys,
+    'PFMERGE': get_keys,
+    'RENAME': get_two_keys,
+    'RENAMENX': get_two_keys,
+    'RPOPLPUSH': get_two_keys,
+    'SDIFF': get_keys,
+    'SDIFFSTORE': get_keys,
+    'SINTER': get_keys,
+    'SINTERSTORE': get_keys,
+    'SMOVE': get_two_keys,
+    'SUNION': get_keys,
+    'SUNIONSTORE': get_keys,
+    'WATCH': get_keys,
+    'ZINTERSTORE': get_store_keys,
+    'ZUNIONSTORE': get_store_keys,
+}
+
+def get_same(results):
+    """Return the result that all the nodes agree on, e.g.: the sha of a
+      script loaded on every node.
+    """
+
+    if any(item != results[0] for item in results[1:]):
+        raise DataError(u'The nodes returned different results.')
+    return results[0]
+
+# Keyless commands that are sent to every node, mapped to the function that
+# combines the nodes' results.
+FANOUT_COMMANDS = {
+    'DBSIZE': sum,
+    'FLUSHALL': all,
+    'FLUSHDB': all,
+    'PING': all,
+    'PUBLISH': sum,
+    'SCRIPT': get_same,
+}
+
+# Commands whose first argument isn't a key and that can't be routed.
+UNSUPPORTED_COMMANDS = frozenset([
+    'CLIENT',
+    'CLUSTER',
+    'CONFIG',
+    'DEBUG',
+    'INFO',
+    'KEYS',
+    'MEMORY',
+    'MULTI',
+    'OBJECT',
+    'RANDOMKEY',
+    'SCAN',
+    'SELECT',
+    'SLOWLOG',
+])
+
+def is_write_token_key(key, namespace=None):
+    """Is ``key`` the token key of a table or the global write token?
+
+          >>> is_write_token_key(u'alkey.cache.TOKENS:alkey:*#*')
+          True
+          >>> is_write_token_key('alkey.cache.TOKENS:alkey:users#*')
+          True
+          >>> is_write_token_key('alkey.cache.TOKENS:alkey:users#1')
+          False
+
+    """
+
+    # Compose.
+    if namespace is None:
+        namespace = TOKEN_NAMESPACE
+
+    prefix = u'{0}:'.format(namespace)
+    if isinstance(key, str):
+        key = key.decode('utf-8')
+    if not key.startswith(prefix):
+        return False
+    return bool(valid_write_token.match(key[len(prefix):]))
+
+
+class HashRing(object):
+    """A consistent hash ring, mapping keys to ``nodes`` so that adding or
+      removing a node only moves the keys it owns::
+
+          >>> ring = HashRing(['a', 'b', 'c'])
+          >>> ring.get_node('foo') == ring.get_node(u'foo')
+          True
+          >>> smaller = HashRing(['a', 'b'])
+          >>> keys = [str(i) for i in range(1000)]
+          >>> moved = [k for k in keys if ring.get_node(k) != 'c'
+          ...         and ring.get_node(k) != smaller.get_node(k)]
+          >>> moved
+          []
+
+    """
+
+    def __init__(self, nodes, replicas=160):
+        self.nodes = {}
+        for node in nodes:
+            for i in range(replicas):
+                point = self.hash(u'{0}-{1}'.format(node, i))
+                self.nodes[point] = node
+        self.points = sorted(self.nodes.keys())
+
+    def hash(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def get_node(self, key):
+        """Return the node that owns ``key``."""
+
+        index = bisect.bisect(self.points, self.hash(key)) % len(self.points)
+        return self.nodes[self.points[index]]
+
+
+class ShardedRedis(redis.StrictRedis):
+    """Route the commands of a ``redis.StrictRedis`` client to the node that
+      owns each key.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> nodes = [Mock(), Mock()]
+          >>> client = ShardedRedis(nodes, names=['a', 'b'], replicate=True)
+          >>> owner = lambda key: nodes[['a', 'b'].index(client.ring.get_node(key))]
+
+      Sends single key commands to the node that owns the key::
+
+          >>> key = u'alkey.cache.TOKENS:alkey:users#1'
+          >>> return_value = client.get(key)
+          >>> owner(key).execute_command.assert_called_with('GET', key)
+
+      Splits ``MGET`` per node, returning the values in order::
+
+          >>> keys = ['k{0}'.format(i) for i in range(6)]
+          >>> for node in nodes:
+          ...     node.execute_command.side_effect = lambda *args: list(args[1:])
+          >>> client.mget(keys) == keys
+          True
+
+      Routes scripts by their keys and refuses multi key commands whose keys
+      live on different nodes::
+
+          >>> lock_key, other_key = 'lock0', 'lock1'
+          >>> while owner(other_key) is owner(lock_key):
+          ...     other_key += '1'
+          >>> return_value = client.evalsha('sha', 1, lock_key, 'token')
+          >>> owner(lock_key).execute_command.assert_called_with('EVALSHA',
+          ...         'sha', 1, lock_key, 'token')
+          >>> client.sunion(lock_key, other_key)
+          Traceback (most recent call last):
+          ...
+          DataError: SUNION keys must live on the same node.
+
+      Sends keyless commands to every node, combining their results, and
+      refuses the ones it can't combine::
+
+          >>> for node in nodes:
+          ...     node.execute_command.side_effect = None
+          ...     node.execute_command.return_value = 2
+          >>> client.dbsize()
+          4
+          >>> client.info()
+          Traceback (most recent call last):
+          ...
+          DataError: INFO is not supported by ShardedRedis.
+
+      Replicated write tokens are written to every node and read from the
+      local node::
+
+          >>> key = u'alkey.cache.TOKENS:alkey:*#*'
+          >>> return_value = client.setex(key, 60, 'token')
+          >>> for node in nodes:
+          ...     node.execute_command.assert_called_with('SETEX', key, 60, 'token')
+          >>> return_value = client.get(key)
+          >>> nodes[0].execute_command.assert_called_with('GET', key)
+
+      Close the client to stop the threads used to call the nodes in
+      parallel::
+
+          >>> client.close()
+
+    """
+
+    # Commands are sent to more than one node, so pipelines aren't ordered.
+    fans_out = True
+
+    def __init__(self, clients, names=None, replicate=False, local=0,
+            is_replicated=None, ring_cls=None):
+        """Instantiate with a list of node ``clients``. The ``names`` identify
+          each node on the hash ring, so should be stable across restarts.
+        """
+
+        # Compose.
+        if names is None:
+            names = [unicode(i) for i in range(len(clients))]
+        if is_replicated is None:
+            is_replicated = is_write_token_key
+        if ring_cls is None:
+            ring_cls = HashRing
+
+        # Assign.
+        self.clients = list(clients)
+        self.indexes = dict((name, i) for i, name in enumerate(names))
+        self.ring = ring_cls(names)
+        self.replicate = replicate
+        self.local = local
+        self.is_replicated = is_replicated
+        self.response_callbacks = {}
+        self.connection = None
+        self.pool = None
+
+    def __repr__(self):
+        return '{0}<{1}>'.format(type(self).__name__, sorted(self.indexes))
+
+    def get_index(self, key):
+        """Return the index of the client that owns ``key``."""
+
+        return self.indexes[self.ring.get_node(get_hash_key(key))]
+
+    def get_indexes(self, command, key):
+        """Return the indexes of the clients to send ``command`` to."""
+
+        if self.replicate and self.is_replicated(key):
+            if command in READ_COMMANDS:
+                return [self.local]
+            return range(len(self.clients))
+        return [self.get_index(key)]
+
+    def route(self, args, options):
+        """Return ``(parts, combine)``, where ``parts`` is a list of
+          ``(index, args, options)`` commands to send to the nodes and
+          ``combine`` reduces the parts' results to a single result.
+        """
+
+        command = args[0].upper()
+        if command in FANOUT_COMMANDS:
+            parts = [(i, args, options) for i in range(len(self.clients))]
+            return parts, FANOUT_COMMANDS[command]
+        if len(args) < 2 or command in UNSUPPORTED_COMMANDS:
+            msg = u'{0} is not supported by {1}.'
+            raise DataError(msg.format(command, type(self).__name__))
+        if command in KEY_COMMANDS:
+            keys = KEY_COMMANDS[command](args)
+            indexes = set(tuple(self.get_indexes(command, k)) for k in keys)
+            if len(indexes) != 1:
+                msg = u'{0} keys must live on the same node.'
+                raise DataError(msg.format(command))
+            parts = [(i, args, options) for i in indexes.pop()]
+            return parts, lambda results: results[0]
+        if command not in SPLIT_COMMANDS:
+            indexes = self.get_indexes(command, args[1])
+            parts = [(i, args, options) for i in indexes]
+            return parts, lambda results: results[0]
+
+        # Split multi key commands per node.
+        groups = {}
+        for position, key in enumerate(args[1:]):
+            for i in self.get_indexes(command, key):
+                groups.setdefault(i, []).append((position, key))
+        parts = []
+        for i, items in groups.items():
+            parts.append((i, (command,) + tuple(k for _, k in items), options))
+        if SPLIT_COMMANDS[command] is not None:
+            return parts, SPLIT_COMMANDS[command]
+        def combine(results):
+            values = [None] * (len(args) - 1)
+            for (i, items), part_values in zip(groups.items(), results):
+                for (position, _), value in zip(items, part_values):
+                    values[position] = value
+            return values
+        return parts, combine
+
+    def map(self, func, items):
+        """Call ``func`` with each of the ``items``, in parallel if there's
+          more than one.
+        """
+
+        if len(items) < 2:
+            return [func(item) for item in items]
+        if self.pool is None:
+            self.pool = ThreadPool(len(self.clients))
+        return self.pool.map(func, items)
+
+    def close(self):
+        """Stop the threads used to call the nodes in parallel."""
+
+        pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.close()
+
+    def execute_command(self, *args, **options):
+        parts, combine = self.route(args, options)
+        def call(part):
+            i, args_, options_ = part
+            return self.clients[i].execute_command(*args_, **options_)
+        return combine(self.map(call, parts))
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return ShardedPipeline(self, transaction=transaction)
+
+    def register_script(self, script):
+        """Return a ``Script`` that's run on the node that owns its keys."""
+
+        registered = self.clients[0].register_script(script)
+        registered.registered_client = self
+        return registered
+
+    def scan_iter(self, match=None, count=None):
+        """Scan each node in turn, yielding replicated keys once."""
+
+        seen = set()
+        for client in self.clients:
+            for key in client.scan_iter(match=match, count=count):
+                if self.replicate and self.is_replicated(key):
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                yield key
+
+
+class ShardedPipeline(ShardedRedis):
+    """Buffer commands and then execute them with one pipeline per node.
+
+      Note that if a ``transaction`` is requested, it's only atomic per node.
+
+          >>> from mock import Mock
+          >>> nodes = [Mock(), Mock()]
+          >>> for node in nodes:
+          ...     node.pipeline.return_value.execute.return_value = [1, 1]
+          >>> client = ShardedRedis(nodes, names=['a', 'b'])
+          >>> pipeline = client.pipeline(transaction=False)
+          >>> results = pipeline.sadd('a', 1).expire('a', 60).execute()
+          >>> results
+          [1, 1]
+          >>> node = nodes[client.get_index('a')]
+          >>> node.pipeline.assert_called_with(transaction=False)
+
+    """
+
+    def __init__(self, sharded, transaction=True):
+        self.sharded = sharded
+        self.transaction = transaction
+        self.command_stack = []
+        self.response_callbacks = {}
+        self.connection = None
+        self.pool = None
+
+    def __repr__(self):
+        return '{0}<{1!r}>'.format(type(self).__name__, self.sharded)
+
+    def execute_command(self, *args, **options):
+        self.command_stack.append(self.sharded.route(args, options))
+        return self
+
+    def execute(self):
+        """Execute the buffered commands, returning their results in order."""
+
+        # Build one list of commands per node, remembering where each of the
+        # commands' parts ends up.
+        routes, self.command_stack = self.command_stack, []
+        stacks = {}
+        positions = []
+        for parts, combine in routes:
+            command_positions = []
+            for i, args, options in parts:
+                stack = stacks.setdefault(i, [])
+                command_positions.append((i, len(stack)))
+                stack.append((args, options))
+            positions.append(command_positions)
+
+        def call(item):
+            i, stack = item
+            pipeline = self.sharded.clients[i].pipeline(transaction=self.transaction)
+            for args, options in stack:
+                pipeline.execute_command(*args, **options)
+            return i, pipeline.execute()
+        results = dict(self.sharded.map(call, stacks.items()))
+
+        # Reassemble.
+        combined = []
+        for (parts, combine), command_positions in zip(routes, positions):
+            values = [results[i][j] for i, j in command_positions]
+            combined.append(combine(values))
+        return combined
+
+    def reset(self):
+        self.command_stack = []
+
+
+def get_sharded_client(settings, client_cls=None, pool_cls=None, sharded_cls=None):
+    """Return a ``ShardedRedis`` client configured from the ``settings``. The
+      node urls are read from ``alkey.shards`` and the local node from
+      ``alkey.shards.local`` (defaulting to the first node)::
+
+          >>> from mock import Mock
+          >>> mock_sharded_cls = Mock()
+          >>> settings = {
+          ...     'alkey.shards': 'redis://a:6379 redis://b:6379',
+          ...     'alkey.shards.local': 'redis://b:6379',
+          ...     'alkey.shards.replicate': 'true',
+          ... }
+          >>> client = get_sharded_client(settings, client_cls=Mock(),
+          ...         pool_cls=Mock(), sharded_cls=mock_sharded_cls)
+          >>> kwargs = mock_sharded_cls.call_args[1]
+          >>> kwargs['names'], kwargs['local'], kwargs['replicate']
+          (['redis://a:6379', 'redis://b:6379'], 1, True)
+
+    """
+
+    # Compose.
+    if client_cls is None:
+        client_cls = redis.StrictRedis
+    if pool_cls is None:
+        pool_cls = redis.BlockingConnectionPool
+    if sharded_cls is None:
+        sharded_cls = ShardedRedis
+
+    urls = settings['alkey.shards'].split()
+    local = settings.get('alkey.shards.local', urls[0]).strip()
+    kwargs = {}
+    max_connections = settings.get('redis.max_connections', None)
+    if max_connections is not None:
+        kwargs['max_connections'] = int(max_connections)
+    clients = []
+    for url in urls:
+        pool = pool_cls.from_url(url, **kwargs)
+        clients.append(client_cls(connection_pool=pool))
+    return sharded_cls(clients, names=urls, local=urls.index(local),
+            replicate=as_bool(settings.get('alkey.shards.replicate', False)))
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``Sweeper``, a maintenance utility that incrementally scans the
+  changed sets, reporting their size and how long they've been idle, and
+  optionally invalidating or deleting the ones that have been orphaned by
+  sessions that never committed or rolled back, e.g.::
+
+      sweeper = Sweeper(redis_client, min_idle=600, action='invalidate')
+      for changed_set in sweeper.sweep():
+          print changed_set
+
+  Invalidating is the conservative option: the process may have died after
+  the database transaction committed, in which case the tokens need to be
+  updated. The members are left in the set, as an idle set may also belong to
+  a long running transaction that's yet to commit, whose commit must still
+  invalidate them. Deleting is only safe if you know the transactions were
+  rolled back.
+
+  If the changes are being recorded to a change feed, pass the ``feed`` (or
+  ``--feed`` on the command line), so that the invalidations are relayed
+  like any other commit's.
+
+  All of the Redis calls are rate limited, so it's safe to run against a busy
+  production Redis, e.g.: using the ``alkey-sweep`` console script::
+
+      alkey-sweep --url redis://localhost:6379 --min-idle 600 --rate 100
+"""
+
+__all__ = [
+    'ChangedSet',
+    'RateLimiter',
+    'Sweeper',
+    'main',
+    'parse_changed_key',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import argparse
+import sys
+import time
+from collections import namedtuple
+
+import redis
+
+from .constants import CHANGED_KEY
+from .constants import CHANGED_SET_EXPIRES
+from .feed import get_change_feed
+from .handle import clear_changed
+from .handle import get_changed_key
+from .handle import invalidate_tokens
+
+ACTIONS = ('report', 'invalidate', 'delete')
+
+# ``idle`` is the number of seconds since the set was last written to, or
+# ``None`` if the set doesn't expire.
+ChangedSet = namedtuple('ChangedSet', 'key session_id size idle orphaned action')
+
+def parse_changed_key(changed_key, key=None):
+    """Return the session id from a ``changed_key``::
+
+          >>> parse_changed_key('alkey.handle.CHANGED:{1234}')
+          u'1234'
+          >>> parse_changed_key(u'alkey.handle.CHANGED:1234')
+          u'1234'
+
+    """
+
+    # Compose.
+    if key is None:
+        key = CHANGED_KEY
+
+    if isinstance(changed_key, str):
+        changed_key = changed_key.decode('utf-8')
+    session_id = changed_key[len(key) + 1:]
+    if session_id.startswith(u'{') and session_id.endswith(u'}'):
+        session_id = session_id[1:-1]
+    return session_id
+
+
+class RateLimiter(object):
+    """Limit calls to ``wait`` to ``rate`` per second, sleeping if need be::
+
+          >>> clock = [0.0]
+          >>> sleep = lambda seconds: clock.append(clock.pop() + seconds)
+          >>> limiter = RateLimiter(4, now=lambda: clock[0], sleep=sleep)
+          >>> for i in range(9):
+          ...     limiter.wait()
+          >>> clock[0]
+          2.0
+
+    """
+
+    def __init__(self, rate, now=None, sleep=None):
+        # Compose.
+        if now is None:
+            now = time.time
+        if sleep is None:
+            sleep = time.sleep
+
+        # Assign.
+        self.interval = 1.0 / rate if rate else 0
+        self.now = now
+        self.sleep = sleep
+        self.next_time = None
+
+    def wait(self, n=1):
+        """Wait until ``n`` more calls can be made."""
+
+        if not self.interval:
+            return
+        now = self.now()
+        if self.next_time is None or self.next_time < now:
+            self.next_time = now
+        delay = self.next_time - now
+        if delay > 0:
+            self.sleep(delay)
+        self.next_time += self.interval * n
+
+
+class Sweeper(object):
+    """Scan the changed sets, reporting each one's size and idle time and
+      applying the ``action`` to the ones that have been idle for at least
+      ``min_idle`` seconds.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> mock_client = Mock()
+          >>> mock_client.scan_iter.return_value = ['alkey.handle.CHANGED:{1}']
+          >>> mock_pipeline = mock_client.pipeline.return_value
+          >>> mock_pipeline.execute.return_value = [2, CHANGED_SET_EXPIRES - 60]
+          >>> mock_clear = Mock()
+
+      Reports the changed sets::
+
+          >>> sweeper = Sweeper(mock_client, min_idle=30, rate=0,
+          ...         clear=mock_clear)
+          >>> list(sweeper.sweep()) # doctest: +NORMALIZE_WHITESPACE
+          [ChangedSet(key='alkey.handle.CHANGED:{1}', session_id=u'1', size=2,
+                  idle=60, orphaned=True, action='report')]
+
+      Deleting them if asked to::
+
+          >>> sweeper.action = 'delete'
+          >>> changed_set = list(sweeper.sweep())[0]
+          >>> mock_clear.assert_called_with(mock_client, u'1')
+
+      Invalidating them, recording the changes to the ``feed``::
+
+          >>> mock_client.sscan_iter.return_value = ['a', 'b']
+          >>> mock_invalidate = Mock()
+          >>> sweeper = Sweeper(mock_client, min_idle=30, rate=0,
+          ...         action='invalidate', feed='<feed>',
+          ...         invalidate=mock_invalidate)
+          >>> changed_set = list(sweeper.sweep())[0]
+          >>> mock_invalidate.call_args[1]['feed'], mock_invalidate.call_args[1]['clear']
+          ('<feed>', False)
+
+      Leaving the ones that are still in use::
+
+          >>> mock_clear.reset_mock()
+          >>> sweeper.action = 'delete'
+          >>> sweeper.min_idle = 120
+          >>> list(sweeper.sweep())[0].orphaned
+          False
+          >>> mock_clear.called
+          False
+
+    """
+
+    def __init__(self, redis_client, min_idle=600, action='report', rate=100,
+            batch_size=100, scan_count=100, expires=None, key=None,
+            limiter_cls=None, invalidate=None, clear=None, feed=None):
+        """``rate`` limits the Redis calls per second (``0`` means unlimited)
+          and ``batch_size`` the number of members invalidated per call.
+          Invalidations are recorded to the change ``feed``, if provided.
+        """
+
+        # Compose.
+        if expires is None:
+            expires = CHANGED_SET_EXPIRES
+        if key is None:
+            key = CHANGED_KEY
+        if limiter_cls is None:
+            limiter_cls = RateLimiter
+        if invalidate is None:
+            invalidate = invalidate_tokens
+        if clear is None:
+            clear = clear_changed
+        if action not in ACTIONS:
+            raise ValueError(u'Unknown action: {0}'.format(action))
+
+        # Assign.
+        self.redis = redis_client
+        self.min_idle = min_idle
+        self.action = action
+        self.limiter = limiter_cls(rate)
+        self.batch_size = batch_size
+        self.scan_count = scan_count
+        self.expires = expires
+        self.key = key
+        self.invalidate = invalidate
+        self.clear = clear
+        self.feed = feed
+
+    def scan(self):
+        """Incrementally scan the changed set keys."""
+
+        match = u'{0}:*'.format(self.key)
+        keys = self.redis.scan_iter(match=match, count=self.scan_count)
+        for changed_key in keys:
+            self.limiter.wait()
+            yield changed_key
+
+    def inspect(self, changed_key):
+        """Return ``(size, idle)`` for ``changed_key``."""
+
+        self.limiter.wait()
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.scard(changed_key).ttl(changed_key)
+        size, ttl = pipeline.execute()
+        if ttl is None or ttl < 0:
+            return size, None
+        return size, max(0, self.expires - ttl)
+
+    def invalidate_batch(self, session_id, members):
+        get_members = lambda *args, **kwargs: members
+        self.limiter.wait(len(members))
+        self.invalidate(self.redis, session_id, get_members=get_members,
+                feed=self.feed, clear=False)
+
+    def invalidate_members(self, changed_key, session_id):
+        """Invalidate the members of the changed set a batch at a time,
+          leaving them in the set, so that if the session is still open it
+          invalidates them (again) when it commits.
+        """
+
+        batch = []
+        self.limiter.wait()
+        for member in self.redis.sscan_iter(changed_key, count=self.batch_size):
+            batch.append(member)
+            if len(batch) == self.batch_size:
+                self.invalidate_batch(session_id, batch)
+                batch = []
+                self.limiter.wait()
+        if batch:
+            self.invalidate_batch(session_id, batch)
+
+    def sweep(self):
+        """Yield a ``ChangedSet`` for each of the changed sets, applying the
+          action to the orphaned ones.
+        """
+
+        for changed_key in self.scan():
+            session_id = parse_changed_key(changed_key, key=self.key)
+            if get_changed_key(session_id, key=self.key) != changed_key:
+                # Not a changed set we know how to handle.
+                continue
+            size, idle = self.inspect(changed_key)
+            if not size:
+                continue
+            orphaned = idle is None or idle >= self.min_idle
+            if orphaned:
+                if self.action == 'invalidate':
+                    self.invalidate_members(changed_key, session_id)
+                elif self.action == 'delete':
+                    self.limiter.wait()
+                    self.clear(self.redis, session_id)
+            yield ChangedSet(changed_key, session_id, size, idle, orphaned,
+                    self.action)
+
+
+def main(argv=None, client_cls=None, sweeper_cls=None, output=None,
+        get_feed=None):
+    """Command line entry point::
+
+          >>> from mock import Mock
+          >>> mock_sweeper_cls = Mock()
+          >>> mock_sweeper_cls.return_value.sweep.return_value = [
+          ...     ChangedSet('alkey.handle.CHANGED:{1}', '1', 5, 900, True,
+          ...             'invalidate'),
+          ... ]
+          >>> lines = []
+          >>> main(['--min-idle', '600', '--action', 'invalidate'],
+          ...         client_cls=Mock(), sweeper_cls=mock_sweeper_cls,
+          ...         output=lines.append)
+          0
+          >>> lines
+          [u'alkey.handle.CHANGED:{1} size=5 idle=900 invalidate']
+
+      Recording the invalidations to the change feed, if asked to::
+
+          >>> mock_sweeper_cls.call_args[1]['feed'] is None
+          True
+          >>> main(['--action', 'invalidate', '--feed', '--feed-maxlen', '500'],
+          ...         client_cls=Mock(), sweeper_cls=mock_sweeper_cls,
+          ...         output=lines.append)
+          0
+          >>> feed = mock_sweeper_cls.call_args[1]['feed']
+          >>> feed.key, feed.maxlen
+          ('alkey.feed.CHANGES', 500)
+
+    """
+
+    # Compose.
+    if client_cls is None: #pragma: no cover
+        client_cls = redis.StrictRedis
+    if sweeper_cls is None: #pragma: no cover
+        sweeper_cls = Sweeper
+    if output is None: #pragma: no cover
+        output = lambda line: sys.stdout.write(u'{0}\n'.format(line))
+    if get_feed is None:
+        get_feed = get_change_feed
+
+    parser = argparse.ArgumentParser(description=u'Sweep orphaned changed sets.')
+    parser.add_argument('--url', default='redis://localhost:6379')
+    parser.add_argument('--db', type=int, default=None)
+    parser.add_argument('--action', choices=ACTIONS, default='report')
+    parser.add_argument('--min-idle', type=int, default=600,
+            help=u'Seconds since the last flush before a set is orphaned.')
+    parser.add_argument('--rate', type=float, default=100,
+            help=u'Maximum Redis calls per second.')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--feed', action='store_true',
+            help=u'Record the invalidations to the change feed.')
+    parser.add_argument('--feed-key', default=None)
+    parser.add_argument('--feed-maxlen', type=int, default=10000)
+    args = parser.parse_args(argv)
+
+    kwargs = {}
+    if args.db is not None:
+        kwargs['db'] = args.db
+    redis_client = client_cls.from_url(args.url, **kwargs)
+    feed = get_feed({
+        'alkey.feed': args.feed,
+        'alkey.feed.key': args.feed_key,
+        'alkey.feed.maxlen': args.feed_maxlen,
+    })
+    sweeper = sweeper_cls(redis_client, min_idle=args.min_idle,
+            action=args.action, rate=args.rate, batch_size=args.batch_size,
+            feed=feed)
+    for item in sweeper.sweep():
+        status = item.action if item.orphaned else u'in use'
+        idle = u'-' if item.idle is None else item.idle
+        output(u'{0} size={1} idle={2} {3}'.format(item.key, item.size, idle,
+                status))
+    return 0
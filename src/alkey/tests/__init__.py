@@ -15,6 +15,14 @@ TEST_SETTINGS = {
     'redis.db': 6
 }
 
+def get_new_session_id(index):
+    """Return the id of a new session, e.g.: in a worker process."""
+
+    from sqlalchemy.orm import sessionmaker
+    from alkey.handle import get_session_id
+
+    return get_session_id(sessionmaker()())
+
 class IntegrationTest(unittest.TestCase):
     """Test token and cache key generation in response to model changes."""
 
@@ -43,6 +51,62 @@ class IntegrationTest(unittest.TestCase):
         cls.__tablename__ = tablename
         return cls
 
+    def makeMappedInstance(self, cls, **kwargs):
+        """Return a persistent looking instance of a mapped ``cls``."""
+
+        from sqlalchemy.orm import make_transient_to_detached
+
+        instance = cls(**kwargs)
+        make_transient_to_detached(instance)
+        return instance
+
+    def makeSession(self, base):
+        """Return a session on an in memory sqlite db, with the tables of the
+          declarative ``base`` created and alkey's handlers bound to use the
+          test redis client.
+        """
+
+        from functools import partial
+        from sqlalchemy import create_engine
+        from sqlalchemy import event
+        from sqlalchemy.orm import sessionmaker
+        from alkey import handle
+        from alkey.events import bind
+
+        engine = create_engine('sqlite://')
+        base.metadata.create_all(engine)
+        session_cls = sessionmaker(bind=engine)
+        kwargs = dict(get_redis=lambda request: self.redis, get_request=lambda: None)
+        bind(session_cls, event=event, engine_cls=engine,
+                commit=partial(handle.handle_commit, **kwargs),
+                flush=partial(handle.handle_flush, **kwargs),
+                rollback=partial(handle.handle_rollback, **kwargs),
+                flushed=handle.handle_flushed, begin=handle.handle_begin,
+                bulk=partial(handle.handle_bulk, **kwargs),
+                execute=partial(handle.handle_execute, **kwargs))
+        return session_cls()
+
+    def test_import_doesnt_load_frameworks(self):
+        """Importing ``alkey`` doesn't import Pyramid, ``pyramid_redis``,
+          Beaker or the SQLAlchemy ORM.
+        """
+
+        import os
+        import subprocess
+        import sys
+        import alkey
+
+        code = (
+            'import sys, alkey\n'
+            'names = ("pyramid", "pyramid_redis", "beaker")\n'
+            'print(" ".join(sorted(name for name in sys.modules if sys.modules[name]\n'
+            '        and name.split(".")[0] in names or name == "sqlalchemy.orm")))\n'
+        )
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(alkey.__file__))
+        output = subprocess.check_output([sys.executable, '-c', code], env=env)
+        self.assertTrue(output.strip() == '')
+
     def test_get_token_for_new_instance(self):
         """Getting a token for an instance that isn't yet in the cache
           returns a new timestamp.
@@ -394,4 +458,998 @@ class IntegrationTest(unittest.TestCase):
         for segment in segments:
             self.assertTrue(segment in cache_key)
 
+    def test_object_id_for_uuid_primary_key(self):
+        """Instances keyed by a UUID get a compact, per row object id."""
+
+        import uuid
+        from sqlalchemy import Column, String
+        from sqlalchemy.ext.declarative import declarative_base
+        from alkey.cache import get_token
+        from alkey.handle import record_changed
+        from alkey.handle import invalidate_tokens
+        from alkey.utils import get_object_id
+        from alkey.utils import valid_object_id
+
+        class Document(declarative_base()):
+            __tablename__ = 'documents'
+            id = Column(String, primary_key=True)
+
+        document1 = self.makeMappedInstance(Document, id=uuid.uuid4())
+        document2 = self.makeMappedInstance(Document, id=uuid.uuid4())
+        oid = get_object_id(document1)
+        self.assertTrue(valid_object_id.match(oid))
+        self.assertTrue(len(oid) == len(u'alkey:documents#') + 22)
+
+        # Changing one document doesn't invalidate the other.
+        token1 = get_token(self.redis, document1)
+        token2 = get_token(self.redis, document2)
+        record_changed(self.redis, 'session_id', [document1])
+        invalidate_tokens(self.redis, 'session_id')
+        self.assertTrue(get_token(self.redis, document1) != token1)
+        self.assertTrue(get_token(self.redis, document2) == token2)
+
+    def test_object_id_for_composite_primary_key(self):
+        """Instances with a composite primary key get a per row object id."""
+
+        from sqlalchemy import Column, Integer, Unicode
+        from sqlalchemy.ext.declarative import declarative_base
+        from alkey.utils import get_object_id
+        from alkey.utils import unpack_object_id
+        from alkey.utils import valid_object_id
+
+        class Translation(declarative_base()):
+            __tablename__ = 'translations'
+            page_id = Column(Integer, primary_key=True)
+            locale = Column(Unicode, primary_key=True)
+
+        instance = self.makeMappedInstance(Translation, page_id=1, locale=u'pt/br')
+        oid = get_object_id(instance)
+        self.assertTrue(oid == u'alkey:translations#1,pt%2Fbr')
+        self.assertTrue(valid_object_id.match(oid))
+        self.assertTrue(unpack_object_id(oid) == (u'translations', (1, u'pt/br')))
+
+        # Unflushed instances still fall back on the table token.
+        transient = Translation(page_id=2, locale=u'en')
+        self.assertTrue(get_object_id(transient) == u'alkey:translations#*')
+
+    def test_get_tokens_matches_get_token(self):
+        """Batched token reads return the same tokens as ``get_token``, whether
+          or not they're grouped by slot.
+        """
+
+        from alkey.cache import get_token
+        from alkey.cache import get_tokens
+        from alkey.constants import GLOBAL_WRITE_TOKEN
+
+        instances = [self.makeInstance(id=i) for i in range(1, 6)]
+        tokens = [get_token(self.redis, item) for item in instances[:3]]
+
+        # New tokens are generated and stored for the rest.
+        args = instances + [GLOBAL_WRITE_TOKEN]
+        values = get_tokens(self.redis, args)
+        self.assertTrue(values[:3] == tokens)
+        self.assertTrue(values[3:] == [get_token(self.redis, item) for item in args[3:]])
+
+        # Grouping by slot returns the same values, in the same order.
+        self.assertTrue(get_tokens(self.redis, args, cluster=True) == values)
+
+    def test_changed_set_keys_share_a_slot(self):
+        """The changed set key is hash tagged with the session id."""
+
+        from alkey.cluster import key_slot
+        from alkey.handle import get_changed_key
+        from alkey.handle import record_changed
+
+        record_changed(self.redis, 'session_id', [self.makeInstance()])
+        changed_key = get_changed_key('session_id')
+        self.assertTrue(self.redis.scard(changed_key) == 1)
+        self.assertTrue(key_slot(changed_key) == key_slot(u'session_id'))
+
+    def test_sharded_tokens(self):
+        """Tokens can be sharded across standalone nodes, with the write
+          tokens replicated to every node.
+        """
+
+        import redis
+        from alkey.cache import get_token
+        from alkey.cache import get_tokens
+        from alkey.constants import GLOBAL_WRITE_TOKEN
+        from alkey.handle import record_changed
+        from alkey.handle import invalidate_tokens
+        from alkey.sharding import ShardedRedis
+
+        other = redis.StrictRedis(db=TEST_SETTINGS['redis.db'] + 1)
+        self.addCleanup(other.flushdb)
+        client = ShardedRedis([self.redis, other], replicate=True)
+        self.addCleanup(client.close)
+
+        instances = [self.makeInstance(id=i) for i in range(1, 21)]
+        tokens = get_tokens(client, instances + [GLOBAL_WRITE_TOKEN])
+        self.assertTrue(self.redis.dbsize() > 1 and other.dbsize() > 1)
+        self.assertTrue(self.redis.dbsize() + other.dbsize() == 22)
+
+        # Invalidation is split across the nodes.
+        record_changed(client, 'session_id', instances[:2])
+        invalidate_tokens(client, 'session_id')
+        new_tokens = get_tokens(client, instances + [GLOBAL_WRITE_TOKEN])
+        self.assertTrue(new_tokens[:2] != tokens[:2])
+        self.assertTrue(new_tokens[2:-1] == tokens[2:-1])
+
+        # The global write token is the same on both nodes.
+        global_token = new_tokens[-1]
+        self.assertTrue(global_token != tokens[-1])
+        self.assertTrue(get_token(self.redis, GLOBAL_WRITE_TOKEN) == global_token)
+        self.assertTrue(get_token(other, GLOBAL_WRITE_TOKEN) == global_token)
+
+        # Keyless commands are sent to, and combined across, every node.
+        self.assertTrue(client.ping())
+        self.assertTrue(client.dbsize() == self.redis.dbsize() + other.dbsize())
+
+    def test_sharded_invalidation_survives_a_failed_node(self):
+        """If a node fails whilst the tokens are being written, the changed
+          set isn't cleared, so the invalidation can be retried.
+        """
+
+        import redis
+        from alkey.handle import get_changed_key
+        from alkey.handle import invalidate_tokens
+        from alkey.handle import record_changed
+        from alkey.sharding import ShardedRedis
+
+        class FailingRedis(redis.StrictRedis):
+            def pipeline(self, transaction=True, shard_hint=None):
+                pipeline = super(FailingRedis, self).pipeline(
+                        transaction=transaction, shard_hint=shard_hint)
+                pipeline.execute = Mock(side_effect=redis.ConnectionError)
+                return pipeline
+
+        other = FailingRedis(db=TEST_SETTINGS['redis.db'] + 1)
+        self.addCleanup(other.flushdb)
+        client = ShardedRedis([self.redis, other])
+        self.addCleanup(client.close)
+
+        # Record the changes in a changed set that lives on the healthy node,
+        # for instances whose tokens live on both nodes.
+        session_id = 0
+        while client.get_index(get_changed_key(session_id)) != 0:
+            session_id += 1
+        instances = [self.makeInstance(id=i) for i in range(1, 21)]
+        record_changed(client, session_id, instances)
+        changed_key = get_changed_key(session_id)
+        self.assertTrue(self.redis.scard(changed_key) == 20)
+
+        self.assertRaises(redis.ConnectionError, invalidate_tokens, client,
+                session_id)
+        self.assertTrue(self.redis.scard(changed_key) == 20)
+
+    def test_pinned_requests_read_tokens_from_the_primary(self):
+        """Token reads go to a replica until the request is pinned to the
+          primary, after which it sees its own writes.
+        """
+
+        import redis
+        from alkey.cache import get_token
+        from alkey.cache import set_token
+        from alkey.replicas import ReplicaRouter
+        from alkey.replicas import is_pinned
+        from alkey.replicas import pin_to_primary
+
+        replica = redis.StrictRedis(db=TEST_SETTINGS['redis.db'] + 1)
+        self.addCleanup(replica.flushdb)
+        replica_set = Mock()
+        replica_set.choose.return_value = replica
+        request = Mock()
+        request.environ = {}
+        client = ReplicaRouter(self.redis, replica_set,
+                is_pinned=lambda: is_pinned(request))
+
+        # A lagging replica has the old token.
+        instance = self.makeInstance()
+        set_token(replica, instance, u'old')
+        set_token(self.redis, instance, u'new')
+        self.assertTrue(get_token(client, instance) == u'old')
+
+        pin_to_primary(request)
+        self.assertTrue(get_token(client, instance) == u'new')
+
+    def test_failed_replica_reads_are_retried_on_the_primary(self):
+        """A replica that times out is skipped until it's next checked and
+          the read is served by the primary.
+        """
+
+        import redis
+        from alkey.cache import get_token
+        from alkey.cache import set_token
+        from alkey.replicas import ReplicaRouter
+        from alkey.replicas import ReplicaSet
+
+        class HungRedis(redis.StrictRedis):
+            def execute_command(self, *args, **options):
+                raise redis.TimeoutError(u'Timeout reading from socket')
+
+        replica = HungRedis(db=TEST_SETTINGS['redis.db'] + 1)
+        replica_set = ReplicaSet([replica], check_interval=60)
+        replica_set.checked = replica_set.now()
+        replica_set.healthy = [replica]
+        client = ReplicaRouter(self.redis, replica_set)
+
+        instance = self.makeInstance()
+        set_token(self.redis, instance, u'token')
+        self.assertTrue(get_token(client, instance) == u'token')
+        self.assertTrue(replica_set.healthy == [])
+        self.assertTrue(get_token(client, instance) == u'token')
+
+    def test_tracked_tokens_stay_coherent(self):
+        """Tokens read through a ``TrackingRedis`` client change when they're
+          invalidated, whether or not the server supports tracking.
+        """
+
+        import time
+        from alkey.cache import get_token
+        from alkey.handle import record_changed
+        from alkey.handle import invalidate_tokens
+        from alkey.replicas import is_pinned
+        from alkey.replicas import pin_to_primary
+        from alkey.tracking import TokenTracker
+        from alkey.tracking import TrackingRedis
+
+        tracker = TokenTracker(self.redis, poll_interval=0.1)
+        tracker.start()
+        self.addCleanup(tracker.stop)
+        for i in range(20):
+            if tracker.available or not tracker.supported:
+                break
+            time.sleep(0.1)
+        client = TrackingRedis(self.redis, tracker)
+
+        instance = self.makeInstance()
+        token1 = get_token(client, instance)
+        self.assertTrue(get_token(client, instance) == token1)
+
+        record_changed(self.redis, 'session_id', [instance])
+        invalidate_tokens(self.redis, 'session_id')
+        for i in range(20):
+            if get_token(client, instance) != token1:
+                break
+            time.sleep(0.1)
+        self.assertTrue(get_token(client, instance) != token1)
+
+        # A request that's been pinned to the primary, as it is once it's
+        # committed, sees its own writes straight away.
+        request = Mock()
+        request.environ = {}
+        client = TrackingRedis(self.redis, tracker,
+                is_pinned=lambda: is_pinned(request))
+        token2 = get_token(client, instance)
+        self.assertTrue(get_token(client, instance) == token2)
+        invalidate = tracker.invalidate
+        tracker.invalidate = lambda keys: None # Delay the pushed invalidation.
+        try:
+            record_changed(self.redis, 'session_id', [instance])
+            pin_to_primary(request)
+            invalidate_tokens(self.redis, 'session_id')
+            self.assertTrue(get_token(client, instance) != token2)
+        finally:
+            tracker.invalidate = invalidate
+
+
+    def test_bulk_and_core_changes_invalidate_tokens(self):
+        """Bulk query updates and deletes and Core DML statements executed
+          in a session invalidate the table tokens and the tokens of the
+          rows they're known to have changed.
+        """
+
+        from sqlalchemy import Column, Integer, Unicode
+        from sqlalchemy.ext.declarative import declarative_base
+        from alkey.cache import get_token
+
+        class User(declarative_base()):
+            __tablename__ = 'users'
+            id = Column(Integer, primary_key=True)
+            name = Column(Unicode)
+
+        session = self.makeSession(User)
+        session.add_all([User(id=1, name=u'a'), User(id=2, name=u'b')])
+        session.commit()
+        user1, user2 = session.query(User).order_by(User.id).all()
+
+        # A bulk update invalidates the rows it matched and the table.
+        tokens = [get_token(self.redis, item) for item in (User, user1, user2)]
+        query = session.query(User).filter(User.id == 1)
+        query.update({'name': u'c'}, synchronize_session='fetch')
+        session.commit()
+        self.assertTrue(get_token(self.redis, User) != tokens[0])
+        self.assertTrue(get_token(self.redis, user1) != tokens[1])
+        self.assertTrue(get_token(self.redis, user2) == tokens[2])
+
+        # As do Core statements keyed by primary key.
+        tokens = [get_token(self.redis, item) for item in (User, user1, user2)]
+        session.execute(User.__table__.update().values(name=u'd').where(
+                User.__table__.c.id == 2))
+        session.bulk_update_mappings(User, [{'id': 1, 'name': u'e'}])
+        session.commit()
+        self.assertTrue(get_token(self.redis, User) != tokens[0])
+        self.assertTrue(get_token(self.redis, user1) != tokens[1])
+
+        # Whilst changes that are rolled back don't invalidate anything.
+        tokens = [get_token(self.redis, item) for item in (User, user1)]
+        session.query(User).delete(synchronize_session='evaluate')
+        session.rollback()
+        self.assertTrue(get_token(self.redis, User) == tokens[0])
+        self.assertTrue(get_token(self.redis, user1) == tokens[1])
+
+    def test_bulk_mode_only_records_tables(self):
+        """In bulk mode, commits invalidate the table and global write tokens
+          rather than storing a token for every changed row.
+        """
+
+        from sqlalchemy import Column, ForeignKey, Integer
+        from sqlalchemy.ext.declarative import declarative_base
+        from sqlalchemy.orm import relationship
+        from alkey import bulk_mode
+        from alkey.cache import get_token
+        from alkey.constants import GLOBAL_WRITE_TOKEN
+
+        Base = declarative_base()
+        class User(Base):
+            __tablename__ = 'users'
+            id = Column(Integer, primary_key=True)
+        class Order(Base):
+            __tablename__ = 'orders'
+            id = Column(Integer, primary_key=True)
+            user_id = Column(Integer, ForeignKey('users.id'))
+            user = relationship(User)
+
+        session = self.makeSession(Base)
+        session.add(User(id=1))
+        session.commit()
+        user = session.query(User).get(1)
+        tokens = [get_token(self.redis, item) for item in
+                (User, Order, user, GLOBAL_WRITE_TOKEN)]
+
+        with bulk_mode(session):
+            session.add_all([Order(id=i, user_id=1) for i in range(1, 101)])
+            session.commit()
+
+        # The tables are invalidated, including the related table, but the
+        # individual rows aren't stored.
+        self.assertTrue(get_token(self.redis, User) != tokens[0])
+        self.assertTrue(get_token(self.redis, Order) != tokens[1])
+        self.assertTrue(get_token(self.redis, user) == tokens[2])
+        self.assertTrue(get_token(self.redis, GLOBAL_WRITE_TOKEN) != tokens[3])
+        order_keys = self.redis.keys('alkey.cache.TOKENS:alkey:orders#[0-9]*')
+        self.assertTrue(len(order_keys) == 0)
+
+        # Unless within the ``max_rows`` allowance.
+        with bulk_mode(session, max_rows=1):
+            session.query(User).filter(User.id == 1).update({'id': 1},
+                    synchronize_session='fetch')
+            session.commit()
+        self.assertTrue(get_token(self.redis, user) != tokens[2])
+
+    def test_bucketed_tokens(self):
+        """Row tokens stored in per table hashes behave like string tokens."""
+
+        from alkey.buckets import BucketedRedis
+        from alkey.cache import get_token
+        from alkey.cache import get_tokens
+        from alkey.constants import GLOBAL_WRITE_TOKEN
+        from alkey.handle import invalidate_tokens
+        from alkey.handle import record_changed
+
+        client = BucketedRedis(self.redis)
+        instances = [self.makeInstance(id=i) for i in range(98, 103)]
+        tokens = get_tokens(client, instances + [GLOBAL_WRITE_TOKEN])
+        self.assertTrue(tokens == [get_token(client, item) for item in
+                instances + [GLOBAL_WRITE_TOKEN]])
+
+        # The rows are stored in two buckets, plus the global token.
+        keys = self.redis.keys('alkey.cache.*')
+        self.assertTrue(len(keys) == 3)
+        self.assertTrue(self.redis.ttl('alkey.cache.BUCKETS:users:0') > 0)
+
+        # Invalidating a row only changes its own token.
+        record_changed(client, 'session_id', [instances[0]])
+        invalidate_tokens(client, 'session_id')
+        values = get_tokens(client, instances)
+        self.assertTrue(values[0] != tokens[0])
+        self.assertTrue(values[1:] == tokens[1:len(instances)])
+
+    def test_sweep_orphaned_changed_sets(self):
+        """The sweeper invalidates the changed sets that have been idle for
+          too long, leaving the ones that are in use.
+        """
+
+        from alkey.cache import get_token
+        from alkey.constants import CHANGED_SET_EXPIRES
+        from alkey.handle import get_changed_key
+        from alkey.handle import invalidate_tokens
+        from alkey.handle import record_changed
+        from alkey.sweep import Sweeper
+
+        instances = [self.makeInstance(id=i) for i in range(1, 6)]
+        tokens = [get_token(self.redis, item) for item in instances]
+        record_changed(self.redis, 'orphaned', instances[:4])
+        record_changed(self.redis, 'active', instances[4:])
+        orphaned_key = get_changed_key('orphaned')
+        self.redis.expire(orphaned_key, CHANGED_SET_EXPIRES - 900)
+
+        sweeper = Sweeper(self.redis, min_idle=600, action='invalidate',
+                rate=0, batch_size=3)
+        results = dict((item.session_id, item) for item in sweeper.sweep())
+        self.assertTrue(results['orphaned'].orphaned)
+        self.assertTrue(results['orphaned'].size == 4)
+        self.assertFalse(results['active'].orphaned)
+
+        # The orphaned set's tokens were updated, but its members are left
+        # to expire, in case its session is still open.
+        self.assertTrue(self.redis.scard(orphaned_key) == 4)
+        new_tokens = [get_token(self.redis, item) for item in instances]
+        for i, item in enumerate(instances):
+            changed = new_tokens[i] != tokens[i]
+            self.assertTrue(changed == (i < 4))
+
+        # So a later commit of the session still invalidates them.
+        invalidate_tokens(self.redis, 'orphaned')
+        self.assertFalse(self.redis.exists(orphaned_key))
+        for i, item in enumerate(instances[:4]):
+            self.assertTrue(get_token(self.redis, item) != new_tokens[i])
+
+    def test_declared_parents_are_invalidated(self):
+        """Changing an instance invalidates the parents its class declares in
+          ``__alkey_parents__``, transitively, including the parents it's
+          moved away from.
+        """
+
+        from sqlalchemy import Column, ForeignKey, Integer, Unicode
+        from sqlalchemy.ext.declarative import declarative_base
+        from sqlalchemy.orm import relationship
+        from alkey.cache import get_token
+
+        Base = declarative_base()
+        class Order(Base):
+            __tablename__ = 'orders'
+            id = Column(Integer, primary_key=True)
+        class LineItem(Base):
+            __tablename__ = 'line_items'
+            __alkey_parents__ = ('parent_order',)
+            id = Column(Integer, primary_key=True)
+            order_ref = Column(Integer, ForeignKey('orders.id'))
+            parent_order = relationship(Order, backref='items')
+        class Option(Base):
+            __tablename__ = 'options'
+            __alkey_parents__ = ('line_item',)
+            id = Column(Integer, primary_key=True)
+            line_item_id = Column(Integer, ForeignKey('line_items.id'))
+            line_item = relationship(LineItem)
+            name = Column(Unicode)
+
+        session = self.makeSession(Base)
+        session.add_all([Order(id=1), Order(id=2), LineItem(id=1, order_ref=1),
+                Option(id=1, line_item_id=1, name=u'a')])
+        session.commit()
+        order1, order2 = session.query(Order).order_by(Order.id).all()
+        item = session.query(LineItem).get(1)
+        option = session.query(Option).get(1)
+        tokens = [get_token(self.redis, x) for x in (order1, order2, item)]
+
+        # Changing the option invalidates its item and, through the loaded
+        # item, the order.
+        option.name = u'b'
+        session.commit()
+        values = [get_token(self.redis, x) for x in (order1, order2, item)]
+        self.assertTrue(values[0] != tokens[0])
+        self.assertTrue(values[1] == tokens[1])
+        self.assertTrue(values[2] != tokens[2])
+
+        # Moving the item invalidates both orders.
+        item.order_ref = 2
+        session.commit()
+        tokens = values
+        values = [get_token(self.redis, x) for x in (order1, order2)]
+        self.assertTrue(values[0] != tokens[0])
+        self.assertTrue(values[1] != tokens[1])
+
+    def test_conditional_view(self):
+        """Views decorated with ``conditional_view`` return ``304`` until the
+          instances their etag is derived from change.
+        """
+
+        from pyramid.registry import Registry
+        from pyramid.request import Request
+        from pyramid.response import Response
+        from alkey.cache import CacheKeyGenerator
+        from alkey.handle import invalidate_tokens
+        from alkey.handle import record_changed
+        from alkey.http import conditional_view
+
+        instance = self.makeInstance()
+        calls = []
+        def view(context, request):
+            calls.append(request)
+            return Response(u'body')
+        decorated = conditional_view(lambda request: (instance,))(view)
+        def get(etag=None):
+            headers = {'If-None-Match': '"{0}"'.format(etag)} if etag else {}
+            request = Request.blank('/', headers=headers)
+            request.registry = Registry()
+            request.cache_key = CacheKeyGenerator(self.redis)
+            return decorated(None, request)
+
+        response = get()
+        self.assertTrue(response.status_int == 200)
+        etag = response.etag
+        self.assertTrue(get(etag).status_int == 304)
+        self.assertTrue(len(calls) == 1)
+
+        # Changing the instance changes the etag.
+        record_changed(self.redis, 'session_id', [instance])
+        invalidate_tokens(self.redis, 'session_id')
+        response = get(etag)
+        self.assertTrue(response.status_int == 200)
+        self.assertTrue(response.etag != etag)
+
+        # Salted views have their own etags and send the same headers with
+        # the ``304``.
+        unsalted = response.etag
+        decorated = conditional_view(lambda request: (instance,), salt=u'v2',
+                vary=('Accept',), cache_control='max-age=60')(view)
+        salted = get(unsalted)
+        self.assertTrue(salted.status_int == 200)
+        self.assertTrue(salted.etag != unsalted)
+        response = get(salted.etag)
+        self.assertTrue(response.status_int == 304)
+        self.assertTrue(response.vary == ('Accept',))
+        self.assertTrue(response.headers['Cache-Control'] == 'max-age=60')
+
+    def test_digest_cache_key(self):
+        """Digest keys are a fixed length, change when the tokens change and
+          the segments they're derived from can still be revealed.
+        """
+
+        from alkey.cache import CacheKeyGenerator
+        from alkey.handle import invalidate_tokens
+        from alkey.handle import record_changed
+
+        instances = [self.makeInstance(id=i) for i in range(1, 11)]
+        generator = CacheKeyGenerator(self.redis, digest=True, prefix=u'app:')
+        key = generator(u'orders', *instances)
+        self.assertTrue(key.startswith(u'app:'))
+        self.assertTrue(len(key) == len(u'app:') + 32)
+        self.assertTrue(generator(u'orders', *instances) == key)
+
+        # The full key is made up of the segments.
+        segments = generator.segments(u'orders', *instances)
+        self.assertTrue(u'alkey:users#10' in segments)
+        full_key = CacheKeyGenerator(self.redis)(u'orders', *instances)
+        self.assertTrue(full_key == u'/'.join(segments))
+
+        record_changed(self.redis, 'session_id', instances[-1:])
+        invalidate_tokens(self.redis, 'session_id')
+        self.assertTrue(generator(u'orders', *instances) != key)
+
+    def test_lazy_cache_keys(self):
+        """Lazy keys resolve to the same keys, reading all of the pending
+          tokens in one go.
+        """
+
+        from alkey.cache import CacheKeyGenerator
+
+        instances = [self.makeInstance(id=i) for i in range(1, 4)]
+        generator = CacheKeyGenerator(self.redis)
+        expected = [generator(u'fragment', item) for item in instances]
+
+        calls = []
+        get_tokens = generator.get_tokens
+        def counting_get_tokens(*args):
+            calls.append(args)
+            return get_tokens(*args)
+        generator.get_tokens = counting_get_tokens
+        placeholders = [generator.lazy(u'fragment', item) for item in instances]
+        self.assertTrue(not calls)
+        self.assertTrue(unicode(placeholders[1]) == expected[1])
+        self.assertTrue([unicode(item) for item in placeholders] == expected)
+        self.assertTrue(len(calls) == 1)
+        self.assertTrue(not generator.pending)
+
+    def test_host_token_table(self):
+        """Tokens read through one process's table are served to the others
+          until the listener invalidates them.
+        """
+
+        import os
+        import tempfile
+        from alkey.cache import CacheKeyGenerator
+        from alkey.cache import get_token_key
+        from alkey.hosttable import HostTokenListener
+        from alkey.hosttable import HostTokenRedis
+        from alkey.hosttable import HostTokenTable
+
+        path = tempfile.mktemp()
+        tables = [HostTokenTable(path, slots=64), HostTokenTable(path, slots=64)]
+        try:
+            listener = HostTokenListener(self.redis, tables[0])
+            listener.elected = True
+            listener.beat()
+            clients = [HostTokenRedis(self.redis, listener)]
+            clients.append(HostTokenRedis(self.redis, Mock(table=tables[1])))
+
+            instance = self.makeInstance(id=1)
+            # The first read misses and sets the token, the second fills.
+            CacheKeyGenerator(clients[0])(instance)
+            key = CacheKeyGenerator(clients[0])(instance)
+            token_key = get_token_key(instance)
+            self.assertTrue(tables[1].lookup([token_key])[0][0] is not None)
+            self.assertTrue(CacheKeyGenerator(clients[1])(instance) == key)
+            self.assertTrue(not clients[1].listener.redis.mget.called)
+
+            listener.invalidate([token_key])
+            self.assertTrue(tables[1].lookup([token_key])[1] == [0])
+        finally:
+            for table in tables:
+                table.close()
+            os.unlink(path)
+
+    def test_dogpile_region(self):
+        """Multi key regions cache each instance's value until its token
+          changes.
+        """
+
+        from alkey.handle import invalidate_tokens
+        from alkey.handle import record_changed
+        from alkey.region import get_cache_region
+
+        settings = {'alkey.dogpile.distributed_lock': 'false'}
+        region = get_cache_region(self.redis, settings)
+        self.assertTrue(region.backend.client is self.redis)
+
+        created = []
+        @region.cache_multi_on_arguments()
+        def render(*instances):
+            created.extend(instances)
+            return [u'user {0}'.format(item.id) for item in instances]
+
+        instances = [self.makeInstance(id=i) for i in range(1, 4)]
+        self.assertTrue(render(*instances) == [u'user 1', u'user 2', u'user 3'])
+        self.assertTrue(render(*instances) == [u'user 1', u'user 2', u'user 3'])
+        self.assertTrue(len(created) == 3)
+
+        record_changed(self.redis, 'session_id', instances[1:2])
+        invalidate_tokens(self.redis, 'session_id')
+        render(*instances)
+        self.assertTrue(created[3:] == instances[1:2])
+
+    def test_change_feed_records_commits(self):
+        """The changes are recorded to the feed in the invalidation pipeline."""
+
+        from alkey.cache import get_token
+        from alkey.handle import invalidate_tokens
+        from alkey.handle import record_changed
+
+        instances = [self.makeInstance(id=1), self.makeInstance('orders', 2)]
+        record_changed(self.redis, 'session_id', instances)
+        feed = Mock()
+        invalidate_tokens(self.redis, 'session_id', feed=feed)
+
+        pipeline, oids, tablenames, value = feed.record.call_args[0]
+        self.assertTrue(sorted(oids) == ['alkey:orders#2', 'alkey:users#1'])
+        self.assertTrue(tablenames == set(['orders', 'users']))
+        self.assertTrue(get_token(self.redis, instances[0]) == value)
+        self.assertTrue(feed.record.call_args[1]['bumps_global'])
+
+    def test_concurrent_workers_dont_read_stale_tokens(self):
+        """Threads concurrently flushing, committing and rolling back changes
+          and generating cache keys never read a stale cached value.
+        """
+
+        import os
+        import tempfile
+        from alkey.tests.stress import create_items
+        from alkey.tests.stress import get_engine
+        from alkey.tests.stress import get_session_cls
+        from alkey.tests.stress import run_threads
+
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        try:
+            engine = get_engine(db_path)
+            create_items(engine, 5)
+            session_cls = get_session_cls(engine, self.redis)
+            counts = run_threads(session_cls, self.redis, threads=4,
+                    iterations=50, items=5)
+        finally:
+            os.remove(db_path)
+        self.assertTrue(counts['reads'] > 0 and counts['writes'] > 0)
+        self.assertTrue(counts['hits'] > 0)
+        self.assertTrue(counts['stale'] == 0)
+
+    def test_session_ids_are_unique_across_processes(self):
+        """Sessions in different (forked) processes don't share a changed
+          set, even though their ``hash_key`` counters start from the same
+          value.
+        """
+
+        import multiprocessing
+
+        pool = multiprocessing.Pool(2)
+        try:
+            session_ids = pool.map(get_new_session_id, range(2))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertTrue(len(set(session_ids)) == 2)
+
+    def test_heat_map_merges_counts(self):
+        """The invalidations are counted and merged into Redis, where the
+          worst offenders are reported.
+        """
+
+        from alkey.handle import invalidate_tokens
+        from alkey.handle import record_changed
+        from alkey.heatmap import HeatMap
+        from alkey.heatmap import get_report
+
+        heat = HeatMap()
+        for i in range(3):
+            instances = [self.makeInstance(id=1), self.makeInstance('orders', i)]
+            record_changed(self.redis, 'session_id', instances)
+            invalidate_tokens(self.redis, 'session_id', heat=heat)
+        heat.stop()
+        self.assertTrue(heat.thread.daemon)
+        heat.write(self.redis)
+
+        report = get_report(self.redis, count=2)
+        self.assertTrue(report['oids'][0] == (u'alkey:users#1', 3))
+        self.assertTrue(len(report['oids']) == 2)
+        self.assertTrue(report['tables'] == [(u'orders', 3), (u'users', 3)])
+        self.assertTrue(report['commits'] == 3)
+        self.assertTrue(report['global_fraction'] == 1.0)
+
+    def test_relay_applies_changes(self):
+        """The relay applies the latest token for each oid to the targets."""
+
+        from alkey.cache import get_token
+        from alkey.feed import Change
+        from alkey.relay import Relay
+
+        instance = self.makeInstance(id=1)
+        reader = Mock()
+        reader.has_gap.return_value = False
+        reader.read.return_value = [
+            Change(u'1-0', u'first', [u'alkey:users#1'], [u'users']),
+            Change(u'2-0', u'second', [u'alkey:users#1', u'alkey:users#2'],
+                    [u'users']),
+        ]
+        relay = Relay(reader, [self.redis], window=0)
+        self.assertTrue(relay.step() == 4)
+        self.assertTrue(get_token(self.redis, instance) == 'second')
+        self.assertTrue(get_token(self.redis, 'alkey:users#*') == 'second')
+        reader.ack.assert_called_with([u'1-0', u'2-0'])
+
+    def test_serialized_cache_manager(self):
+        """Cached values are serialised and compressed by the namespace
+          manager, alongside values stored by the wrapped manager.
+        """
+
+        from alkey.cache import get_cache_manager
+
+        request = Mock()
+        request.registry.settings = {
+            'cache.type': 'memory',
+            'cache.serializer': 'raw',
+            'cache.compression': 'zlib',
+            'cache.compression_threshold': '100',
+        }
+        cache = get_cache_manager(request).get_cache('test_serialized')
+        fragment = u'<li>fragment</li>' * 100
+        self.assertTrue(cache.get('key', createfunc=lambda: fragment) == fragment)
+        self.assertTrue(cache.get('key', createfunc=lambda: None) == fragment)
+        stored = cache.namespace.inner['key']
+        self.assertTrue(stored.startswith('AKuz') and len(stored) < 200)
+
+        cache.namespace.inner['old'] = (cache.starttime or 0, None, u'old value')
+        self.assertTrue(cache.get('old') == u'old value')
+
+    def test_msgpack_serialized_values_keep_their_types(self):
+        """Values that msgpack can't round trip exactly are pickled."""
+
+        from collections import OrderedDict
+        from alkey.serializers import decode_value
+        from alkey.serializers import encode_value
+
+        def round_trip(value):
+            data = encode_value((1.0, None, value), serializer='msgpack')
+            return decode_value(data)[2]
+
+        stored = round_trip({u'ids': (1, 2), 'name': u'name'})
+        self.assertTrue(type(stored[u'ids']) is tuple)
+        stored = round_trip(OrderedDict([(u'b', 1), (u'a', 2)]))
+        self.assertTrue(stored.keys() == [u'b', u'a'])
+        stored = round_trip([u'text', 'bytes', 2 ** 70])
+        self.assertTrue(stored == [u'text', 'bytes', 2 ** 70])
+        self.assertTrue(type(stored[0]) is unicode and type(stored[1]) is str)
+
+    def test_sliding_token_ttls(self):
+        """Tokens are stored with a short TTL, which reads extend."""
+
+        from alkey.cache import get_token_key
+        from alkey.cache import get_tokens
+        from alkey.expiry import SlidingExpiryRedis
+        from alkey.handle import invalidate_tokens
+        from alkey.handle import record_changed
+        from alkey.replicas import ReplicaRouter
+
+        client = SlidingExpiryRedis(self.redis, initial_ttl=60, max_ttl=600)
+        instance = self.makeInstance(id=1)
+        key = get_token_key(instance)
+
+        get_tokens(client, [instance])
+        self.assertTrue(0 < self.redis.ttl(key) <= 60)
+        get_tokens(client, [instance])
+        self.assertTrue(self.redis.ttl(key) > 60)
+
+        # Invalidated tokens start again with the short TTL.
+        record_changed(client, 'session_id', [instance])
+        invalidate_tokens(client, 'session_id')
+        self.assertTrue(0 < self.redis.ttl(key) <= 60)
+        self.assertTrue(self.redis.ttl(u'alkey.cache.TOKENS:alkey:*#*') <= 60)
+
+        # Reads routed to a replica are extended on the primary.
+        replica = Mock(wraps=self.redis, spec=['execute_command'])
+        replica_set = Mock(spec=['choose'])
+        replica_set.choose.return_value = replica
+        router = ReplicaRouter(self.redis, replica_set)
+        client = SlidingExpiryRedis(router, initial_ttl=60, max_ttl=600,
+                primary=self.redis)
+        get_tokens(client, [instance])
+        self.assertTrue(replica.execute_command.called)
+        self.assertTrue(self.redis.ttl(key) > 60)
+
+    def test_loaded_instances_tokens_are_prefetched(self):
+        """The tokens of the instances a request loads are read in one batch
+          and dropped when the session commits.
+        """
+
+        from functools import partial
+        from sqlalchemy import Column, Integer, Unicode
+        from sqlalchemy.ext.declarative import declarative_base
+        from alkey import prefetch
+        from alkey.cache import CacheKeyGenerator
+        from alkey.cache import get_token
+        from alkey.cache import get_token_key
+        from alkey.cache import read_tokens
+        from alkey.constants import PREFETCHER_KEY
+
+        class User(declarative_base()):
+            __tablename__ = 'users'
+            id = Column(Integer, primary_key=True)
+            name = Column(Unicode)
+
+        session = self.makeSession(User)
+        mock_read_tokens = Mock(side_effect=read_tokens)
+        prefetcher = prefetch.TokenPrefetcher(self.redis,
+                read_tokens_=mock_read_tokens)
+        request = Mock()
+        request.environ = {PREFETCHER_KEY: prefetcher}
+        kwargs = dict(get_request=lambda: request)
+        prefetch.bind(type(session), mapper_cls=User,
+                load=partial(prefetch.handle_load, **kwargs),
+                refresh=partial(prefetch.handle_refresh, **kwargs),
+                commit=partial(prefetch.handle_commit, **kwargs))
+        session.add_all([User(id=i, name=u'a') for i in range(1, 4)])
+        session.commit()
+        session.expunge_all()
+
+        users = session.query(User).order_by(User.id).all()
+        self.redis.delete(get_token_key(users[2]))
+        generator = CacheKeyGenerator(self.redis,
+                get_tokens_=prefetcher.get_tokens)
+        keys = [generator(item) for item in users[:2]]
+        self.assertTrue(mock_read_tokens.call_count == 1)
+        self.assertTrue(mock_read_tokens.call_args[0][1] == [u'alkey:users#1',
+                u'alkey:users#2', u'alkey:users#3'])
+
+        # Prefetching doesn't write tokens for the rows that aren't keyed.
+        self.assertFalse(self.redis.exists(get_token_key(users[2])))
+        generator(users[2])
+        self.assertTrue(self.redis.exists(get_token_key(users[2])))
+
+        # A commit drops the prefetched tokens, so changes are seen.
+        users[0].name = u'b'
+        session.commit()
+        self.assertTrue(generator(users[0]) != keys[0])
+        self.assertTrue(get_token(self.redis, users[0]) in generator(users[0]))
+
+    def test_untracked_tables_are_skipped(self):
+        """Changes to untracked classes aren't recorded and changes to classes
+          that opt out of the global write token don't bump it.
+        """
+
+        from sqlalchemy import Column, ForeignKey, Integer, Unicode
+        from sqlalchemy.ext.declarative import declarative_base
+        from sqlalchemy.orm import relationship
+        from alkey.cache import get_token
+        from alkey.cache import get_token_key
+
+        Base = declarative_base()
+
+        class User(Base):
+            __tablename__ = 'users'
+            id = Column(Integer, primary_key=True)
+            name = Column(Unicode)
+
+        class AuditLog(Base):
+            __tablename__ = 'audit_logs'
+            __alkey_track__ = False
+            id = Column(Integer, primary_key=True)
+            user_id = Column(Integer, ForeignKey('users.id'))
+            user = relationship(User)
+
+        class Counter(Base):
+            __tablename__ = 'counters'
+            __alkey_global__ = False
+            id = Column(Integer, primary_key=True)
+            value = Column(Integer)
+
+        session = self.makeSession(Base)
+        user = User(id=1, name=u'a')
+        session.add_all([user, Counter(id=1, value=0)])
+        session.commit()
+        global_key = get_token_key(u'alkey:*#*')
+        tokens = [get_token(self.redis, User), get_token(self.redis, user),
+                self.redis.get(global_key)]
+
+        # Untracked changes don't write any tokens.
+        session.add(AuditLog(id=1, user_id=1))
+        session.commit()
+        session.execute(AuditLog.__table__.delete())
+        session.commit()
+        self.assertTrue(not self.redis.exists(get_token_key(AuditLog)))
+        self.assertTrue(get_token(self.redis, User) == tokens[0])
+        self.assertTrue(get_token(self.redis, user) == tokens[1])
+        self.assertTrue(self.redis.get(global_key) == tokens[2])
+
+        # Counter changes invalidate the counters, but not the global token.
+        counter_token = get_token(self.redis, Counter)
+        session.query(Counter).update({'value': Counter.value + 1},
+                synchronize_session=False)
+        session.commit()
+        self.assertTrue(get_token(self.redis, Counter) != counter_token)
+        self.assertTrue(self.redis.get(global_key) == tokens[2])
+
+        # Whilst tracked changes still do.
+        user.name = u'b'
+        session.commit()
+        self.assertTrue(self.redis.get(global_key) != tokens[2])
+
+    def test_popular_tokens_are_warmed(self):
+        """Sampled token reads are scored by popularity and the most popular
+          tokens are read back in one batch.
+        """
 
+        from alkey.cache import CacheKeyGenerator
+        from alkey.cache import get_token_key
+        from alkey.cluster import mget_by_slot
+        from alkey.popularity import PopularityRedis
+        from alkey.popularity import PopularityTracker
+        from alkey.popularity import Warmer
+
+        tracker = PopularityTracker(self.redis, sample_rate=1)
+        client = PopularityRedis(self.redis, tracker)
+        instances = [self.makeInstance(id=i) for i in range(1, 4)]
+        generator = CacheKeyGenerator(client)
+        generator(*instances)
+        generator(instances[1])
+
+        popular = client.popularity.top(1)
+        self.assertTrue(popular == [get_token_key(instances[1])])
+        warmer = Warmer(client.inner, client.popularity, count=10)
+        self.assertTrue(warmer.warm() == 3)
+        self.assertTrue(client.popularity.decay())
+        self.assertTrue(not client.popularity.decay())
+
+        # Reads made in pipelines, e.g.: by ``mget_by_slot``, are sampled too.
+        key = get_token_key(instances[2])
+        score = self.redis.zscore(tracker.key, key)
+        mget_by_slot(client, [key])
+        self.assertTrue(self.redis.zscore(tracker.key, key) > score)
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+
+"""Concurrency stress harness for ``alkey``: runs real SQLAlchemy sessions on
+  a SQLite file db against a Redis db, with many worker processes and threads
+  concurrently flushing, committing and rolling back changes and generating
+  cache keys, e.g.::
+
+      python -m alkey.tests.stress --url redis://localhost:6379 --db 6 \\
+              --workers 1,2,4,8 --threads 2 --duration 10
+
+  Each read generates a cache key for a row and reads the row's version
+  through a shared cache (a Redis hash) keyed by it. A read is *stale* if it
+  hits a cached version that's older than the latest version whose commit
+  (and invalidation) had returned before the read started, i.e.: if a token
+  wasn't invalidated, or an invalidation was lost. The harness reports the
+  stale reads and the throughput for each number of worker processes.
+
+  Note that the Redis db is written to and the harness's keys are deleted
+  between runs, so don't point it at a db that's in use.
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+
+import redis
+
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from alkey import handle
+from alkey.cache import CacheKeyGenerator
+from alkey.events import bind
+
+# The key prefix of the harness's cache and committed versions.
+STRESS_KEY = 'alkey.stress'
+
+COUNTERS = ('reads', 'hits', 'stale', 'writes', 'bulk', 'rollbacks', 'errors')
+
+Base = declarative_base()
+
+class Item(Base):
+    __tablename__ = 'stress_items'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+def create_items(engine, count):
+    """Create the table with ``count`` rows at version ``0``."""
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    engine.execute(Item.__table__.insert(),
+            [{'id': i, 'version': 0} for i in range(1, count + 1)])
+
+def get_engine(db_path):
+    """Return an engine for the SQLite file db, waiting on locks rather than
+      failing straight away.
+    """
+
+    return create_engine('sqlite:///{0}'.format(db_path),
+            connect_args={'timeout': 30})
+
+def get_session_cls(engine, redis_client):
+    """Return a session class with alkey's handlers bound to use the
+      ``redis_client``.
+    """
+
+    session_cls = sessionmaker(bind=engine)
+    kwargs = dict(get_redis=lambda request: redis_client,
+            get_request=lambda: None)
+    bind(session_cls, event=event, engine_cls=engine,
+            commit=partial(handle.handle_commit, **kwargs),
+            flush=partial(handle.handle_flush, **kwargs),
+            rollback=partial(handle.handle_rollback, **kwargs),
+            flushed=handle.handle_flushed, begin=handle.handle_begin,
+            bulk=partial(handle.handle_bulk, **kwargs),
+            execute=partial(handle.handle_execute, **kwargs))
+    return session_cls
+
+def clear_keys(redis_client, key=None):
+    """Delete the harness's keys, the tokens and the changed sets."""
+
+    # Compose.
+    if key is None:
+        key = STRESS_KEY
+
+    patterns = (u'{0}:*'.format(key), u'alkey.cache.TOKENS:*',
+            u'alkey.handle.CHANGED:*')
+    for pattern in patterns:
+        keys = list(redis_client.scan_iter(match=pattern))
+        if keys:
+            redis_client.delete(*keys)
+
+
+class Worker(object):
+    """Run a random mix of reads, writes, bulk updates and rollbacks.
+
+      A write commits a new version of a row and then records it as the floor
+      that subsequent reads must not be older than.
+    """
+
+    def __init__(self, session_cls, redis_client, items=10, write_ratio=0.2,
+            bulk_ratio=0.05, rollback_ratio=0.05, key=None, seed=None):
+        # Compose.
+        if key is None:
+            key = STRESS_KEY
+
+        # Assign.
+        self.session_cls = session_cls
+        self.redis = redis_client
+        self.items = items
+        self.write_ratio = write_ratio
+        self.bulk_ratio = bulk_ratio
+        self.rollback_ratio = rollback_ratio
+        self.key = key
+        self.random = random.Random(seed)
+        self.generator = CacheKeyGenerator(redis_client)
+        self.counts = dict((k, 0) for k in COUNTERS)
+
+    def get_committed_key(self, item_id):
+        return u'{0}:COMMITTED:{1}'.format(self.key, item_id)
+
+    def get_floor(self, item_id):
+        """Return the latest version of the row whose commit has returned."""
+
+        versions = self.redis.zrevrange(self.get_committed_key(item_id), 0, 0)
+        return int(versions[0]) if versions else 0
+
+    def set_floor(self, item_id, version):
+        committed_key = self.get_committed_key(item_id)
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.zadd(committed_key, {str(version): version})
+        pipeline.zremrangebyrank(committed_key, 0, -11)
+        pipeline.execute()
+
+    def read(self, item_id):
+        floor = self.get_floor(item_id)
+        cache_key = self.generator(u'alkey:stress_items#{0}'.format(item_id))
+        cache_hash = u'{0}:CACHE'.format(self.key)
+        cached = self.redis.hget(cache_hash, cache_key)
+        self.counts['reads'] += 1
+        if cached is not None:
+            self.counts['hits'] += 1
+            if int(cached) < floor:
+                self.counts['stale'] += 1
+            return
+        session = self.session_cls()
+        try:
+            version = session.query(Item.version).filter_by(id=item_id).scalar()
+            session.commit()
+        finally:
+            session.close()
+        self.redis.hsetnx(cache_hash, cache_key, version)
+
+    def write(self, item_id, bulk=False, rollback=False):
+        session = self.session_cls()
+        try:
+            query = session.query(Item).filter_by(id=item_id)
+            if bulk:
+                query.update({'version': Item.version + 1},
+                        synchronize_session='fetch')
+            else:
+                item = query.one()
+                item.version = Item.version + 1
+                session.flush()
+            version = session.query(Item.version).filter_by(id=item_id).scalar()
+            if rollback:
+                session.rollback()
+                self.counts['rollbacks'] += 1
+                return
+            session.commit()
+        except OperationalError:
+            session.rollback()
+            self.counts['errors'] += 1
+            return
+        finally:
+            session.close()
+        self.set_floor(item_id, version)
+        self.counts['bulk' if bulk else 'writes'] += 1
+
+    def step(self):
+        item_id = self.random.randint(1, self.items)
+        value = self.random.random()
+        if value < self.rollback_ratio:
+            self.write(item_id, rollback=True)
+        elif value < self.rollback_ratio + self.bulk_ratio:
+            self.write(item_id, bulk=True)
+        elif value < self.rollback_ratio + self.bulk_ratio + self.write_ratio:
+            self.write(item_id)
+        else:
+            self.read(item_id)
+
+    def run(self, duration=None, iterations=None):
+        """Run for ``duration`` seconds or ``iterations`` steps."""
+
+        started = time.time()
+        i = 0
+        while True:
+            if iterations is not None and i >= iterations:
+                break
+            if duration is not None and time.time() - started >= duration:
+                break
+            self.step()
+            i += 1
+        return self.counts
+
+
+def run_threads(session_cls, redis_client, threads=2, seed=0, **kwargs):
+    """Run a ``Worker`` in each of ``threads`` threads, returning the summed
+      counts.
+    """
+
+    run_kwargs = dict((k, kwargs.pop(k)) for k in ('duration', 'iterations')
+            if k in kwargs)
+    workers = [Worker(session_cls, redis_client, seed=seed + i, **kwargs)
+            for i in range(threads)]
+    pool = [threading.Thread(target=item.run, kwargs=run_kwargs)
+            for item in workers]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    totals = dict((k, 0) for k in COUNTERS)
+    for item in workers:
+        for k, v in item.counts.items():
+            totals[k] += v
+    return totals
+
+def run_process(args):
+    """Run the threads of one worker process, with its own engine and redis
+      client.
+    """
+
+    db_path, url, db, seed, kwargs = args
+    redis_client = redis.StrictRedis.from_url(url, db=db)
+    session_cls = get_session_cls(get_engine(db_path), redis_client)
+    return run_threads(session_cls, redis_client, seed=seed, **kwargs)
+
+def run_stress(db_path, url, db, processes=1, **kwargs):
+    """Run ``processes`` worker processes, returning the summed counts and the
+      number of seconds they took.
+    """
+
+    started = time.time()
+    args = [(db_path, url, db, i * 1000, dict(kwargs)) for i in range(processes)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(run_process, args)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - started
+    totals = dict((k, 0) for k in COUNTERS)
+    for counts in results:
+        for k, v in counts.items():
+            totals[k] += v
+    return totals, elapsed
+
+def main(argv=None, output=None):
+    # Compose.
+    if output is None:
+        output = lambda line: sys.stdout.write(u'{0}\n'.format(line))
+
+    parser = argparse.ArgumentParser(description=u'Stress test alkey.')
+    parser.add_argument('--url', default='redis://localhost:6379')
+    parser.add_argument('--db', type=int, default=6)
+    parser.add_argument('--db-path', default=None,
+            help=u'The SQLite file (defaults to a temporary file).')
+    parser.add_argument('--workers', default='1,2,4,8',
+            help=u'Comma separated numbers of worker processes to run.')
+    parser.add_argument('--threads', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--items', type=int, default=10)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    db_path = args.db_path
+    if db_path is None:
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+    redis_client = redis.StrictRedis.from_url(args.url, db=args.db)
+    engine = get_engine(db_path)
+
+    stale = 0
+    for processes in [int(item) for item in args.workers.split(',')]:
+        create_items(engine, args.items)
+        clear_keys(redis_client)
+        counts, elapsed = run_stress(db_path, args.url, args.db,
+                processes=processes, threads=args.threads,
+                duration=args.duration, items=args.items,
+                write_ratio=args.write_ratio)
+        operations = sum(counts[k] for k in COUNTERS if k not in ('hits',
+                'stale', 'errors'))
+        output(u'workers={0} threads={1} ops={2} ops/s={3:.0f} {4}'.format(
+                processes, args.threads, operations, operations / elapsed,
+                u' '.join(u'{0}={1}'.format(k, counts[k]) for k in COUNTERS)))
+        stale += counts['stale']
+    clear_keys(redis_client)
+    return 1 if stale else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+
+"""Provides ``TokenTracker``, a bounded local map of token values that's kept
+  coherent using Redis (6+) `server assisted client side caching
+  <https://redis.io/topics/client-side-caching>`_ in broadcast mode, and
+  ``TrackingRedis``, a redis client that reads tokens from it, e.g.::
+
+      tracker = TokenTracker(redis_client, max_size=10000)
+      tracker.start()
+      client = TrackingRedis(redis_client, tracker)
+      client.get(u'alkey.cache.TOKENS:alkey:users#1') # served locally when hot
+
+  The tracker subscribes a dedicated connection to the invalidation channel
+  and then enables ``CLIENT TRACKING ... BCAST PREFIX alkey.cache.TOKENS:``
+  on a second dedicated connection, redirecting the invalidation messages to
+  the first. If tracking isn't supported (or a connection drops) the local map
+  is cleared and reads fall through to Redis. As do the reads of a request
+  that's been pinned to the primary, so that it sees its own writes.
+"""
+
+__all__ = [
+    'TokenTracker',
+    'TrackingRedis',
+    'get_token_tracker',
+]
+
+import logging
+logger = logging.getLogger(__name__)
+
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+from redis.exceptions import ConnectionError
+from redis.exceptions import RedisError
+from redis.exceptions import ResponseError
+
+from .constants import TOKEN_NAMESPACE
+from .utils import is_token_read
+
+# The channel Redis publishes key invalidations to.
+INVALIDATE_CHANNEL = '__redis__:invalidate'
+
+class TokenTracker(object):
+    """Keep a bounded, least recently used map of token values, invalidated by
+      the messages Redis pushes when the keys change.
+
+      Setup::
+
+          >>> tracker = TokenTracker(None, max_size=2)
+          >>> tracker.available = True
+
+      Values are only stored if they weren't invalidated whilst being read::
+
+          >>> tracker.begin(['a', 'b'])
+          >>> tracker.invalidate(['b'])
+          >>> tracker.finish(['a', 'b'], ['1', '2'])
+          >>> tracker.lookup(['a', 'b'])
+          (['1', None], [1])
+
+      The map is bounded::
+
+          >>> for key in 'cd':
+          ...     tracker.begin([key])
+          ...     tracker.finish([key], [key])
+          >>> tracker.lookup(['a', 'c', 'd'])
+          ([None, 'c', 'd'], [0])
+
+      And cleared when Redis is flushed::
+
+          >>> tracker.invalidate(None)
+          >>> tracker.lookup(['c'])
+          ([None], [0])
+
+    """
+
+    def __init__(self, redis_client, max_size=10000, namespace=None,
+            poll_interval=1, retry_interval=5, sleep=None):
+        # Compose.
+        if namespace is None:
+            namespace = TOKEN_NAMESPACE
+        if sleep is None:
+            sleep = time.sleep
+
+        # Assign.
+        self.redis = redis_client
+        self.max_size = max_size
+        self.prefix = u'{0}:'.format(namespace)
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self.sleep = sleep
+        self.values = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.available = False
+        self.supported = True
+        self.stopped = False
+        self.pubsub = None
+        self.connections = []
+        self.thread = None
+
+    def lookup(self, keys):
+        """Return ``(values, missing)`` where ``missing`` is the list of the
+          indexes of the ``keys`` that aren't stored locally.
+        """
+
+        values = []
+        missing = []
+        with self.lock:
+            for i, key in enumerate(keys):
+                value = self.values.pop(key, None)
+                if value is None:
+                    missing.append(i)
+                else:
+                    self.values[key] = value
+                values.append(value)
+        return values, missing
+
+    def begin(self, keys):
+        """Register that ``keys`` are about to be read from Redis."""
+
+        with self.lock:
+            for key in keys:
+                readers, valid = self.pending.get(key, (0, True))
+                self.pending[key] = (readers + 1, valid)
+
+    def finish(self, keys, values):
+        """Store the ``values`` read for ``keys``, unless they've been
+          invalidated since ``begin`` was called.
+        """
+
+        with self.lock:
+            for key, value in zip(keys, values):
+                readers, valid = self.pending.pop(key, (1, False))
+                if readers > 1:
+                    self.pending[key] = (readers - 1, valid)
+                if valid and value is not None and self.available:
+                    self.values.pop(key, None)
+                    self.values[key] = value
+                    if len(self.values) > self.max_size:
+                        self.values.popitem(last=False)
+
+    def invalidate(self, keys):
+        """Drop ``keys`` (or everything, if ``keys`` is ``None``)."""
+
+        with self.lock:
+            if keys is None:
+                self.values.clear()
+                for key, (readers, valid) in self.pending.items():
+                    self.pending[key] = (readers, False)
+                return
+            for key in keys:
+                self.values.pop(key, None)
+                if key in self.pending:
+                    self.pending[key] = (self.pending[key][0], False)
+
+    def connect(self):
+        """Subscribe to invalidations and enable tracking, raising a
+          ``ResponseError`` if tracking isn't supported.
+        """
+
+        pool = self.redis.connection_pool
+        make_connection = lambda: pool.connection_class(**pool.connection_kwargs)
+
+        # Subscribe a dedicated connection to the invalidation channel.
+        listener = make_connection()
+        self.connections.append(listener)
+        listener.send_command('CLIENT', 'ID')
+        client_id = listener.read_response()
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.connection = listener
+        self.pubsub.subscribe(INVALIDATE_CHANNEL)
+
+        # And enable tracking on another, redirecting the invalidations to it.
+        tracking = make_connection()
+        self.connections.append(tracking)
+        tracking.send_command('CLIENT', 'TRACKING', 'ON', 'REDIRECT', client_id,
+                'BCAST', 'PREFIX', self.prefix)
+        tracking.read_response()
+
+    def disconnect(self):
+        """Stop serving local values and drop the connections."""
+
+        self.available = False
+        self.invalidate(None)
+        # Take the connections, as ``stop`` can be called from another thread
+        # whilst the listener is disconnecting.
+        with self.lock:
+            connections, self.connections = self.connections, []
+            self.pubsub = None
+        for connection in connections:
+            try:
+                connection.disconnect()
+            except RedisError: #pragma: no cover
+                pass
+
+    def poll(self):
+        """Connect if need be and then handle the next message, or make sure
+          the tracking connection is still alive.
+        """
+
+        if not self.available:
+            self.connect()
+            self.available = True
+        # Take references, as ``stop`` can disconnect from another thread.
+        pubsub = self.pubsub
+        connections = self.connections
+        if pubsub is None or not connections:
+            raise ConnectionError(u'Disconnected whilst listening.')
+        message = pubsub.get_message(timeout=self.poll_interval)
+        if message and message['type'] == 'message':
+            self.invalidate(message['data'])
+        else:
+            connections[-1].send_command('PING')
+            connections[-1].read_response()
+        self.beat()
+
+    def listen(self):
+        """Handle invalidation messages, reconnecting if the connection drops.
+
+          Any error stops the local values being served until the connections
+          are re-established, as invalidations may have been missed::
+
+              >>> from mock import Mock
+              >>> tracker = TokenTracker(Mock(), sleep=lambda seconds: None)
+              >>> tracker.available = True
+              >>> tracker.values['a'] = 'a'
+              >>> def poll():
+              ...     tracker.stopped = True
+              ...     raise IndexError
+              >>> tracker.poll = poll
+              >>> tracker.listen()
+              >>> tracker.available, tracker.lookup(['a'])
+              (False, ([None], [0]))
+
+        """
+
+        while not self.stopped:
+            try:
+                self.poll()
+            except ResponseError as err:
+                logger.info(u'Client side caching unavailable: {0}'.format(err))
+                self.supported = False
+                self.disconnect()
+                return
+            except RedisError as err:
+                logger.warn(err, exc_info=True)
+                self.disconnect()
+                if not self.stopped:
+                    self.sleep(self.retry_interval)
+            except Exception as err:
+                if not self.stopped:
+                    logger.error(err, exc_info=True)
+                self.disconnect()
+                if not self.stopped:
+                    self.sleep(self.retry_interval)
+        self.disconnect()
+
+    def beat(self):
+        """Called after each poll whilst the connections are healthy."""
+
+    def start(self):
+        """Start listening for invalidations in a daemon thread."""
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.listen)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """Stop serving local values and listening. The connections are
+          dropped by the listener thread, if it's running, as they can't be
+          closed whilst it's reading from them, so wait briefly for it.
+        """
+
+        self.stopped = True
+        self.available = False
+        self.invalidate(None)
+        if self.thread is None:
+            self.disconnect()
+        elif self.thread is not threading.current_thread():
+            self.thread.join(self.poll_interval + 1)
+
+
+class TrackingRedis(redis.StrictRedis):
+    """Serve token reads from a ``TokenTracker``, falling through to Redis for
+      the tokens that aren't stored locally.
+
+      Setup::
+
+          >>> from mock import Mock
+          >>> inner = Mock()
+          >>> tracker = TokenTracker(Mock())
+          >>> tracker.redis.mget.return_value = ['1']
+          >>> client = TrackingRedis(inner, tracker)
+          >>> key = u'alkey.cache.TOKENS:alkey:users#1'
+
+      Falls through to the inner client unless tracking is available::
+
+          >>> return_value = client.get(key)
+          >>> inner.execute_command.assert_called_with('GET', key)
+
+      Otherwise fills from the tracked client and then serves locally::
+
+          >>> tracker.available = True
+          >>> client.get(key), client.get(key)
+          ('1', '1')
+          >>> tracker.redis.mget.call_count
+          1
+
+      Unless the request has been pinned to the primary, e.g.: because it's
+      committed changes whose invalidations may not have been pushed yet::
+
+          >>> inner.reset_mock()
+          >>> client = TrackingRedis(inner, tracker, is_pinned=lambda: True)
+          >>> return_value = client.get(key)
+          >>> inner.execute_command.assert_called_with('GET', key)
+
+    """
+
+    def __init__(self, inner, tracker, is_pinned=None, is_token_read_=None):
+        # Compose.
+        if is_pinned is None:
+            is_pinned = lambda: False
+        if is_token_read_ is None:
+            is_token_read_ = is_token_read
+
+        # Assign.
+        self.inner = inner
+        self.tracker = tracker
+        self.is_pinned = is_pinned
+        self.is_token_read = is_token_read_
+        self.response_callbacks = {}
+        self.connection = None
+
+    def __repr__(self):
+        return '{0}<{1!r}>'.format(type(self).__name__, self.inner)
+
+    def execute_command(self, *args, **options):
+        if (not self.tracker.available or not self.is_token_read(args) or
+                self.is_pinned()):
+            return self.inner.execute_command(*args, **options)
+
+        keys = args[1:]
+        values, missing = self.tracker.lookup(keys)
+        if missing:
+            # Fill from the tracked client -- not e.g.: a lagging replica.
+            missing_keys = [keys[i] for i in missing]
+            self.tracker.begin(missing_keys)
+            fetched = [None] * len(missing_keys)
+            try:
+                fetched = self.tracker.redis.mget(missing_keys)
+            finally:
+                self.tracker.finish(missing_keys, fetched)
+            for i, value in zip(missing, fetched):
+                values[i] = value
+        if args[0].upper() == 'GET':
+            return values[0]
+        return values
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return self.inner.pipeline(transaction=transaction, shard_hint=shard_hint)
+
+    def scan_iter(self, match=None, count=None):
+        return self.inner.scan_iter(match=match, count=count)
+
+
+def get_token_tracker(redis_client, settings, tracker_cls=None):
+    """Return a started ``TokenTracker`` for ``redis_client``, bounded by
+      ``alkey.tracking.max_size``::
+
+          >>> from mock import Mock
+          >>> mock_tracker_cls = Mock()
+          >>> settings = {'alkey.tracking.max_size': '100'}
+          >>> tracker = get_token_tracker('<client>', settings,
+          ...         tracker_cls=mock_tracker_cls)
+          >>> mock_tracker_cls.assert_called_with('<client>', max_size=100)
+          >>> tracker.start.called
+          True
+
+    """
+
+    # Compose.
+    if tracker_cls is None:
+        tracker_cls = TokenTracker
+
+    max_size = int(settings.get('alkey.tracking.max_size', 10000))
+    tracker = tracker_cls(redis_client, max_size=max_size)
+    tracker.start()
+    return tracker
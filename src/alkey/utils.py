@@ -3,9 +3,14 @@
 """Utility functions."""
 
 __all__ = [
+    'as_bool',
+    'encode_identity',
     'get_object_id',
+    'get_parent_oids',
+    'get_relation_tables',
     'get_stamp',
     'get_table_id',
+    'is_token_read',
     'resiliently_call',
     'unpack_object_id',
     'valid_object_id',
@@ -15,19 +20,94 @@ __all__ = [
 import logging
 logger = logging.getLogger(__name__)
 
+import base64
 import time
+import urllib
+import uuid
 from datetime import datetime
 
 from redis.exceptions import ConnectionError
 
-from sqlalchemy.orm import relationships
-relprop_cls = relationships.RelationshipProperty
+from .constants import TOKEN_NAMESPACE
+
+# The ORM is only imported once it's needed, i.e.: once there are mapped
+# instances, so importing ``alkey`` doesn't pull it in.
+from sqlalchemy import inspect
 
 import re
-valid_object_id = re.compile(r'^alkey:[a-z_]+#[0-9]+$', re.U)
+valid_object_id = re.compile(
+    r'^alkey:[a-z_]+#[A-Za-z0-9_.%~-]+(,[A-Za-z0-9_.%~-]+)*$', re.U)
 valid_write_token = re.compile(r'^alkey:([a-z_]+|[*])#[*]$', re.U)
 
-def get_object_id(instance, table_oid=None):
+def as_bool(value):
+    """Coerce a ``value`` read from the settings to a boolean::
+
+          >>> as_bool('true'), as_bool(' On'), as_bool('0'), as_bool(None)
+          (True, True, False, False)
+
+    """
+
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('true', 'yes', 'on', 'y', 't', '1')
+    return bool(value)
+
+def encode_identity(identity):
+    """Return a compact, object id safe string for a primary key ``identity``,
+      i.e.: the tuple of primary key values SQLAlchemy uses to identify a row.
+
+      Integers are used as they are::
+
+          >>> encode_identity((1234,))
+          u'1234'
+
+      UUIDs are packed into 22 url safe base64 characters::
+
+          >>> encode_identity((uuid.UUID('c3a8f5e4-8a3b-4c6e-9f1d-2b7e5a9c0d41'),))
+          u'w6j15Io7TG6fHSt-WpwNQQ'
+
+      Anything else is coerced to unicode and quoted, so it can't contain the
+      ``#``, ``,`` or ``/`` delimiters::
+
+          >>> encode_identity((u'a#b/c',))
+          u'a%23b%2Fc'
+
+      Composite keys are joined with a comma::
+
+          >>> encode_identity((1, u'en'))
+          u'1,en'
+
+    """
+
+    parts = []
+    for value in identity:
+        if isinstance(value, (int, long)):
+            part = unicode(value)
+        elif isinstance(value, uuid.UUID):
+            part = base64.urlsafe_b64encode(value.bytes).rstrip('=')
+        else:
+            if not isinstance(value, unicode):
+                value = unicode(value)
+            part = urllib.quote(value.encode('utf-8'), safe='')
+        parts.append(part.decode('ascii') if isinstance(part, str) else part)
+    return u','.join(parts)
+
+def get_identity(instance):
+    """Return the primary key identity of a persistent sqlalchemy ``instance``,
+      or ``None`` if it's not mapped or hasn't been flushed yet::
+
+          >>> get_identity('flobble')
+
+    """
+
+    state = inspect(instance, raiseerr=False)
+    if state is None:
+        return None
+    from sqlalchemy.orm.state import InstanceState
+    if isinstance(state, InstanceState):
+        return state.identity
+    return None
+
+def get_object_id(instance, table_oid=None, get_ident=None, encode=None):
     """Return an identifier for a model ``instance``.
 
       Setup::
@@ -42,6 +122,14 @@ def get_object_id(instance, table_oid=None):
           >>> get_object_id(mock_instance)
           u'alkey:items#1234'
 
+      Mapped instances use their primary key identity, which means string,
+      UUID and composite primary keys get their own object id too::
+
+          >>> mock_get_ident = Mock()
+          >>> mock_get_ident.return_value = (1234, u'en')
+          >>> get_object_id(mock_instance, get_ident=mock_get_ident)
+          u'alkey:items#1234,en'
+
       Can also be passed a model class::
 
           >>> mock_instance.id = '<column>'
@@ -59,13 +147,22 @@ def get_object_id(instance, table_oid=None):
     # Compose.
     if table_oid is None:
         table_oid = get_table_id
+    if get_ident is None:
+        get_ident = get_identity
+    if encode is None:
+        encode = encode_identity
 
     # If we've been passed a flushed sqlalchemy instance, return an instance
-    # identifier.
+    # identifier. Prefer the mapper's primary key identity, falling back on
+    # an integer ``id`` attribute for objects that aren't mapped.
     if hasattr(instance, '__tablename__'):
-        instance_id = getattr(instance, 'id', None)
-        if isinstance(instance_id, int):
-            return u'alkey:{0}#{1}'.format(instance.__tablename__, instance.id)
+        identity = get_ident(instance)
+        if identity is None:
+            instance_id = getattr(instance, 'id', None)
+            if isinstance(instance_id, (int, long)):
+                identity = (instance_id,)
+        if identity:
+            return u'alkey:{0}#{1}'.format(instance.__tablename__, encode(identity))
         # Or if we've been passed an unflushed instance or a model class,
         # return a class identifier.
         return table_oid(instance.__tablename__)
@@ -94,6 +191,32 @@ def get_table_id(tablename):
 
     return u'alkey:{0}#*'.format(tablename)
 
+def is_token_read(args, namespace=None, commands=('GET', 'MGET')):
+    """Is the redis command in ``args`` a read of token keys only?
+
+          >>> is_token_read(('GET', u'alkey.cache.TOKENS:alkey:users#1'))
+          True
+          >>> is_token_read(('MGET', 'alkey.cache.TOKENS:alkey:users#1', 'foo'))
+          False
+          >>> is_token_read(('SETEX', 'alkey.cache.TOKENS:alkey:users#1', 1, 'a'))
+          False
+
+    """
+
+    # Compose.
+    if namespace is None:
+        namespace = TOKEN_NAMESPACE
+
+    if len(args) < 2 or args[0].upper() not in commands:
+        return False
+    prefix = u'{0}:'.format(namespace)
+    for key in args[1:]:
+        if isinstance(key, str):
+            key = key.decode('utf-8')
+        if not key.startswith(prefix):
+            return False
+    return True
+
 def unpack_object_id(object_id):
     """Return ``(table_name, id)`` for ``object_id``::
 
@@ -102,14 +225,29 @@ def unpack_object_id(object_id):
           >>> unpack_object_id(u'alkey:questions#*')
           (u'questions', None)
 
+      String ids are unquoted and composite ids are returned as a tuple.
+      Note that UUIDs are returned in their encoded form::
+
+          >>> unpack_object_id(u'alkey:tags#a%23b')
+          (u'tags', u'a#b')
+          >>> unpack_object_id(u'alkey:translations#1234,en')
+          (u'translations', (1234, u'en'))
+
     """
 
     s = object_id.replace(u'alkey:', '', 1)
     parts = s.split('#')
-    try:
-        parts[1] = int(parts[1])
-    except ValueError:
+    if parts[1] == u'*':
         parts[1] = None
+        return tuple(parts)
+    values = []
+    for part in parts[1].split(','):
+        try:
+            value = int(part)
+        except ValueError:
+            value = urllib.unquote(part.encode('utf-8')).decode('utf-8')
+        values.append(value)
+    parts[1] = values[0] if len(values) == 1 else tuple(values)
     return tuple(parts)
 
 def resiliently_call(target, args=[], kwargs={}, should_raise=False, sleep=None,
@@ -169,7 +307,43 @@ def resiliently_call(target, args=[], kwargs={}, should_raise=False, sleep=None,
             logger.warn(err, exc_info=True)
 
 def is_single_relation(candidate):
-    return isinstance(candidate, relprop_cls) and not candidate.uselist
+    if candidate is None:
+        return False
+    from sqlalchemy.orm.relationships import RelationshipProperty
+    return isinstance(candidate, RelationshipProperty) and not candidate.uselist
+
+def get_relation_tables(cls):
+    """Return the tablenames of the single relations declared on ``cls``,
+      i.e.: the tables its instances "belong to", without reading any of
+      the instances' attributes::
+
+          >>> from sqlalchemy import Column, ForeignKey, Integer
+          >>> from sqlalchemy.ext.declarative import declarative_base
+          >>> from sqlalchemy.orm import relationship
+          >>> Base = declarative_base()
+          >>> class User(Base):
+          ...     __tablename__ = 'users'
+          ...     id = Column(Integer, primary_key=True)
+          >>> class Order(Base):
+          ...     __tablename__ = 'orders'
+          ...     id = Column(Integer, primary_key=True)
+          ...     user_id = Column(Integer, ForeignKey('users.id'))
+          ...     user = relationship(User, backref='orders')
+          >>> get_relation_tables(Order)
+          ['users']
+          >>> get_relation_tables(User)
+          []
+
+    """
+
+    tablenames = set()
+    for value in cls.__dict__.itervalues():
+        relprop = getattr(value, 'property', None)
+        if is_single_relation(relprop):
+            tablename = getattr(relprop.mapper.class_, '__tablename__', None)
+            if tablename:
+                tablenames.add(tablename)
+    return sorted(tablenames)
 
 def get_single_relations(instance):
     mapping = {}
@@ -180,5 +354,120 @@ def get_single_relations(instance):
             id_ = getattr(instance, '{0}_id'.format(key), None)
             tablename = relprop.mapper.class_.__tablename__
             if id_ and tablename:
-                mapping[key] = u'alkey:{0}#{1}'.format(tablename, id_)
+                mapping[key] = u'alkey:{0}#{1}'.format(tablename,
+                        encode_identity((id_,)))
     return mapping.values()
+
+def get_parents(instance, previous=True):
+    """Yield ``(parent_oid, parent)`` for the parents of ``instance`` declared
+      in its class' ``__alkey_parents__`` -- plus, if ``previous``, the ones
+      it's just been moved away from. ``parent`` is the parent instance, if
+      it's available without loading it from the db, or ``None``.
+
+      Note that if ``previous`` and the instance's foreign keys have been
+      expired, they're selected from the db.
+    """
+
+    state = inspect(instance, raiseerr=False)
+    if state is None:
+        return
+    from sqlalchemy.orm.attributes import NO_VALUE
+    from sqlalchemy.orm.state import InstanceState
+    if not isinstance(state, InstanceState):
+        return
+    mapper = state.mapper
+    committed = {}
+    def get_values(key):
+        # Attribute history doesn't load anything from the db.
+        history = state.attrs[key].history
+        values = list(history.unchanged or ()) + list(history.added or ())
+        if previous:
+            values.extend(history.deleted or ())
+            if key in committed:
+                values.append(committed[key])
+        return values
+
+    # If the instance has been expired, look up the committed foreign key
+    # values, so the parents it's being moved away from are included.
+    if previous and state.key is not None and state.session is not None:
+        columns = []
+        for name in getattr(type(instance), '__alkey_parents__', ()):
+            if name in mapper.relationships:
+                prop = mapper.relationships[name]
+                columns.extend(local for local, _ in prop.local_remote_pairs)
+        keys = [mapper.get_property_by_column(col).key for col in columns]
+        unknown = [i for i, key in enumerate(keys) if key not in state.dict or
+                state.committed_state.get(key) is NO_VALUE]
+        if unknown:
+            criteria = [col == value for col, value in
+                    zip(mapper.primary_key, state.key[1])]
+            with state.session.no_autoflush:
+                query = state.session.query(*[columns[i] for i in unknown])
+                row = query.filter(*criteria).first()
+            if row is not None:
+                for i, value in zip(unknown, row):
+                    committed[keys[i]] = value
+
+    for name in getattr(type(instance), '__alkey_parents__', ()):
+        if name not in mapper.relationships:
+            msg = u'{0}.__alkey_parents__: {1} is not a relationship.'
+            raise ValueError(msg.format(type(instance).__name__, name))
+        prop = mapper.relationships[name]
+        parent_mapper = prop.mapper
+        tablename = parent_mapper.class_.__tablename__
+
+        # The parent instances that are already loaded.
+        for parent in get_values(prop.key):
+            if parent is not None:
+                yield get_object_id(parent), parent
+
+        # And the parents identified by the foreign key values.
+        columns = {}
+        for local, remote in prop.local_remote_pairs:
+            columns[remote] = get_values(mapper.get_property_by_column(local).key)
+        primary_key = parent_mapper.primary_key
+        if set(primary_key) != set(columns):
+            # Not joined on the primary key, so fall back on the table.
+            yield get_table_id(tablename), None
+            continue
+        # Line up the current and previous values of each column.
+        for identity in zip(*[columns[col] for col in primary_key]):
+            if None in identity:
+                continue
+            oid = u'alkey:{0}#{1}'.format(tablename, encode_identity(identity))
+            parent = None
+            if state.session is not None:
+                key = parent_mapper.identity_key_from_primary_key(list(identity))
+                parent = state.session.identity_map.get(key)
+            yield oid, parent
+
+def get_parent_oids(instance, get_parents_=None):
+    """Return the object ids of the declared parents of ``instance`` and,
+      transitively, their declared parents -- as far as they're available
+      without loading anything from the db.
+
+      Declare parents by listing many to one relationships in a model class'
+      ``__alkey_parents__``, e.g.: ``__alkey_parents__ = ('order',)``.
+
+          >>> get_parent_oids('flobble')
+          []
+
+    """
+
+    # Compose.
+    if get_parents_ is None:
+        get_parents_ = get_parents
+
+    oids = []
+    seen = set()
+    queue = [(instance, True)]
+    while queue:
+        item, previous = queue.pop(0)
+        for oid, parent in get_parents_(item, previous=previous):
+            if oid in seen:
+                continue
+            seen.add(oid)
+            oids.append(oid)
+            if parent is not None:
+                queue.append((parent, False))
+    return oids